@@ -0,0 +1,555 @@
+"""
+Офлайн-бенчмарк обработчиков бота.
+
+Настоящие обработчики из было.py запускаются на замороженной копии
+downloaded_files (копируется во временную папку, которая становится рабочей:
+кэш и служебные файлы бота не трогаются) с поддельными Update и Bot. Нагрузки
+строятся детерминированно из зерна и списка файлов:
+
+- morning_rush - утренний наплыв запросов расписания групп (популярные группы
+  спрашивают чаще), одновременно до --concurrency запросов;
+- teacher_ranges - расписания преподавателей на период замен и на отдельные даты;
+- classroom_sweep - обход кабинетов с выбором даты.
+
+Обработчики берут даты от текущего дня, поэтому часы бота замораживаются на
+--today (по умолчанию - первый день последнего файла замен, 08:00): запуск
+на тех же файлах с тем же зерном повторяет ту же нагрузку в любой день.
+
+Для каждой нагрузки выводятся пропускная способность, процентили задержки,
+пиковый RSS процесса, количество открытий Excel на запрос и задержки этапов
+из metrics. Результат можно сохранить как базовый и сравнивать с ним
+последующие запуски; при регрессии код возврата - 1.
+
+--parse-engine выбирает движок разбора файлов (parse_engine) для загрузки
+расписания, а --parse-scaling вместо нагрузок измеряет полную сборку
+поколения из замороженных файлов движком "thread" и движком "process" с
+заданным числом процессов и проверяет, что результаты совпадают.
+
+    python benchmark.py
+    python benchmark.py --workload morning_rush --queries 500 --concurrency 30
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json
+    python benchmark.py --parse-scaling 1,2,4
+"""
+import os
+import sys
+import json
+import time
+import re
+import random
+import shutil
+import asyncio
+import hashlib
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+from types import SimpleNamespace
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WORKLOADS = ("morning_rush", "teacher_ranges", "classroom_sweep")
+SUBGROUP_BUTTONS = ("Первая подгруппа", "Вторая подгруппа")
+# Формат кабинета, который принимает enter_classroom
+CLASSROOM_PATTERN = re.compile(r'^[А-ЯA-Z]\d{2,}$', re.IGNORECASE)
+# Допустимое ухудшение относительно базового запуска
+DEFAULT_THRESHOLD = 0.2
+# Время замороженных часов: утренний наплыв перед первой парой
+FROZEN_TIME = (8, 0)
+
+logger = logging.getLogger("benchmark")
+
+
+class FakeBot:
+    """Bot, который ничего не отправляет, а считает сообщения"""
+
+    def __init__(self, send_latency=0.0):
+        self.send_latency = send_latency
+        self.sent = 0
+        self.deleted = 0
+        self._message_ids = 0
+        self._lock = threading.Lock()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        with self._lock:
+            self.sent += 1
+            self._message_ids += 1
+            message_id = self._message_ids
+        return FakeMessage(self, chat_id, text, message_id)
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, text, message_id=0):
+        self._bot = bot
+        self.chat = SimpleNamespace(id=chat_id)
+        self.chat_id = chat_id
+        self.text = text
+        self.message_id = message_id
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot.send_message(self.chat_id, text, **kwargs)
+
+    async def delete(self):
+        self._bot.deleted += 1
+        return True
+
+
+def fake_update(bot, user_id, text):
+    """Update с сообщением пользователя user_id"""
+    user = SimpleNamespace(id=user_id, username=f"bench{user_id}", first_name="Bench", last_name="")
+    message = FakeMessage(bot, user_id, text)
+    message.from_user = user
+    return SimpleNamespace(
+        message=message, effective_message=message, effective_user=user,
+        effective_chat=message.chat, callback_query=None
+    )
+
+
+def fake_context(bot):
+    """Контекст одного диалога (user_data общий для всех шагов диалога)"""
+    return SimpleNamespace(
+        bot=bot, args=[], user_data={}, chat_data={},
+        application=SimpleNamespace(user_data={}, bot_data={})
+    )
+
+
+class ExcelOpenCounter:
+    """Считает вызовы openpyxl.load_workbook"""
+
+    def __init__(self):
+        import openpyxl
+        self.count = 0
+        self._lock = threading.Lock()
+        self._original = openpyxl.load_workbook
+
+        def counting_load_workbook(*args, **kwargs):
+            with self._lock:
+                self.count += 1
+            return self._original(*args, **kwargs)
+
+        openpyxl.load_workbook = counting_load_workbook
+
+
+def files_digest(files_dir):
+    """Отпечаток набора файлов (имена, размеры, содержимое)"""
+    digest = hashlib.sha256()
+    for file_name in sorted(os.listdir(files_dir)):
+        digest.update(file_name.encode("utf-8"))
+        with open(os.path.join(files_dir, file_name), "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:16]
+
+
+def freeze_files(source_dir):
+    """Копирует файлы во временную папку и делает ее рабочей"""
+    work_dir = tempfile.mkdtemp(prefix="botmpk-bench-")
+    shutil.copytree(source_dir, os.path.join(work_dir, "downloaded_files"))
+    os.chdir(work_dir)
+    return work_dir
+
+
+def default_today(files_dir):
+    """Первый день последнего по дате файла замен (или сегодня, если файлов замен нет)"""
+    starts = []
+    for file_name in os.listdir(files_dir):
+        parts = os.path.splitext(file_name)[0].split('-')
+        if len(parts) != 2:
+            continue
+        for date_format in ('%d.%m.%y', '%d.%m.%Y'):
+            try:
+                starts.append(datetime.strptime(parts[0], date_format))
+                break
+            except ValueError:
+                continue
+    return max(starts).date() if starts else datetime.now().date()
+
+
+def freeze_clock(today):
+    """
+    Подменяет datetime в загруженных модулях бота на класс с замороженными now()/today().
+
+    Модули импортируют "from datetime import datetime", поэтому замена имени
+    в модуле действует на все их вызовы.
+    """
+    frozen_now = datetime(today.year, today.month, today.day, *FROZEN_TIME)
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return frozen_now.replace(tzinfo=tz) if tz else frozen_now
+
+        @classmethod
+        def today(cls):
+            return frozen_now
+
+    real_datetime = datetime
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, '__file__', None) or ''
+        if module_file == __file__ or os.path.dirname(os.path.abspath(module_file)) != REPO_DIR:
+            continue
+        if getattr(module, 'datetime', None) is real_datetime:
+            module.datetime = FrozenDatetime
+    return frozen_now
+
+
+def apply_production_patches():
+    """Те же замены функций было, что выполняет main.py при запуске"""
+    from schedule_wrapper import patch_get_teacher_schedule
+    from schedule_store import patch_schedule_parsers
+    from replacements_store import patch_load_replacements
+    from classroom_index import patch_classroom_schedule
+    from excel_cache import patch_excel_functions
+
+    patch_get_teacher_schedule()
+    patch_schedule_parsers()
+    patch_load_replacements()
+    patch_classroom_schedule()
+    patch_excel_functions()
+
+
+async def warm_up(raw):
+    """Загрузка расписания и построение индексов, как после запуска бота"""
+    from schedule_generations import get_generation
+    started = time.perf_counter()
+    generation = get_generation()
+    if not raw:
+        import schedule_wrapper
+        from teacher_schedule_processor import precache_teacher_schedules
+        await schedule_wrapper.do_initial_setup()
+        await precache_teacher_schedules()
+    return generation, time.perf_counter() - started
+
+
+def _zipf_weights(count):
+    return [1.0 / (rank + 1) for rank in range(count)]
+
+
+def build_workload(name, generation, queries, rng):
+    """Список запросов нагрузки: кортежи (вид, параметры)"""
+    store = generation.store
+    if name == "morning_rush":
+        groups = sorted(os.path.splitext(file_name)[0] for file_name in store.entries)
+        popularity = groups[:]
+        rng.shuffle(popularity)
+        picks = rng.choices(popularity, weights=_zipf_weights(len(popularity)), k=queries)
+        return [("group", (group, rng.choice(SUBGROUP_BUTTONS))) for group in picks]
+
+    if name == "teacher_ranges":
+        teachers = sorted(store.teacher_display_names.values())
+        dates = sorted({date_str for sheet in generation.replacement_sheets.values() for date_str in sheet.cells})
+        workload = []
+        for _ in range(queries):
+            teacher = rng.choice(teachers)
+            if dates and rng.random() < 0.3:
+                workload.append(("teacher_date", (teacher, rng.choice(dates))))
+            else:
+                workload.append(("teacher", (teacher,)))
+        return workload
+
+    if name == "classroom_sweep":
+        rooms = sorted(room for room in store.room_display_names.values() if CLASSROOM_PATTERN.match(room))
+        start = rng.randrange(len(rooms)) if rooms else 0
+        return [("classroom", (rooms[(start + index) % len(rooms)], rng.random())) for index in range(queries)]
+
+    raise ValueError(f"Неизвестная нагрузка: {name}")
+
+
+async def run_query(bot, user_id, kind, params):
+    """Проходит диалог пользователя теми же обработчиками, что зарегистрированы в main.py"""
+    import было
+
+    context = fake_context(bot)
+    if kind == "group":
+        group, subgroup_button = params
+        await было.group_input(fake_update(bot, user_id, group), context)
+        await было.subgroup_choice(fake_update(bot, user_id, subgroup_button), context)
+    elif kind == "teacher":
+        await было.enter_teacher(fake_update(bot, user_id, params[0]), context)
+    elif kind == "teacher_date":
+        teacher, date_str = params
+        context.user_data['teacher_name'] = teacher
+        await было.choose_date_for_teacher(fake_update(bot, user_id, date_str), context)
+    elif kind == "classroom":
+        room, date_choice = params
+        await было.enter_classroom(fake_update(bot, user_id, room), context)
+        dates = sorted(context.user_data.get('available_dates', {}))
+        if dates:
+            display = dates[int(date_choice * len(dates))]
+            await было.choose_date_for_classroom(fake_update(bot, user_id, display), context)
+
+
+def _percentile(samples, q):
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+
+async def run_workload(name, workload, concurrency, bot, counter):
+    from cache_utils import clear_cache
+
+    # Каждая нагрузка начинается с пустым кэшем ответов
+    clear_cache()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    opens_before = counter.count
+    sent_before = bot.sent
+
+    async def one(index, kind, params):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await run_query(bot, 100000 + index, kind, params)
+            except Exception as e:
+                errors += 1
+                logger.error(f"{name}: запрос {kind} {params} завершился ошибкой: {e}")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index, kind, params) for index, (kind, params) in enumerate(workload)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    queries = len(workload)
+    return {
+        "queries": queries,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(queries / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        "excel_opens_per_query": round((counter.count - opens_before) / queries, 3) if queries else 0.0,
+        "messages_per_query": round((bot.sent - sent_before) / queries, 2) if queries else 0.0,
+        # ru_maxrss в Linux - в килобайтах
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def stage_breakdown():
+    """p50/p95 этапов из metrics по видам запросов"""
+    from metrics import get_latency_stats
+    return {
+        f"{query_type}.{stage}": {"count": entry["count"], "p50_ms": round(entry["p50"] * 1000, 2),
+                                  "p95_ms": round(entry["p95"] * 1000, 2)}
+        for (query_type, stage), entry in sorted(get_latency_stats().items())
+    }
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """Список регрессий относительно базового запуска"""
+    regressions = []
+    for name, result in report["workloads"].items():
+        base = baseline.get("workloads", {}).get(name)
+        if not base:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if base[metric] and result[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {base[metric]} -> {result[metric]}")
+        if base["throughput"] and result["throughput"] < base["throughput"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {base['throughput']} -> {result['throughput']}")
+        if result["excel_opens_per_query"] > base["excel_opens_per_query"]:
+            regressions.append(f"{name}: excel_opens_per_query {base['excel_opens_per_query']} "
+                               f"-> {result['excel_opens_per_query']}")
+        if result["errors"] > base.get("errors", 0):
+            regressions.append(f"{name}: errors {base.get('errors', 0)} -> {result['errors']}")
+    return regressions
+
+
+def print_report(report, baseline=None):
+    print(f"Файлы: {report['files']} ({report['files_digest']}), день {report['today']}, зерно {report['seed']}, "
+          f"параллельно {report['concurrency']}, режим {report['mode']}")
+    print(f"Загрузка расписания: {report['warm_up_seconds']} с")
+    header = f"{'нагрузка':<16}{'запросов':>9}{'зап/с':>9}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}" \
+             f"{'Excel/зап':>10}{'RSS МБ':>8}{'ошибок':>8}"
+    print(header)
+    for name, result in report["workloads"].items():
+        print(f"{name:<16}{result['queries']:>9}{result['throughput']:>9}{result['p50_ms']:>9}"
+              f"{result['p95_ms']:>9}{result['p99_ms']:>9}{result['excel_opens_per_query']:>10}"
+              f"{result['peak_rss_mb']:>8}{result['errors']:>8}")
+        base = (baseline or {}).get("workloads", {}).get(name)
+        if base:
+            print(f"{'  базовый':<16}{base['queries']:>9}{base['throughput']:>9}{base['p50_ms']:>9}"
+                  f"{base['p95_ms']:>9}{base['p99_ms']:>9}{base['excel_opens_per_query']:>10}"
+                  f"{base['peak_rss_mb']:>8}{base.get('errors', 0):>8}")
+    if report.get("stages"):
+        print("\nЭтапы (p50 / p95 мс, количество):")
+        for key, entry in report["stages"].items():
+            print(f"  {key}: {entry['p50_ms']} / {entry['p95_ms']}, {entry['count']}")
+
+
+def measure_parse_scaling(process_counts):
+    """Время сборки поколения с нуля каждым движком разбора"""
+    from parse_engine import set_parse_engine
+    from schedule_generations import _build, _list_sources
+
+    sources = _list_sources("downloaded_files")
+    runs = [("thread", 1)] + [("process", count) for count in process_counts]
+    results = []
+    reference = None
+    for engine, count in runs:
+        # Для движка process в измерение входит и запуск процессов: пул создается на каждую сборку
+        set_parse_engine(engine, count)
+        started = time.perf_counter()
+        store, sheets, _ = _build(sources, "downloaded_files", None)
+        seconds = time.perf_counter() - started
+        if reference is None:
+            reference = (store.entries, sheets)
+        results.append({
+            "engine": engine,
+            "workers": count,
+            "seconds": round(seconds, 3),
+            "files_per_second": round(len(sources) / seconds, 1) if seconds else 0.0,
+            "same_result": (store.entries, sheets) == reference,
+        })
+    set_parse_engine("thread")
+    for result in results:
+        result["speedup"] = round(results[0]["seconds"] / result["seconds"], 2) if result["seconds"] else 0.0
+    return {"files": len(sources), "cpus": os.cpu_count(), "runs": results}
+
+
+def print_parse_scaling(scaling):
+    print(f"Сборка поколения: {scaling['files']} файлов, процессоров {scaling['cpus']}")
+    print(f"{'движок':<10}{'потоков/процессов':>19}{'с':>9}{'файлов/с':>10}{'ускорение':>11}{'совпадает':>11}")
+    for run in scaling["runs"]:
+        print(f"{run['engine']:<10}{run['workers']:>19}{run['seconds']:>9}{run['files_per_second']:>10}"
+              f"{run['speedup']:>11}{'да' if run['same_result'] else 'НЕТ':>11}")
+
+
+async def run_benchmark(args):
+    generation, warm_up_seconds = await warm_up(args.raw)
+    counter = ExcelOpenCounter()
+    bot = FakeBot(args.send_latency / 1000)
+    rng = random.Random(args.seed)
+
+    report = {
+        "files": args.files,
+        "files_digest": files_digest("downloaded_files"),
+        "seed": args.seed,
+        "concurrency": args.concurrency,
+        "mode": "raw" if args.raw else "production",
+        "today": args.today.strftime('%d.%m.%Y'),
+        "warm_up_seconds": round(warm_up_seconds, 3),
+        "workloads": {},
+    }
+    for name in args.workload:
+        workload = build_workload(name, generation, args.queries, rng)
+        report["workloads"][name] = await run_workload(name, workload, args.concurrency, bot, counter)
+    report["stages"] = stage_breakdown()
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработчиков бота")
+    parser.add_argument("--files", default=os.path.join(REPO_DIR, "downloaded_files"),
+                        help="Папка с файлами расписаний и замен (копируется перед запуском)")
+    parser.add_argument("--workload", action="append", choices=WORKLOADS,
+                        help="Нагрузка (можно указать несколько раз; по умолчанию все)")
+    parser.add_argument("--queries", type=int, default=200, help="Запросов в каждой нагрузке")
+    parser.add_argument("--concurrency", type=int, default=20, help="Одновременных запросов")
+    parser.add_argument("--seed", type=int, default=1, help="Зерно генератора нагрузок")
+    parser.add_argument("--send-latency", type=float, default=0.0,
+                        help="Задержка поддельной отправки сообщения, мс")
+    parser.add_argument("--today", help="Дата замороженных часов бота, DD.MM.YYYY "
+                                         "(по умолчанию - первый день последнего файла замен)")
+    parser.add_argument("--raw", action="store_true",
+                        help="Без замен функций из main.py (исходные реализации было.py)")
+    parser.add_argument("--parse-engine", choices=("thread", "process"), default="thread",
+                        help="Движок разбора файлов при загрузке расписания")
+    parser.add_argument("--parse-processes", type=int, help="Процессов для движка process")
+    parser.add_argument("--parse-scaling", help="Только измерить сборку поколения движками разбора "
+                                                "с указанным числом процессов, например 1,2,4")
+    parser.add_argument("--baseline", help="Сравнить с сохраненным запуском")
+    parser.add_argument("--save-baseline", help="Сохранить результат как базовый")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Допустимое ухудшение задержек и пропускной способности (доля)")
+    parser.add_argument("--json", action="store_true", help="Вывести результат в JSON")
+    parser.add_argument("--verbose", action="store_true", help="Показывать логи бота")
+    args = parser.parse_args(argv)
+    args.workload = args.workload or list(WORKLOADS)
+    args.files = os.path.abspath(args.files)
+    if args.parse_scaling:
+        try:
+            args.parse_scaling = [int(count) for count in args.parse_scaling.split(",")]
+        except ValueError:
+            parser.error("--parse-scaling: ожидается список чисел через запятую")
+    for option in ("baseline", "save_baseline"):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO if args.verbose else logging.ERROR)
+
+    work_dir = freeze_files(args.files)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        import было  # noqa: F401 - обработчики и их зависимости
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.ERROR)
+        if not args.raw:
+            apply_production_patches()
+        # Модули, которые обработчики импортируют при первом запросе
+        import cache_utils, prerender, classroom_index, schedule_wrapper, teacher_schedule_processor  # noqa: F401,E401
+        args.today = (datetime.strptime(args.today, '%d.%m.%Y').date() if args.today
+                      else default_today("downloaded_files"))
+        freeze_clock(args.today)
+
+        if args.parse_scaling:
+            scaling = measure_parse_scaling(args.parse_scaling)
+        else:
+            from parse_engine import set_parse_engine
+            set_parse_engine(args.parse_engine, args.parse_processes)
+            report = asyncio.run(run_benchmark(args))
+            report["parse_engine"] = args.parse_engine
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.parse_scaling:
+        if args.json:
+            print(json.dumps(scaling, ensure_ascii=False, indent=2))
+        else:
+            print_parse_scaling(scaling)
+        return 0 if all(run["same_result"] for run in scaling["runs"]) else 1
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("files_digest") != report["files_digest"]:
+            print("Внимание: базовый запуск выполнен на другом наборе файлов")
+        for option in ("today", "seed", "concurrency", "mode"):
+            if baseline.get(option) != report[option]:
+                print(f"Внимание: у базового запуска другое значение {option}: {baseline.get(option)}")
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Базовый запуск сохранен в {args.save_baseline}")
+
+    if baseline:
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print("Регрессии:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("Регрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,6 +13,9 @@ user_tasks: Dict[int, List[asyncio.Task]] = {}
 # Increase the number of concurrent operations
 MAX_CONCURRENT_OPERATIONS = 30  # Increased from default
 
+# Threads of the loop's default executor (DNS lookups and other short library I/O)
+DEFAULT_EXECUTOR_WORKERS = 4
+
 # Type variables for better type hinting
 T = TypeVar('T')
 HandlerCallbackType = Callable[..., Any]
@@ -213,15 +216,18 @@ def patch_dispatcher():
 # Apply all concurrency patches
 def apply_all_concurrency_patches():
     """Apply all concurrency patches to ensure true parallel processing"""
-    # Set asyncio to use a larger thread pool
+    # Keep the default executor (run_in_executor(None), DNS lookups for Telegram API connections)
+    # out of the task scheduler: it must not wait behind Excel parsing or fail when the queue is full.
+    # The bot's own blocking work goes to the scheduler through run_blocking/run_task.
     try:
         import concurrent.futures
         asyncio.get_event_loop().set_default_executor(
-            concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_OPERATIONS)
+            concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_EXECUTOR_WORKERS,
+                                                  thread_name_prefix="default-io")
         )
-        logger.info(f"Set asyncio thread pool to {MAX_CONCURRENT_OPERATIONS} workers")
+        logger.info(f"Set asyncio default executor to {DEFAULT_EXECUTOR_WORKERS} I/O workers")
     except Exception as e:
-        logger.warning(f"Could not set asyncio thread pool: {e}")
+        logger.warning(f"Could not set default executor: {e}")
     
     patch_application_class()
     patch_dispatcher()
@@ -0,0 +1,384 @@
+"""
+Рассылка уведомлений подписчикам.
+
+Сообщения отправляются параллельно (не больше MAX_CONCURRENT_SENDS запросов
+одновременно) с соблюдением ограничений Telegram: общего числа сообщений
+в секунду на бота и интервала между сообщениями в один чат. Ответ RetryAfter
+приостанавливает всю рассылку на указанное Telegram время.
+
+Поток синхронизации передает уведомление через publish_notification: рассылка
+записывается в журнал (по файлу на рассылку) и сразу ставится в очередь цикла
+событий рассылки. В том же файле журнала периодически сохраняется, кому
+сообщение уже доставлено, поэтому после перезапуска бота незавершенные
+рассылки продолжаются с того места, где остановились, а не начинаются заново.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+
+logger = logging.getLogger(__name__)
+
+# Журнал рассылок: по файлу на рассылку, файл удаляется после ее завершения
+NOTIFICATION_JOURNAL_DIR = "notification_journal"
+
+# Файлы уведомления и хода рассылки, которые писали прежние версии бота
+NOTIFICATION_FILE = "new_replacements_notify.json"
+BROADCAST_PROGRESS_FILE = "broadcast_progress.json"
+
+# Telegram допускает около 30 сообщений в секунду от бота и 1 сообщение в секунду в один чат
+GLOBAL_RATE_LIMIT = 25
+PER_CHAT_INTERVAL = 1.0
+MAX_CONCURRENT_SENDS = 10
+# Попыток отправки при сетевых ошибках (ожидания по RetryAfter не считаются)
+MAX_SEND_ATTEMPTS = 3
+MAX_RETRY_AFTER_WAITS = 5
+# Как часто (в секундах) записывать ход рассылки на диск
+PROGRESS_FLUSH_INTERVAL = 1.0
+
+# Цикл событий и очередь рассылки (устанавливаются при запуске notification_channel)
+_channel_loop = None
+_channel_queue = None
+_channel_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_last_broadcast_stats = {}
+_totals = {'broadcasts': 0, 'sent': 0, 'failed': 0, 'retry_after': 0, 'retries': 0}
+
+
+def _retry_after_seconds(error):
+    """Время ожидания из RetryAfter в секундах (retry_after может быть числом или timedelta)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class RateLimiter:
+    """Ограничитель частоты отправки: общий для бота и отдельный для каждого чата"""
+
+    def __init__(self, rate=GLOBAL_RATE_LIMIT, per_chat_interval=PER_CHAT_INTERVAL):
+        self.interval = 1.0 / rate
+        self.per_chat_interval = per_chat_interval
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._chat_next = {}
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Приостанавливает все отправки (ответ RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id):
+        """Ждет, пока можно будет отправить сообщение в чат"""
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + self.interval
+            slot = max(slot, self._chat_next.get(chat_id, 0.0))
+            self._chat_next[chat_id] = slot + self.per_chat_interval
+
+        while True:
+            delay = max(slot, self._paused_until) - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+
+def new_broadcast(message, chat_ids, parse_mode=None, messages=None):
+    """
+    Описание рассылки в том виде, в котором оно хранится на диске.
+
+    Args:
+        message: Текст для всех чатов
+        chat_ids: Получатели
+        parse_mode: Режим разметки Telegram или None
+        messages: Персональные тексты {chat_id: текст}, заменяющие message
+    """
+    return {
+        'id': uuid.uuid4().hex,
+        'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'message': message,
+        'messages': {str(chat_id): text for chat_id, text in (messages or {}).items()},
+        'parse_mode': parse_mode,
+        'chat_ids': [str(chat_id) for chat_id in chat_ids],
+        'delivered': [],
+        'failed': []
+    }
+
+
+def save_progress(broadcast, progress_file=BROADCAST_PROGRESS_FILE):
+    """Записывает ход рассылки (через временный файл)"""
+    temp_file = f"{progress_file}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(broadcast, f, ensure_ascii=False)
+    os.replace(temp_file, progress_file)
+
+
+def load_progress(progress_file=BROADCAST_PROGRESS_FILE):
+    """Незавершенная рассылка или None"""
+    try:
+        with open(progress_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка при чтении хода рассылки: {e}")
+        return None
+
+
+async def run_broadcast(bot, broadcast, progress_file=BROADCAST_PROGRESS_FILE, limiter=None):
+    """
+    Отправляет сообщение рассылки всем чатам, которым оно еще не доставлено.
+
+    Args:
+        bot: telegram.Bot
+        broadcast: Рассылка из new_broadcast или load_progress (изменяется на месте)
+        progress_file: Куда записывать ход рассылки
+        limiter: RateLimiter (по умолчанию новый с ограничениями Telegram)
+
+    Returns:
+        dict: Статистика рассылки
+    """
+    limiter = limiter or RateLimiter()
+    delivered = set(broadcast['delivered'])
+    failed = set(broadcast['failed'])
+    pending = [chat_id for chat_id in broadcast['chat_ids'] if chat_id not in delivered and chat_id not in failed]
+    stats = {
+        'id': broadcast['id'],
+        'total': len(broadcast['chat_ids']),
+        'resumed': len(delivered) + len(failed),
+        'sent': 0,
+        'failed': 0,
+        'retry_after': 0,
+        'retries': 0
+    }
+    messages = broadcast.get('messages') or {}
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+    dirty = asyncio.Event()
+
+    def record(chat_id, ok):
+        (delivered if ok else failed).add(chat_id)
+        stats['sent' if ok else 'failed'] += 1
+        dirty.set()
+
+    async def send(chat_id):
+        attempts = 0
+        waits = 0
+        async with semaphore:
+            while True:
+                await limiter.acquire(chat_id)
+                try:
+                    await bot.send_message(chat_id=int(chat_id), text=messages.get(chat_id, broadcast['message']),
+                                           parse_mode=broadcast.get('parse_mode'))
+                    record(chat_id, True)
+                    return
+                except RetryAfter as e:
+                    delay = _retry_after_seconds(e)
+                    stats['retry_after'] += 1
+                    waits += 1
+                    limiter.pause(delay)
+                    logger.warning(f"Telegram ограничил частоту отправки, пауза {delay:.0f} с")
+                    if waits > MAX_RETRY_AFTER_WAITS:
+                        logger.error(f"Не удалось отправить уведомление в чат {chat_id}: превышено число ожиданий")
+                        record(chat_id, False)
+                        return
+                except (Forbidden, BadRequest) as e:
+                    # Бот заблокирован или чат недоступен - повторять бессмысленно
+                    logger.info(f"Уведомление не доставлено в чат {chat_id}: {e}")
+                    record(chat_id, False)
+                    return
+                except NetworkError as e:
+                    attempts += 1
+                    if attempts >= MAX_SEND_ATTEMPTS:
+                        logger.error(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
+                        record(chat_id, False)
+                        return
+                    stats['retries'] += 1
+                    await asyncio.sleep(2 ** (attempts - 1))
+                except Exception as e:
+                    logger.error(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
+                    record(chat_id, False)
+                    return
+
+    def flush():
+        broadcast['delivered'] = sorted(delivered)
+        broadcast['failed'] = sorted(failed)
+        try:
+            save_progress(broadcast, progress_file)
+        except Exception as e:
+            logger.error(f"Ошибка при записи хода рассылки: {e}")
+
+    async def flusher():
+        while True:
+            await dirty.wait()
+            dirty.clear()
+            flush()
+            await asyncio.sleep(PROGRESS_FLUSH_INTERVAL)
+
+    if stats['resumed']:
+        logger.info(f"Продолжение рассылки {broadcast['id']}: уже обработано {stats['resumed']} из {stats['total']}")
+
+    started = time.monotonic()
+    flush_task = asyncio.create_task(flusher())
+    try:
+        await asyncio.gather(*(send(chat_id) for chat_id in pending))
+    finally:
+        flush_task.cancel()
+        flush()
+
+    elapsed = time.monotonic() - started
+    stats['elapsed'] = round(elapsed, 3)
+    stats['per_second'] = round(stats['sent'] / elapsed, 2) if elapsed > 0 else 0.0
+    logger.info(f"Рассылка {broadcast['id']} завершена: доставлено {stats['sent']}, не доставлено {stats['failed']}, "
+                f"RetryAfter {stats['retry_after']}, повторов {stats['retries']}, "
+                f"{stats['elapsed']} с ({stats['per_second']} сообщений/с)")
+
+    with _stats_lock:
+        _last_broadcast_stats.clear()
+        _last_broadcast_stats.update(stats)
+        _totals['broadcasts'] += 1
+        for key in ('sent', 'failed', 'retry_after', 'retries'):
+            _totals[key] += stats[key]
+    return stats
+
+
+async def process_notifications(bot, notification_file=NOTIFICATION_FILE, progress_file=BROADCAST_PROGRESS_FILE,
+                                chat_ids=None):
+    """
+    Доводит до конца рассылку из файлов прежнего формата.
+
+    Args:
+        bot: telegram.Bot
+        notification_file: Файл уведомления ({message, chat_ids, parse_mode})
+        progress_file: Файл хода рассылки
+        chat_ids: Получатели вместо указанных в файле уведомления
+    """
+    broadcast = load_progress(progress_file)
+    if broadcast:
+        await run_broadcast(bot, broadcast, progress_file)
+        os.remove(progress_file)
+
+    if not os.path.exists(notification_file):
+        return
+
+    logger.info(f"Найден файл уведомления: {notification_file}")
+    with open(notification_file, 'r', encoding='utf-8') as f:
+        notification_data = json.load(f)
+
+    message = notification_data.get("message", "")
+    recipients = chat_ids if chat_ids is not None else notification_data.get("chat_ids", [])
+    if message and recipients:
+        broadcast = new_broadcast(message, recipients, notification_data.get("parse_mode", "Markdown"))
+        # Сначала сохраняется рассылка, потом удаляется уведомление: при сбое между
+        # этими шагами уведомление будет разослано один раз
+        save_progress(broadcast, progress_file)
+    else:
+        broadcast = None
+    os.remove(notification_file)
+
+    if broadcast:
+        await run_broadcast(bot, broadcast, progress_file)
+        os.remove(progress_file)
+
+
+def _journal_entries(journal_dir=NOTIFICATION_JOURNAL_DIR):
+    """Файлы незавершенных рассылок в порядке постановки в очередь"""
+    try:
+        file_names = os.listdir(journal_dir)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(journal_dir, f) for f in sorted(file_names) if f.endswith('.json')]
+
+
+def publish_notification(message, chat_ids, parse_mode="Markdown", messages=None,
+                         journal_dir=NOTIFICATION_JOURNAL_DIR):
+    """
+    Ставит рассылку в очередь. Можно вызывать из любого потока.
+
+    Рассылка сначала записывается в журнал, поэтому не теряется, даже если
+    цикл рассылки еще не запущен или бот завершится до ее окончания.
+
+    Returns:
+        str: Путь к файлу рассылки в журнале
+    """
+    broadcast = new_broadcast(message, chat_ids, parse_mode, messages)
+    os.makedirs(journal_dir, exist_ok=True)
+    journal_file = os.path.join(journal_dir, f"{time.time_ns()}-{broadcast['id']}.json")
+    save_progress(broadcast, journal_file)
+
+    with _channel_lock:
+        loop, queue = _channel_loop, _channel_queue
+    if loop is not None and not loop.is_closed():
+        loop.call_soon_threadsafe(queue.put_nowait, journal_file)
+        logger.info(f"Рассылка {broadcast['id']} для {len(broadcast['chat_ids'])} чатов поставлена в очередь")
+    else:
+        logger.info(f"Рассылка {broadcast['id']} записана в журнал, будет отправлена после запуска цикла рассылки")
+    return journal_file
+
+
+async def notification_channel(bot, journal_dir=NOTIFICATION_JOURNAL_DIR):
+    """Отправляет рассылки из очереди по мере поступления"""
+    global _channel_loop, _channel_queue
+
+    queue = asyncio.Queue()
+    with _channel_lock:
+        _channel_loop = asyncio.get_running_loop()
+        _channel_queue = queue
+
+    try:
+        await process_notifications(bot)
+    except Exception as e:
+        logger.error(f"Ошибка при рассылке уведомления прежнего формата: {e}")
+
+    # Незавершенные рассылки из журнала. Рассылка, опубликованная между установкой
+    # очереди и чтением журнала, попадет в очередь дважды и будет пропущена
+    for journal_file in _journal_entries(journal_dir):
+        queue.put_nowait(journal_file)
+
+    completed = set()
+    while True:
+        journal_file = await queue.get()
+        if journal_file in completed or not os.path.exists(journal_file):
+            continue
+        broadcast = load_progress(journal_file)
+        if broadcast:
+            try:
+                await run_broadcast(bot, broadcast, journal_file)
+            except Exception as e:
+                # Файл остается в журнале, рассылка продолжится после перезапуска
+                logger.error(f"Ошибка при рассылке уведомлений: {e}")
+                logger.error(traceback.format_exc())
+                continue
+        os.remove(journal_file)
+        completed.add(journal_file)
+
+
+def start_notification_sender(token):
+    """Запускает цикл рассылки уведомлений в фоновом потоке"""
+    from telegram import Bot
+
+    def runner():
+        logger.info("Запущен поток рассылки уведомлений")
+        asyncio.run(notification_channel(Bot(token=token)))
+
+    thread = threading.Thread(target=runner, name="broadcast", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_broadcast_stats():
+    """Статистика последней рассылки и суммарные счетчики"""
+    with _stats_lock:
+        return {
+            'last': dict(_last_broadcast_stats),
+            'totals': dict(_totals),
+            'pending': len(_journal_entries())
+        }
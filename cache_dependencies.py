@@ -0,0 +1,120 @@
+"""
+Инвалидация кэша по зависимостям.
+
+После синхронизации сравнивает хранилище расписаний и скомпилированные файлы
+замен до и после обновления и удаляет из кэша только ответы, которые зависят
+от изменившихся данных:
+
+- изменились замены группы на дату -> расписание этой группы, ответы
+  преподавателей и кабинетов на эту дату;
+- появились или пропали даты замен -> расписания всех групп (в них меняется
+  набор дней), ответы преподавателей и кабинетов на эти даты;
+- изменился файл расписания группы -> расписание группы, все ответы
+  преподавателей и кабинетов (основное расписание действует на любые даты).
+"""
+import logging
+
+from cache_utils import (
+    STUDENT_NAMESPACE, TEACHER_NAMESPACE, CLASSROOM_NAMESPACE, ANY_DATE_TAG,
+    clear_cache, group_tag, date_tag, invalidate_cache_tags
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _sheet_cells(sheets):
+    """{дата: {группа: {номер пары: текст}}} по всем файлам замен"""
+    cells = {}
+    for sheet in sheets.values():
+        for date_str, groups in sheet.cells.items():
+            date_cells = cells.setdefault(date_str, {})
+            for group, lessons in groups.items():
+                date_cells.setdefault(group, {}).update(lessons)
+    return cells
+
+
+def changed_replacement_cells(old_sheets, new_sheets):
+    """
+    Пары (дата, группа), замены которых различаются в двух наборах файлов замен.
+
+    Returns:
+        tuple: (множество пар (дата, группа), изменился ли набор дат)
+    """
+    unchanged = all(
+        path in new_sheets and new_sheets[path].digest == sheet.digest
+        for path, sheet in old_sheets.items()
+    ) and set(old_sheets) == set(new_sheets)
+    if unchanged:
+        return set(), False
+
+    old_cells = _sheet_cells(old_sheets)
+    new_cells = _sheet_cells(new_sheets)
+
+    changed = set()
+    for date_str in set(old_cells) | set(new_cells):
+        old_groups = old_cells.get(date_str, {})
+        new_groups = new_cells.get(date_str, {})
+        for group in set(old_groups) | set(new_groups):
+            if old_groups.get(group) != new_groups.get(group):
+                changed.add((date_str, group))
+
+    return changed, set(old_cells) != set(new_cells)
+
+
+def replacement_changes(old_sheets, new_sheets):
+    """
+    Сравнивает файлы замен до и после обновления.
+
+    Returns:
+        tuple: (даты, на которые изменились замены, группы с изменившимися заменами,
+                изменился ли набор дат)
+    """
+    changed, dates_changed = changed_replacement_cells(old_sheets, new_sheets)
+    return {date_str for date_str, _ in changed}, {group for _, group in changed}, dates_changed
+
+
+def schedule_changes(old_store, new_store):
+    """Группы, файлы расписания которых добавились, изменились или удалились"""
+    old_entries = old_store.entries if old_store else {}
+    new_entries = new_store.entries if new_store else {}
+    groups = set()
+    for file_name in set(old_entries) | set(new_entries):
+        old_entry = old_entries.get(file_name)
+        new_entry = new_entries.get(file_name)
+        if old_entry and new_entry and old_entry.digest == new_entry.digest:
+            continue
+        for entry in (old_entry, new_entry):
+            if entry:
+                groups.add(entry.group)
+                groups.add(file_name.rsplit('.', 1)[0])
+    return groups
+
+
+def invalidate_changed_sources(old_store, old_sheets, new_store, new_sheets):
+    """
+    Удаляет из кэша ответы, зависящие от изменившихся файлов.
+
+    Returns:
+        int: Количество удаленных записей (без учета очищенных целиком пространств имен)
+    """
+    changed_dates, changed_groups, dates_changed = replacement_changes(old_sheets, new_sheets)
+    schedule_groups = schedule_changes(old_store, new_store)
+
+    namespaces = []
+    if dates_changed:
+        namespaces.append(STUDENT_NAMESPACE)
+    if schedule_groups:
+        namespaces.extend([TEACHER_NAMESPACE, CLASSROOM_NAMESPACE])
+    if namespaces:
+        clear_cache(namespaces)
+
+    tags = {group_tag(group) for group in changed_groups | schedule_groups}
+    if changed_dates:
+        tags.update(date_tag(date_str) for date_str in changed_dates)
+        tags.add(ANY_DATE_TAG)
+    removed = invalidate_cache_tags(tags)
+
+    logger.info(f"Инвалидация кэша: изменились замены на {len(changed_dates)} дат для {len(changed_groups)} групп, "
+                f"расписания {len(schedule_groups)} групп; очищено целиком: {namespaces or 'ничего'}, "
+                f"удалено записей: {removed}")
+    return removed
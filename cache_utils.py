@@ -1,53 +1,405 @@
 import json
 import os
+import queue
+import atexit
+import sqlite3
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import threading
 import glob
 import time
 import fnmatch
-from typing import Optional, Dict, Any
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Tuple, Iterable, List
+
+from metrics import timed
 
 logger = logging.getLogger(__name__)
 
 CACHE_DIR = "cache"
-STUDENT_CACHE_FILE = os.path.join(CACHE_DIR, "student_schedule_cache.json")
-TEACHER_CACHE_FILE = os.path.join(CACHE_DIR, "teacher_schedule_cache.json")
-CLASSROOM_CACHE_FILE = os.path.join(CACHE_DIR, "classroom_schedule_cache.json")  # Added new cache file
+CACHE_DB_FILE = os.path.join(CACHE_DIR, "schedule_cache.sqlite3")
 cache_lock = threading.Lock()
 
+# Пространства имен кэша
+STUDENT_NAMESPACE = "student"
+TEACHER_NAMESPACE = "teacher"
+CLASSROOM_NAMESPACE = "classroom"
+DATA_NAMESPACE = "data"
+
+# Время жизни записей по умолчанию (30 минут)
+DEFAULT_EXPIRATION = 1800
+# Как часто (в секундах) удалять просроченные записи при записи в кэш
+PURGE_INTERVAL = 600
+# Сколько записей держать в памяти перед SQLite
+MEMORY_CACHE_MAX_ENTRIES = 512
+
+# Теги зависимостей: от каких групп и дат получен закэшированный ответ
+ANY_DATE_TAG = "date:*"
+# Диапазон дат длиннее этого помечается ANY_DATE_TAG вместо отдельных дат
+MAX_TAGGED_DAYS = 62
+
 # Флаг для отслеживания, была ли уже выполнена очистка кэша при запуске
 cache_cleared_on_startup = False
 
+
+class CacheBackend(ABC):
+    """
+    Хранилище кэша: значения по ключу внутри пространства имен, с временем жизни.
+
+    Значения должны сериализоваться в JSON.
+    """
+
+    @abstractmethod
+    def get_entry(self, namespace: str, key: str) -> Optional[Tuple[Any, float]]:
+        """(значение, время истечения) или None, если записи нет или она устарела"""
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        """Значение по ключу или None, если его нет или оно устарело"""
+        entry = self.get_entry(namespace, key)
+        return entry[0] if entry else None
+
+    @abstractmethod
+    def put(self, namespace: str, key: str, value: Any, expiration: int = DEFAULT_EXPIRATION,
+            tags: Iterable[str] = ()):
+        """Записывает значение; tags - источники данных, при изменении которых запись устаревает"""
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> bool:
+        """Удаляет запись, возвращает True, если она была"""
+
+    @abstractmethod
+    def clear(self, namespace: Optional[str] = None):
+        """Удаляет все записи пространства имен (или все записи вообще)"""
+
+    @abstractmethod
+    def purge_expired(self) -> int:
+        """Удаляет просроченные записи, возвращает их количество"""
+
+    @abstractmethod
+    def invalidate_tags(self, tags: Iterable[str]) -> List[Tuple[str, str]]:
+        """Удаляет записи, помеченные любым из тегов, возвращает их ключи"""
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Кэш в SQLite в режиме WAL.
+
+    Каждый поток работает через свое соединение: чтения не блокируют друг друга
+    и запись, а запись меняет одну строку вместо перезаписи всего файла.
+    """
+
+    def __init__(self, db_file: str = CACHE_DB_FILE):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._last_purge = 0.0
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_tags ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " tag TEXT NOT NULL,"
+            " PRIMARY KEY (namespace, key, tag))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_tags_tag ON cache_tags (tag)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None - каждая команда выполняется в своей транзакции
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get_entry(self, namespace, key):
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, time.time())
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def put(self, namespace, key, value, expiration=DEFAULT_EXPIRATION, tags=()):
+        self.put_until(namespace, key, value, time.time() + expiration, tags)
+
+    def put_until(self, namespace, key, value, expires_at, tags=()):
+        """Записывает значение с абсолютным временем истечения"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False), now, expires_at)
+            )
+            conn.execute("DELETE FROM cache_tags WHERE namespace = ? AND key = ?", (namespace, key))
+            conn.executemany(
+                "INSERT OR IGNORE INTO cache_tags (namespace, key, tag) VALUES (?, ?, ?)",
+                [(namespace, key, tag) for tag in tags]
+            )
+        if now - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = now
+            self.purge_expired()
+
+    def delete(self, namespace, key):
+        with self._transaction() as conn:
+            cursor = conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+            conn.execute("DELETE FROM cache_tags WHERE namespace = ? AND key = ?", (namespace, key))
+        return cursor.rowcount > 0
+
+    def clear(self, namespace=None):
+        with self._transaction() as conn:
+            if namespace is None:
+                conn.execute("DELETE FROM cache")
+                conn.execute("DELETE FROM cache_tags")
+            else:
+                conn.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+                conn.execute("DELETE FROM cache_tags WHERE namespace = ?", (namespace,))
+
+    def purge_expired(self):
+        with self._transaction() as conn:
+            cursor = conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM cache_tags WHERE NOT EXISTS ("
+                " SELECT 1 FROM cache WHERE cache.namespace = cache_tags.namespace AND cache.key = cache_tags.key)"
+            )
+        return cursor.rowcount
+
+    def invalidate_tags(self, tags):
+        tags = list(tags)
+        if not tags:
+            return []
+        placeholders = ", ".join("?" for _ in tags)
+        with self._transaction() as conn:
+            keys = conn.execute(
+                f"SELECT DISTINCT namespace, key FROM cache_tags WHERE tag IN ({placeholders})", tags
+            ).fetchall()
+            conn.executemany("DELETE FROM cache WHERE namespace = ? AND key = ?", keys)
+            conn.executemany("DELETE FROM cache_tags WHERE namespace = ? AND key = ?", keys)
+        return [tuple(key) for key in keys]
+
+
+class MemoryCacheTier(CacheBackend):
+    """
+    Ограниченный кэш в памяти (LRU с временем жизни записей) перед хранилищем на диске.
+
+    Попадания обслуживаются из памяти без обращения к диску. Записи сразу
+    попадают в память, а на диск пишутся фоновым потоком в порядке поступления.
+    """
+
+    def __init__(self, disk: SQLiteCacheBackend, max_entries: int = MEMORY_CACHE_MAX_ENTRIES):
+        self.disk = disk
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes: "queue.Queue" = queue.Queue()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'write_errors': 0}
+        self._writer = threading.Thread(target=self._write_loop, name="cache-writer", daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            operation, args = self._writes.get()
+            try:
+                getattr(self.disk, operation)(*args)
+            except Exception as e:
+                with self._lock:
+                    self.stats['write_errors'] += 1
+                logger.error(f"Ошибка при записи кэша на диск ({operation}): {e}")
+            finally:
+                self._writes.task_done()
+
+    def flush(self):
+        """Ждет, пока все отложенные записи попадут на диск"""
+        self._writes.join()
+
+    def _remember(self, cache_key, value, expires_at):
+        # Вызывается под self._lock
+        self._entries[cache_key] = (value, expires_at)
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def get_entry(self, namespace, key):
+        cache_key = (namespace, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self._entries.move_to_end(cache_key)
+                    self.stats['hits'] += 1
+                    return entry
+                del self._entries[cache_key]
+                self.stats['expired'] += 1
+
+        entry = self.disk.get_entry(namespace, key)
+        with self._lock:
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self._remember(cache_key, entry[0], entry[1])
+        return entry
+
+    def put(self, namespace, key, value, expiration=DEFAULT_EXPIRATION, tags=()):
+        expires_at = time.time() + expiration
+        with self._lock:
+            self._remember((namespace, key), value, expires_at)
+        self._writes.put(('put_until', (namespace, key, value, expires_at, tuple(tags))))
+
+    def delete(self, namespace, key):
+        with self._lock:
+            in_memory = self._entries.pop((namespace, key), None) is not None
+        self.flush()
+        return self.disk.delete(namespace, key) or in_memory
+
+    def clear(self, namespace=None):
+        with self._lock:
+            if namespace is None:
+                self._entries.clear()
+            else:
+                for cache_key in [k for k in self._entries if k[0] == namespace]:
+                    del self._entries[cache_key]
+        # Отложенные записи должны попасть на диск до очистки, иначе они переживут ее
+        self.flush()
+        self.disk.clear(namespace)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            for cache_key in [k for k, entry in self._entries.items() if entry[1] <= now]:
+                del self._entries[cache_key]
+        self.flush()
+        return self.disk.purge_expired()
+
+    def invalidate_tags(self, tags):
+        # Теги хранятся на диске, поэтому сначала дожидаемся отложенных записей
+        self.flush()
+        keys = self.disk.invalidate_tags(tags)
+        with self._lock:
+            for cache_key in keys:
+                self._entries.pop(cache_key, None)
+        return keys
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+        stats['pending_writes'] = self._writes.qsize()
+        return stats
+
+
+_backend: Optional[CacheBackend] = None
+
+
+def get_cache_backend() -> CacheBackend:
+    """Возвращает хранилище кэша, при первом обращении открывает SQLite с кэшем в памяти перед ним"""
+    global _backend
+    if _backend is None:
+        with cache_lock:
+            if _backend is None:
+                _backend = MemoryCacheTier(SQLiteCacheBackend())
+                atexit.register(_flush_backend)
+    return _backend
+
+
+def _flush_backend():
+    flush = getattr(_backend, 'flush', None)
+    if flush:
+        flush()
+
+
+def get_cache_stats() -> Dict[str, int]:
+    """Счетчики кэша в памяти: попадания, промахи, вытеснения и т.д."""
+    get_stats = getattr(get_cache_backend(), 'get_stats', None)
+    return get_stats() if get_stats else {}
+
+
+def set_cache_backend(backend: CacheBackend):
+    """Подменяет хранилище кэша (например, на другую реализацию CacheBackend)"""
+    global _backend
+    with cache_lock:
+        _backend = backend
+
+
 def init_cache():
     """Инициализация кэша при запуске"""
     try:
         if not os.path.exists(CACHE_DIR):
             os.makedirs(CACHE_DIR)
 
-        # Создаем пустые файлы кэша, если они не существуют
-        for cache_file in [STUDENT_CACHE_FILE, TEACHER_CACHE_FILE, CLASSROOM_CACHE_FILE]:  # Added CLASSROOM_CACHE_FILE
-            if not os.path.exists(cache_file):
-                with open(cache_file, 'w', encoding='utf-8') as f:
-                    json.dump({}, f)
+        get_cache_backend().purge_expired()
 
         logger.info("Кэш успешно инициализирован")
     except Exception as e:
         logger.error(f"Ошибка при инициализации кэша: {e}")
 
 
-def clear_cache():
-    """Очистка кэша"""
+def clear_cache(namespaces=None):
+    """Очистка кэша (по умолчанию - расписаний студентов, преподавателей и кабинетов)"""
     try:
-        with cache_lock:
-            for cache_file in [STUDENT_CACHE_FILE, TEACHER_CACHE_FILE, CLASSROOM_CACHE_FILE]:  # Added CLASSROOM_CACHE_FILE
-                with open(cache_file, 'w', encoding='utf-8') as f:
-                    json.dump({}, f)
+        for namespace in namespaces or [STUDENT_NAMESPACE, TEACHER_NAMESPACE, CLASSROOM_NAMESPACE]:
+            get_cache_backend().clear(namespace)
         logger.info("Кэш успешно очищен")
     except Exception as e:
         logger.error(f"Ошибка при очистки кэша: {e}")
 
 
+def group_tag(group: str) -> str:
+    """Тег зависимости от расписания и замен группы"""
+    return f"group:{str(group).strip().upper()}"
+
+
+def date_tag(date_str: str) -> str:
+    """Тег зависимости от замен на дату (dd.mm.YYYY)"""
+    return f"date:{date_str}"
+
+
+def date_range_tags(start_date: str, end_date: str) -> List[str]:
+    """Теги всех дат диапазона; для нераспознанного или слишком длинного диапазона - ANY_DATE_TAG"""
+    try:
+        start = datetime.strptime(start_date, '%d.%m.%Y').date()
+        end = datetime.strptime(end_date, '%d.%m.%Y').date()
+    except (TypeError, ValueError):
+        return [ANY_DATE_TAG]
+    if end < start or (end - start).days > MAX_TAGGED_DAYS:
+        return [ANY_DATE_TAG]
+    return [date_tag((start + timedelta(days=offset)).strftime('%d.%m.%Y'))
+            for offset in range((end - start).days + 1)]
+
+
+def invalidate_cache_tags(tags: Iterable[str]) -> int:
+    """Удаляет записи кэша, зависящие от любого из тегов, возвращает их количество"""
+    try:
+        keys = get_cache_backend().invalidate_tags(tags)
+        return len(keys)
+    except Exception as e:
+        logger.error(f"Ошибка при инвалидации кэша по тегам: {e}")
+        return 0
+
+
 def selective_cache_clear(pattern: str = "*", reason: str = "manual"):
     """
     Очистка кэша только при определенных условиях:
@@ -114,61 +466,40 @@ def selective_cache_clear(pattern: str = "*", reason: str = "manual"):
         logger.warning(f"Неизвестная причина очистки кэша: {reason}, пропускаем очистку")
 
 
-def cache_student_schedule(group: str, subgroup: int, schedule_data: str):
-    """Кэширование расписания студентов"""
+def student_cache_key(group: str, subgroup: int) -> str:
+    """Ключ расписания студентов без учета регистра и пробелов вокруг названия группы"""
+    return f"{str(group).strip().upper()}_{subgroup}"
+
+
+def cache_student_schedule(group: str, subgroup: int, schedule_data: str, expiration=DEFAULT_EXPIRATION,
+                           group_file: str = None):
+    """
+    Кэширование расписания студентов.
+
+    group_file - файл расписания, найденный по введенному названию (например,
+    "испп-23" -> ИСпП-23-1.xlsx): ответ зависит от этой группы, и при изменении
+    ее замен или расписания он должен удаляться вместе с остальными.
+    """
     try:
-        with cache_lock:
-            cache = {}
-            if os.path.exists(STUDENT_CACHE_FILE):
-                with open(STUDENT_CACHE_FILE, 'r', encoding='utf-8') as f:
-                    try:
-                        cache = json.load(f)
-                    except json.JSONDecodeError:
-                        logger.error("Ошибка при чтении кэша")
-                        cache = {}
-
-            cache_key = f"{group}_{subgroup}"
-            cache[cache_key] = {
-                'data': schedule_data,
-                'timestamp': datetime.now().isoformat()
-            }
-
-            with open(STUDENT_CACHE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(cache, f, ensure_ascii=False, indent=2)
-            logger.info(f"Кэш успешно сохранен для группы {group}, ключ: {cache_key}")
+        cache_key = student_cache_key(group, subgroup)
+        tags = [group_tag(group)]
+        if group_file:
+            tags.append(group_tag(os.path.splitext(group_file)[0]))
+        get_cache_backend().put(STUDENT_NAMESPACE, cache_key, schedule_data, expiration, tags=tags)
+        logger.info(f"Кэш успешно сохранен для группы {group}, ключ: {cache_key}")
     except Exception as e:
         logger.error(f"Ошибка при кэшировании расписания студентов: {e}")
 
 
+@timed("cache_lookup")
 def get_cached_student_schedule(group: str, subgroup: int) -> str:
     """Получение кэшированного расписания студентов"""
     try:
-        if not os.path.exists(STUDENT_CACHE_FILE):
-            logger.info(f"Файл кэша не существует: {STUDENT_CACHE_FILE}")
-            return None
-
-        with cache_lock:
-            with open(STUDENT_CACHE_FILE, 'r', encoding='utf-8') as f:
-                try:
-                    cache = json.load(f)
-                    logger.info(f"Загружен кэш: {cache}")
-                except json.JSONDecodeError:
-                    logger.error("Ошибка декодирования JSON в кэше")
-                    return None
-
-            cache_key = f"{group}_{subgroup}"
-            logger.info(f"Поиск в кэше по ключу: {cache_key}")
-            if cache_key in cache:
-                cached_data = cache[cache_key]
-                cached_time = datetime.fromisoformat(cached_data['timestamp'])
-
-                # Проверяем актуальность кэша (30 минут)
-                if (datetime.now() - cached_time).total_seconds() < 1800:
-                    logger.info(f"Найден актуальный кэш для группы {group}")
-                    return cached_data['data']
-                else:
-                    logger.info(f"Кэш устарел для группы {group}")
-        return None
+        cache_key = student_cache_key(group, subgroup)
+        schedule_data = get_cache_backend().get(STUDENT_NAMESPACE, cache_key)
+        if schedule_data is not None:
+            logger.info(f"Найден актуальный кэш для группы {group}")
+        return schedule_data
     except Exception as e:
         logger.error(f"Ошибка при получении кэшированного расписания студентов: {e}")
         return None
@@ -177,64 +508,28 @@ def get_cached_student_schedule(group: str, subgroup: int) -> str:
 def cache_teacher_schedule(teacher_name: str, start_date: str, end_date: str, schedule_data: str, expiration=1800):
     """Кэширование расписания преподавателя"""
     try:
-        with cache_lock:
-            cache = {}
-            if os.path.exists(TEACHER_CACHE_FILE):
-                with open(TEACHER_CACHE_FILE, 'r', encoding='utf-8') as f:
-                    try:
-                        cache = json.load(f)
-                    except json.JSONDecodeError:
-                        logger.error("Ошибка при чтении кэша преподавателей")
-                        cache = {}
-
-            cache_key = f"{teacher_name}_{start_date}_{end_date}"
-            cache[cache_key] = {
-                'data': schedule_data,
-                'timestamp': datetime.now().isoformat(),
-                'expiration': expiration  # Store expiration time in seconds
-            }
-
-            with open(TEACHER_CACHE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(cache, f, ensure_ascii=False, indent=2)
-            logger.info(f"Кэш успешно сохранен для преподавателя {teacher_name} с периодом действия {expiration} секунд")
+        cache_key = f"{teacher_name}_{start_date}_{end_date}"
+        get_cache_backend().put(TEACHER_NAMESPACE, cache_key, schedule_data, expiration,
+                                tags=date_range_tags(start_date, end_date))
+        logger.info(f"Кэш успешно сохранен для преподавателя {teacher_name} с периодом действия {expiration} секунд")
     except Exception as e:
         logger.error(f"Ошибка при кэшировании расписания преподавателя: {e}")
 
 
+@timed("cache_lookup")
 def get_cached_teacher_schedule(teacher_name: str, start_date: str, end_date: str) -> str:
     """Получение кэшированного расписания преподавателя"""
     try:
-        if not os.path.exists(TEACHER_CACHE_FILE):
-            logger.info(f"Файл кэша преподавателей не существует: {TEACHER_CACHE_FILE}")
-            return None
-
-        with cache_lock:
-            with open(TEACHER_CACHE_FILE, 'r', encoding='utf-8') as f:
-                try:
-                    cache = json.load(f)
-                except json.JSONDecodeError:
-                    logger.error("Ошибка декодирования JSON в кэше преподавателей")
-                    return None
-
-            cache_key = f"{teacher_name}_{start_date}_{end_date}"
-            if cache_key in cache:
-                cached_data = cache[cache_key]
-                cached_time = datetime.fromisoformat(cached_data['timestamp'])
-                
-                # Get expiration time (default to 30 minutes if not specified)
-                expiration = cached_data.get('expiration', 1800)
-
-                # Проверяем актуальность кэша с учетом периода действия
-                if (datetime.now() - cached_time).total_seconds() < expiration:
-                    logger.info(f"Найден актуальный кэш для преподавателя {teacher_name} (осталось {expiration - (datetime.now() - cached_time).total_seconds():.0f} секунд)")
-                    return cached_data['data']
-                else:
-                    logger.info(f"Кэш устарел для преподавателя {teacher_name}")
-            return None
+        cache_key = f"{teacher_name}_{start_date}_{end_date}"
+        schedule_data = get_cache_backend().get(TEACHER_NAMESPACE, cache_key)
+        if schedule_data is not None:
+            logger.info(f"Найден актуальный кэш для преподавателя {teacher_name}")
+        return schedule_data
     except Exception as e:
         logger.error(f"Ошибка при получении кэшированного расписания преподавателя: {e}")
         return None
 
+@timed("cache_lookup")
 def get_cached_classroom_schedule(classroom, date_str):
     """
     Получает кэшированное расписание кабинета
@@ -248,25 +543,10 @@ def get_cached_classroom_schedule(classroom, date_str):
     """
     try:
         cache_key = f"{classroom}:{date_str}"
-        
-        if not os.path.exists(CLASSROOM_CACHE_FILE):
-            return None
-            
-        with cache_lock:
-            with open(CLASSROOM_CACHE_FILE, 'r', encoding='utf-8') as f:
-                cache = json.load(f)
-                
-            if cache_key in cache:
-                cached_data = cache[cache_key]
-                # Проверяем, не устарел ли кэш (30 минут)
-                cache_time = datetime.fromisoformat(cached_data['timestamp'])
-                if (datetime.now() - cache_time).total_seconds() < 1800:
-                    logger.info(f"Использую кэшированное расписание для кабинета {classroom} на {date_str}")
-                    return cached_data['schedule']
-                else:
-                    logger.info(f"Кэш для кабинета {classroom} на {date_str} устарел")
-        
-        return None
+        schedule = get_cache_backend().get(CLASSROOM_NAMESPACE, cache_key)
+        if schedule is not None:
+            logger.info(f"Использую кэшированное расписание для кабинета {classroom} на {date_str}")
+        return schedule
     except Exception as e:
         logger.error(f"Ошибка при получении кэша расписания кабинета: {e}")
         return None
@@ -283,29 +563,8 @@ def cache_classroom_schedule(classroom, date_str, schedule):
     """
     try:
         cache_key = f"{classroom}:{date_str}"
-        
-        # Make sure cache directory exists
-        if not os.path.exists(CACHE_DIR):
-            os.makedirs(CACHE_DIR)
-        
-        with cache_lock:
-            # Загружаем текущий кэш
-            if os.path.exists(CLASSROOM_CACHE_FILE):
-                with open(CLASSROOM_CACHE_FILE, 'r', encoding='utf-8') as f:
-                    cache = json.load(f)
-            else:
-                cache = {}
-            
-            # Добавляем или обновляем запись в кэше
-            cache[cache_key] = {
-                'schedule': schedule,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            # Сохраняем обновленный кэш
-            with open(CLASSROOM_CACHE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(cache, f, ensure_ascii=False, indent=2)
-                
+        get_cache_backend().put(CLASSROOM_NAMESPACE, cache_key, schedule, DEFAULT_EXPIRATION,
+                                tags=[date_tag(date_str)])
         logger.info(f"Расписание для кабинета {classroom} на {date_str} успешно кэшировано")
     except Exception as e:
         logger.error(f"Ошибка при кэшировании расписания кабинета: {e}")
@@ -320,17 +579,7 @@ def cache_data(key: str, data: Any, expiration: int = 1800):
         expiration: Expiration time in seconds (default 30 minutes)
     """
     try:
-        init_cache()  # Ensure cache directory exists
-        
-        cache_file = os.path.join(CACHE_DIR, key)
-        cache_entry = {
-            "data": data,
-            "expires_at": time.time() + expiration
-        }
-        
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(cache_entry, f, ensure_ascii=False)
-        
+        get_cache_backend().put(DATA_NAMESPACE, key, data, expiration)
         logger.debug(f"Cached data with key '{key}', expires in {expiration} seconds")
     except Exception as e:
         logger.error(f"Error caching data for key '{key}': {e}")
@@ -346,26 +595,10 @@ def get_cached_data(key: str) -> Optional[Any]:
         Cached data or None if not found or expired
     """
     try:
-        cache_file = os.path.join(CACHE_DIR, key)
-        
-        if not os.path.exists(cache_file):
-            return None
-        
-        with open(cache_file, 'r', encoding='utf-8') as f:
-            cache_entry = json.load(f)
-        
-        # Check if expired
-        if time.time() > cache_entry.get("expires_at", 0):
-            # Remove expired cache file
-            try:
-                os.remove(cache_file)
-                logger.debug(f"Removed expired cache file for key '{key}'")
-            except Exception as e:
-                logger.error(f"Error removing expired cache file for key '{key}': {e}")
-            return None
-        
-        logger.debug(f"Retrieved cached data for key '{key}'")
-        return cache_entry.get("data")
+        data = get_cache_backend().get(DATA_NAMESPACE, key)
+        if data is not None:
+            logger.debug(f"Retrieved cached data for key '{key}'")
+        return data
     except Exception as e:
         logger.error(f"Error retrieving cached data for key '{key}': {e}")
         return None
@@ -393,14 +626,10 @@ def delete_cache_item(key: str) -> bool:
         True if item was deleted, False otherwise
     """
     try:
-        cache_file = os.path.join(CACHE_DIR, key)
-        
-        if not os.path.exists(cache_file):
-            return False
-        
-        os.remove(cache_file)
-        logger.debug(f"Deleted cache item with key '{key}'")
-        return True
+        deleted = get_cache_backend().delete(DATA_NAMESPACE, key)
+        if deleted:
+            logger.debug(f"Deleted cache item with key '{key}'")
+        return deleted
     except Exception as e:
         logger.error(f"Error deleting cache item with key '{key}': {e}")
-        return False
\ No newline at end of file
+        return False
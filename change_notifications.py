@@ -0,0 +1,160 @@
+"""
+Персональные уведомления об изменениях в расписании.
+
+После публикации нового поколения расписания оно сравнивается с предыдущим.
+Подписчик, указавший группу (и подгруппу) или преподавателя, получает только
+касающиеся его изменения вместе с уже сформированным расписанием на эти даты,
+поэтому ему не нужно сразу после уведомления запрашивать расписание у бота.
+Подписчики без настроек получают общее уведомление, как раньше.
+"""
+import os
+import logging
+from datetime import datetime
+
+from cache_dependencies import changed_replacement_cells, schedule_changes
+from schedule_store import build_day_schedule, apply_group_replacements
+from replacements_store import get_group_replacements
+from teacher_schedule_processor import collect_replacement_cells, build_teacher_day_schedule
+
+logger = logging.getLogger(__name__)
+
+# Ограничение Telegram на длину сообщения - 4096 символов
+MAX_MESSAGE_LENGTH = 4000
+
+CHANGES_HEADER = "🔔 Изменения в расписании"
+SCHEDULE_UPDATED_TEXT = "Обновлено основное расписание"
+
+
+def _parse_date(date_str):
+    return datetime.strptime(date_str, '%d.%m.%Y').date()
+
+
+def upcoming_dates(changed_cells, today=None):
+    """Даты изменившихся замен, начиная с сегодняшней, по порядку"""
+    today = today or datetime.now().date()
+    dates = set()
+    for date_str, _ in changed_cells:
+        try:
+            if _parse_date(date_str) >= today:
+                dates.add(date_str)
+        except ValueError:
+            continue
+    return sorted(dates, key=_parse_date)
+
+
+def group_day_schedule(generation, file_name, group_name, date_str, subgroup=None):
+    """Расписание группы на дату с заменами из указанного поколения"""
+    schedule = build_day_schedule(file_name, date_str, subgroup, generation.store)
+    group_replacements = get_group_replacements(date_str, group_name, generation)
+    return apply_group_replacements(schedule, group_replacements, group_name, subgroup)
+
+
+def _compose(parts):
+    message = CHANGES_HEADER + "\n\n" + "\n\n".join(parts)
+    if len(message) > MAX_MESSAGE_LENGTH:
+        message = message[:MAX_MESSAGE_LENGTH - 1] + "…"
+    return message
+
+
+class ChangeRenderer:
+    """Сравнивает два поколения и формирует сообщения об изменениях для подписчиков"""
+
+    def __init__(self, old_generation, new_generation, today=None):
+        self.old = old_generation
+        self.new = new_generation
+        changed_cells, _ = changed_replacement_cells(
+            dict(old_generation.replacement_sheets), dict(new_generation.replacement_sheets)
+        )
+        self.dates = upcoming_dates(changed_cells, today)
+        self.schedule_groups = schedule_changes(old_generation.store, new_generation.store)
+        self._old_cells = None
+        self._new_cells = None
+        # Одинаковые настройки у многих подписчиков - сообщение формируется один раз
+        self._rendered = {}
+
+    def group_message(self, group, subgroup=None):
+        """Изменения для группы (и подгруппы) или None, если их нет"""
+        key = ('group', group.upper(), subgroup)
+        if key not in self._rendered:
+            self._rendered[key] = self._render_group(group, subgroup)
+        return self._rendered[key]
+
+    def teacher_message(self, teacher):
+        """Изменения для преподавателя или None, если их нет"""
+        key = ('teacher', teacher.lower())
+        if key not in self._rendered:
+            self._rendered[key] = self._render_teacher(teacher)
+        return self._rendered[key]
+
+    def _render_group(self, group, subgroup):
+        from было import format_schedule
+
+        file_name = self.new.store.find_group_file(group)
+        if not file_name:
+            return None
+        group_name = self.new.store.get_group_name(file_name)
+
+        parts = []
+        if group_name in self.schedule_groups or os.path.splitext(file_name)[0] in self.schedule_groups:
+            parts.append(f"{SCHEDULE_UPDATED_TEXT} группы {group_name}")
+
+        for date_str in self.dates:
+            old_schedule = group_day_schedule(self.old, file_name, group_name, date_str, subgroup)
+            new_schedule = group_day_schedule(self.new, file_name, group_name, date_str, subgroup)
+            if old_schedule != new_schedule:
+                parts.append(format_schedule(new_schedule, group_name, date_str, subgroup))
+
+        return _compose(parts) if parts else None
+
+    def _render_teacher(self, teacher):
+        from было import format_teacher_schedule
+
+        if self._old_cells is None:
+            self._old_cells = collect_replacement_cells(self.old.replacement_sheets.values())
+            self._new_cells = collect_replacement_cells(self.new.replacement_sheets.values())
+
+        parts = []
+        if set(self.new.store.teacher_groups(teacher)) & self.schedule_groups:
+            parts.append(f"{SCHEDULE_UPDATED_TEXT} преподавателя {teacher}")
+
+        for date_str in self.dates:
+            old_day = build_teacher_day_schedule(self.old.store, teacher, date_str, self._old_cells.get(date_str, {}))
+            new_day = build_teacher_day_schedule(self.new.store, teacher, date_str, self._new_cells.get(date_str, {}))
+            if old_day != new_day:
+                parts.append(format_teacher_schedule({date_str: new_day}, teacher, date_str, date_str))
+
+        return _compose(parts) if parts else None
+
+
+def build_personal_messages(subscribers, old_generation, new_generation, today=None):
+    """
+    Делит подписчиков на получающих персональные сообщения и общее уведомление.
+
+    Args:
+        subscribers: {chat_id: данные подписчика} из subscribers.json
+        old_generation: Поколение расписания до синхронизации
+        new_generation: Опубликованное поколение
+
+    Returns:
+        tuple: ({chat_id: текст} для подписчиков с настройками, которых коснулись изменения,
+                [chat_id подписчиков без настроек])
+    """
+    renderer = ChangeRenderer(old_generation, new_generation, today)
+    messages = {}
+    generic = []
+    for chat_id, subscriber in subscribers.items():
+        group = subscriber.get('group') if isinstance(subscriber, dict) else None
+        teacher = subscriber.get('teacher') if isinstance(subscriber, dict) else None
+        if group:
+            message = renderer.group_message(group, subscriber.get('subgroup'))
+        elif teacher:
+            message = renderer.teacher_message(teacher)
+        else:
+            generic.append(chat_id)
+            continue
+        if message:
+            messages[chat_id] = message
+
+    logger.info(f"Персональные уведомления: {len(messages)} подписчиков с изменениями, "
+                f"{len(generic)} без настроек, изменились замены на {len(renderer.dates)} дат")
+    return messages, generic
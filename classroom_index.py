@@ -0,0 +1,409 @@
+"""
+Индекс занятости кабинетов.
+
+Пары основного расписания берутся из хранилища разобранных файлов групп
+(ключ - кабинет, тип недели, день и номер пары), замены берутся из
+скомпилированных файлов замен. Расписание кабинета на дату и список свободных
+кабинетов на пару собираются поиском по словарям, без открытия Excel.
+"""
+import re
+import logging
+import threading
+from datetime import datetime
+from typing import NamedTuple, Optional, Dict, List, Tuple, Any
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+from dropbox_sync import is_update_in_progress, get_update_status_message
+from schedule_store import get_date_parity_and_weekday, normalize_room
+from schedule_generations import get_generation
+from replacements_store import find_replacement_sheet, room_tokens
+from single_flight import coalesced
+from metrics import timed, track_query
+from task_scheduler import run_task
+
+logger = logging.getLogger(__name__)
+
+TEACHER_LINE_PATTERN = re.compile(r'^[А-Яа-я]+\s+[А-Я]\.[А-Я]\.$')
+TEACHER_PATTERNS = (
+    re.compile(r'([А-Яа-я]+)\s+([А-Я])\.\s*([А-Я])\.'),        # Фамилия И.О.
+    re.compile(r'([А-Яа-я]+)\s+([А-Я])[а-я]+\s+([А-Я])[а-я]+'),  # Фамилия Имя Отчество
+)
+SUBJECT_PATTERNS = (
+    ('УП', re.compile(r'УП\.\d+\.\d+(?:\.\d+)?(?:\s+[^{}]+)?')),
+    ('МДК', re.compile(r'МДК\.\d+\.\d+(?:\.\d+)?(?:[\s\S]+?)?')),
+    ('ПМ', re.compile(r'ПМ\.\d+(?:\s+[^{}]+)?')),
+)
+
+
+class ClassroomLesson(NamedTuple):
+    """Пара в кабинете"""
+    lesson_num: Any
+    group: str
+    subgroup: Optional[int]
+    subject: Any
+    teacher: Any
+    is_replacement: bool
+
+
+class ReplacementRooms(NamedTuple):
+    """Кабинеты из замен на одну дату"""
+    # кабинет -> пары из замен в этом кабинете
+    by_room: Dict[str, List[ClassroomLesson]]
+    # (группа, номер пары) -> кабинеты, упомянутые в замене
+    cell_rooms: Dict[Tuple[str, Any], frozenset]
+
+
+EMPTY_REPLACEMENT_ROOMS = ReplacementRooms({}, {})
+
+# Кабинеты из замен: путь -> (скомпилированный файл, {дата: ReplacementRooms})
+_replacement_rooms_cache: Dict[str, Tuple[Any, Dict[str, ReplacementRooms]]] = {}
+_replacement_rooms_lock = threading.Lock()
+
+
+def _lesson_key(lesson_num):
+    """Номер пары для сравнения основного расписания с заменами"""
+    try:
+        return int(lesson_num)
+    except (TypeError, ValueError):
+        return lesson_num
+
+
+def _marker_subgroup(text):
+    if '1. ' in text or '1 п/г' in text or '1 подгр' in text:
+        return 1
+    if '2. ' in text or '2 п/г' in text or '2 подгр' in text:
+        return 2
+    return None
+
+
+def describe_replacement(text, room_text):
+    """
+    Разбирает текст замены для расписания кабинета.
+
+    Args:
+        text: Текст ячейки замены
+        room_text: Кабинет в том виде, в котором он записан в замене
+
+    Returns:
+        tuple: (подгруппа, предмет, преподаватель)
+    """
+    replacement_text = text.strip()
+
+    # Преподаватель обычно записан последней строкой
+    teacher = None
+    teacher_match = None
+    lines = replacement_text.split('\n')
+    if len(lines) > 1 and TEACHER_LINE_PATTERN.match(lines[-1].strip()):
+        teacher = lines[-1].strip()
+        replacement_text = '\n'.join(lines[:-1]).strip()
+
+    if teacher is None:
+        teacher = "Неизвестно"
+        teacher_match = TEACHER_PATTERNS[0].search(replacement_text)
+        if teacher_match:
+            teacher = teacher_match.group(0)
+        else:
+            teacher_match = TEACHER_PATTERNS[1].search(replacement_text)
+            if teacher_match:
+                last_name, first_initial, middle_initial = teacher_match.groups()
+                teacher = f"{last_name} {first_initial}.{middle_initial}."
+
+    # Подгруппа - та часть замены, где указан кабинет
+    subgroup = None
+    pos_1 = replacement_text.find('1. ')
+    pos_2 = replacement_text.find('2. ')
+    if pos_1 != -1 and pos_2 != -1 and pos_1 < pos_2:
+        subgroup1_text = replacement_text[pos_1 + 3:pos_2].strip()
+        subgroup2_text = replacement_text[pos_2 + 3:].strip()
+        if room_text in subgroup1_text:
+            subgroup = 1
+            replacement_text = subgroup1_text
+        elif room_text in subgroup2_text:
+            subgroup = 2
+            replacement_text = subgroup2_text
+        else:
+            subgroup = _marker_subgroup(replacement_text)
+    else:
+        subgroup = _marker_subgroup(replacement_text)
+
+    clean_text = replacement_text
+    for match in re.findall(r'\b[А-Я]\d{3,}\b', replacement_text):
+        clean_text = clean_text.replace(match, '')
+
+    lesson_type_match = re.search(r'\([А-Яа-я]+\)', clean_text)
+    lesson_type = lesson_type_match.group(0) if lesson_type_match else ""
+
+    def cut_before_teacher(start):
+        end = len(clean_text)
+        if teacher_match:
+            teacher_start = clean_text.find(teacher_match.group(0))
+            if teacher_start > 0:
+                end = teacher_start
+        return clean_text[start:end].strip()
+
+    subject_text = ""
+    for marker, pattern in SUBJECT_PATTERNS:
+        if marker in clean_text:
+            subject_match = pattern.search(clean_text)
+            if subject_match:
+                subject_text = cut_before_teacher(subject_match.start())
+                if lesson_type and lesson_type not in subject_text:
+                    subject_text = f"{lesson_type} {subject_text}"
+            break
+    else:
+        subject_text = clean_text
+        if teacher_match and teacher_match.group(0) in subject_text:
+            subject_text = subject_text[:subject_text.find(teacher_match.group(0))].strip()
+        subject_text = re.sub(r'\b[А-Я]\d{2,}\b', '', subject_text)
+        subject_text = re.sub(r'[^А-Яа-яA-Za-z\s\.\-\(\)0-9]+', ' ', subject_text)
+        if lesson_type and lesson_type not in subject_text:
+            subject_text = f"{lesson_type} {subject_text}"
+
+    subject_text = re.sub(r'\s+', ' ', subject_text).strip()
+    return subgroup, subject_text, teacher
+
+
+def compile_replacement_rooms(sheet):
+    """Раскладывает скомпилированный файл замен по кабинетам и датам"""
+    compiled = {}
+    for date_str, groups in sheet.overrides.items():
+        by_room = {}
+        cell_rooms = {}
+        for group_name, lessons in groups.items():
+            for lesson_num, override in lessons.items():
+                if not isinstance(lesson_num, int):
+                    continue
+                cell_rooms[(group_name, lesson_num)] = frozenset(override.rooms)
+                for room_key, room_text in room_tokens(override.text).items():
+                    subgroup, subject, teacher = describe_replacement(override.text, room_text)
+                    by_room.setdefault(room_key, []).append(
+                        ClassroomLesson(lesson_num, group_name, subgroup, subject, teacher, True)
+                    )
+        compiled[date_str] = ReplacementRooms(by_room, cell_rooms)
+    return compiled
+
+
+@timed("replacements_merge")
+def get_replacement_rooms(date_str, generation=None):
+    """Кабинеты из замен на дату; пересчитываются только после перекомпиляции файла замен"""
+    sheet = find_replacement_sheet(generation or get_generation(), date_str)
+    if not sheet:
+        return EMPTY_REPLACEMENT_ROOMS
+
+    with _replacement_rooms_lock:
+        cached = _replacement_rooms_cache.get(sheet.file_path)
+        if cached is None or cached[0] is not sheet:
+            cached = (sheet, compile_replacement_rooms(sheet))
+            _replacement_rooms_cache[sheet.file_path] = cached
+
+    return cached[1].get(date_str, EMPTY_REPLACEMENT_ROOMS)
+
+
+def _is_moved(record, lesson_num, room_key, replacements):
+    """Перенесена ли пара основного расписания заменой в другой кабинет"""
+    cell_rooms = replacements.cell_rooms.get((record.group, lesson_num))
+    return cell_rooms is not None and room_key not in cell_rooms
+
+
+def get_classroom_lessons(classroom, date_str):
+    """
+    Пары в кабинете на дату с учетом замен.
+
+    Returns:
+        list: ClassroomLesson, отсортированные по номеру пары
+    """
+    room_key = normalize_room(classroom)
+    generation = get_generation()
+    store = generation.store
+    parity, weekday = get_date_parity_and_weekday(date_str)
+    replacements = get_replacement_rooms(date_str, generation)
+
+    replacement_lessons = replacements.by_room.get(room_key, [])
+    replaced_numbers = {_lesson_key(lesson.lesson_num) for lesson in replacement_lessons}
+
+    lessons = {}
+    with timed("sheet_parse"):
+        for lesson_num in store.lesson_numbers:
+            number = _lesson_key(lesson_num)
+            # Замены в кабинете вытесняют пары основного расписания
+            if number in replaced_numbers:
+                continue
+            for record in store.by_room.get((room_key, parity, weekday, lesson_num), []):
+                if _is_moved(record, number, room_key, replacements):
+                    continue
+                lessons[(number, record.subgroup, record.group)] = ClassroomLesson(
+                    lesson_num, record.group, record.subgroup, record.subject, record.teacher, False
+                )
+
+    for lesson in replacement_lessons:
+        lessons[(_lesson_key(lesson.lesson_num), lesson.subgroup, lesson.group)] = lesson
+
+    def sort_key(lesson):
+        number = _lesson_key(lesson.lesson_num)
+        return (number if isinstance(number, int) else 0, 0 if lesson.is_replacement else 1)
+
+    return sorted(lessons.values(), key=sort_key)
+
+
+def get_free_rooms(date_str, lesson_num):
+    """
+    Кабинеты, свободные на указанной паре.
+
+    Список кабинетов берется из основного расписания всех групп.
+
+    Returns:
+        list: Названия свободных кабинетов
+    """
+    generation = get_generation()
+    store = generation.store
+    parity, weekday = get_date_parity_and_weekday(date_str)
+    replacements = get_replacement_rooms(date_str, generation)
+    number = _lesson_key(lesson_num)
+
+    occupied = set()
+    for slot_lesson in store.lesson_numbers:
+        if _lesson_key(slot_lesson) != number:
+            continue
+        for room_key in store.rooms_by_slot.get((parity, weekday, slot_lesson), ()):
+            records = store.by_room[(room_key, parity, weekday, slot_lesson)]
+            if any(not _is_moved(record, number, room_key, replacements) for record in records):
+                occupied.add(room_key)
+
+    for room_key, room_lessons in replacements.by_room.items():
+        if any(_lesson_key(lesson.lesson_num) == number for lesson in room_lessons):
+            occupied.add(room_key)
+
+    free = [name for key, name in store.room_display_names.items() if key not in occupied]
+    return sorted(free)
+
+
+@timed("formatting")
+def format_classroom_lessons(classroom, date_str, lessons):
+    """Форматирует расписание кабинета так же, как get_classroom_schedule"""
+    from было import days_ru, get_week_type
+
+    weekday_ru = days_ru[datetime.strptime(date_str, '%d.%m.%Y').weekday()]
+    week_type = get_week_type(date_str)
+    header = f"📅 Расписание для кабинета {classroom} на {weekday_ru} {date_str} ({week_type} неделя):"
+
+    if not lessons:
+        return f"{header}\n\nВ этот день занятий в кабинете нет."
+
+    formatted = [header]
+    for lesson in lessons:
+        lesson_str = f"\n{str(lesson.lesson_num)}️⃣ "
+        if lesson.is_replacement:
+            lesson_str += "✏️ "
+        lesson_str += f"{lesson.subject or 'Неизвестно'} "
+        lesson_str += f"🎓{lesson.teacher or 'Неизвестно'} "
+        subgroup_text = f", {lesson.subgroup}-я подгруппа" if lesson.subgroup else ""
+        lesson_str += f"👥 [{lesson.group or 'Неизвестно'}{subgroup_text}]"
+        formatted.append(lesson_str)
+
+    return "\n".join(formatted)
+
+
+async def indexed_get_classroom_schedule(classroom: str, date_str: str) -> str:
+    """Замена get_classroom_schedule, отвечающая из индекса занятости кабинетов"""
+    with track_query("classroom"):
+        return await build_classroom_schedule(classroom, date_str)
+
+
+@coalesced("classroom", lambda classroom, date_str: (normalize_room(classroom), date_str.strip()))
+async def build_classroom_schedule(classroom: str, date_str: str) -> str:
+    """Ответ на запрос расписания кабинета (один на одновременные одинаковые запросы)"""
+    try:
+        classroom = normalize_room(classroom)
+        # get_generation может сверять поколение с диском, поэтому не в цикле событий
+        lessons = await run_task(get_classroom_lessons, classroom, date_str)
+        return format_classroom_lessons(classroom, date_str, lessons)
+    except Exception as e:
+        logger.error(f"Error getting classroom schedule from index: {e}")
+        return f"Ошибка при получении расписания кабинета: {str(e)}"
+
+
+async def classroom_schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler for /classroom command"""
+    try:
+        if is_update_in_progress():
+            await update.message.reply_text(get_update_status_message(), parse_mode='Markdown')
+            return
+
+        args = context.args
+        if len(args) < 2:
+            await update.message.reply_text(
+                "Пожалуйста, укажите кабинет и дату в формате:\n"
+                "/classroom А403 02.05.2023\n"
+                "Примеры кабинетов: А403, В12, К25"
+            )
+            return
+
+        classroom, date_str = args[0], args[1]
+        try:
+            datetime.strptime(date_str, '%d.%m.%Y')
+        except ValueError:
+            await update.message.reply_text("Пожалуйста, укажите дату в формате ДД.ММ.ГГГГ")
+            return
+
+        schedule = await indexed_get_classroom_schedule(classroom, date_str)
+        with timed("telegram_send", "classroom"):
+            await update.message.reply_text(schedule)
+
+    except Exception as e:
+        logger.error(f"Error in classroom schedule command: {e}")
+        await update.message.reply_text("Произошла ошибка при получении расписания кабинета")
+
+
+async def free_rooms_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler for /free_rooms command: свободные кабинеты на пару"""
+    try:
+        if is_update_in_progress():
+            await update.message.reply_text(get_update_status_message(), parse_mode='Markdown')
+            return
+
+        args = context.args
+        if not args or not args[0].isdigit():
+            await update.message.reply_text(
+                "Пожалуйста, укажите номер пары и дату в формате:\n"
+                "/free_rooms 3 02.05.2025\n"
+                "Без даты используется сегодняшний день"
+            )
+            return
+
+        lesson_num = int(args[0])
+        date_str = args[1] if len(args) > 1 else datetime.now().strftime('%d.%m.%Y')
+        try:
+            date_obj = datetime.strptime(date_str, '%d.%m.%Y')
+        except ValueError:
+            await update.message.reply_text("Пожалуйста, укажите дату в формате ДД.ММ.ГГГГ")
+            return
+
+        if date_obj.weekday() == 6:
+            await update.message.reply_text("В воскресенье занятий нет")
+            return
+
+        free_rooms = await run_task(get_free_rooms, date_str, lesson_num)
+        if not free_rooms:
+            await update.message.reply_text(f"На {lesson_num}-й паре {date_str} свободных кабинетов нет")
+            return
+
+        await update.message.reply_text(
+            f"🚪 Свободные кабинеты на {lesson_num}-й паре {date_str}:\n\n" + ", ".join(free_rooms)
+        )
+
+    except Exception as e:
+        logger.error(f"Error in free rooms command: {e}")
+        await update.message.reply_text("Произошла ошибка при поиске свободных кабинетов")
+
+
+def patch_classroom_schedule():
+    """
+    Подменяет расписание кабинетов в модуле было на версию,
+    работающую с индексом занятости.
+    """
+    import было
+    было.get_classroom_schedule = indexed_get_classroom_schedule
+    было.classroom_schedule_command = classroom_schedule_command
+    logger.info("Classroom schedule has been patched to use the room occupancy index")
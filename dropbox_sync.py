@@ -6,11 +6,16 @@ import schedule
 import time
 from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 import json
+import shutil
 import threading
 import traceback
 import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Настройка логирования
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -24,11 +29,15 @@ ACCESS_TOKEN_FILE = "access_token.txt"
 
 # Папка для хранения загруженных файлов
 DOWNLOADS_DIR = "downloaded_files"
-SUBSCRIBERS_FILE = "subscribers.json"
+# Папка, куда скачиваются файлы до публикации нового поколения расписания
+STAGING_DIR = "downloaded_files.staging"
 
 # Файл для хранения времени последнего обновления расписаний групп
 LAST_SCHEDULE_UPDATE_FILE = "last_schedule_update.txt"
 
+# Состояние загруженных расписаний групп (ETag, Last-Modified, размер и хэш каждого файла)
+SYNC_STATE_FILE = "sync_state.json"
+
 # Файл-маркер, указывающий, что первый запуск уже был выполнен
 FIRST_RUN_MARKER_FILE = "schedule_first_run_completed.txt"
 
@@ -52,6 +61,16 @@ UPDATE_IN_PROGRESS_FILE = "update_in_progress.flag"
 # Максимальное время выполнения операции синхронизации в секундах
 SYNC_TIMEOUT_SECONDS = 300  # 5 минут
 
+# Сколько файлов скачивать и загружать в Dropbox одновременно
+DOWNLOAD_WORKERS = 8
+# Таймауты HTTP запросов к LMS: (подключение, чтение) в секундах
+HTTP_TIMEOUT = (10, 60)
+# Повторы запросов при сетевых ошибках и ответах 429/5xx
+HTTP_RETRIES = 3
+# Задержка между повторами: HTTP_BACKOFF_FACTOR * 2 ** (номер попытки - 1) секунд
+HTTP_BACKOFF_FACTOR = 1
+DROPBOX_UPLOAD_RETRIES = 3
+
 # Текст сообщения для пользователей во время обновления
 UPDATE_IN_PROGRESS_MESSAGE = """⚠️ *Внимание!* 
 
@@ -64,6 +83,10 @@ UPDATE_IN_PROGRESS_MESSAGE = """⚠️ *Внимание!*
 update_timer = None
 update_lock = threading.Lock()
 
+# Общая HTTP сессия с пулом соединений для загрузки файлов с LMS
+_http_session = None
+_http_session_lock = threading.Lock()
+
 
 class DropboxTokenManager:
     def __init__(self, app_key, app_secret):
@@ -192,16 +215,20 @@ def get_dropbox_client():
         return None
 
 
-def notify_subscribers(new_files):
-    """Отправляет уведомления подписчикам о новых файлах замен"""
+def notify_subscribers(new_files, old_generation=None, new_generation=None):
+    """
+    Отправляет уведомления подписчикам о новых файлах замен.
+
+    Если переданы поколения расписания до и после синхронизации, подписчики,
+    указавшие группу или преподавателя, получают только свои изменения
+    с готовым расписанием; остальные - общее уведомление.
+    """
     try:
-        subscribers = {}
-        
-        # Загружаем список подписчиков
-        if os.path.exists(SUBSCRIBERS_FILE):
-            with open(SUBSCRIBERS_FILE, 'r', encoding='utf-8') as f:
-                subscribers = json.load(f)
-                
+        from subscriber_store import get_subscriber_registry
+
+        # Снимок списка подписчиков
+        subscribers = get_subscriber_registry().all()
+
         if not subscribers:
             logger.info("Нет подписчиков для уведомления")
             return
@@ -246,21 +273,23 @@ def notify_subscribers(new_files):
                     else:
                         message += f"• {filename}\n"
         
-        message += "\nБудут доступны через 2 минуты"
-        
-        # Save notification to both files to ensure delivery
-        notification_data = {
-            "message": message,
-            "chat_ids": list(subscribers.keys()),
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        
-        # Write to both notification files
-        with open("new_replacements_notify.json", "w", encoding='utf-8') as f:
-            json.dump(notification_data, f, ensure_ascii=False)
-        
-        with open("pending_notifications.json", "w", encoding='utf-8') as f:
-            json.dump(notification_data, f, ensure_ascii=False)
+        # Рассылка сразу передается циклу рассылки и записывается в журнал
+        from broadcast import publish_notification
+
+        chat_ids = list(subscribers.keys())
+        if old_generation is not None and new_generation is not None:
+            try:
+                from change_notifications import build_personal_messages
+                messages, chat_ids = build_personal_messages(subscribers, old_generation, new_generation)
+                if messages:
+                    publish_notification(None, list(messages), parse_mode=None, messages=messages)
+            except Exception as e:
+                logger.error(f"Ошибка при подготовке персональных уведомлений: {e}")
+                logger.error(traceback.format_exc())
+                chat_ids = list(subscribers.keys())
+
+        if chat_ids:
+            publish_notification(message, chat_ids, parse_mode='Markdown')
             
         logger.info(f"Подготовлено уведомление для {len(subscribers)} подписчиков")
         
@@ -381,15 +410,43 @@ def set_update_in_progress(in_progress=True):
         except:
             pass
 
-def is_update_in_progress():
-    """Проверяет, идет ли процесс обновления"""
+def set_update_progress(done, total, stage):
+    """
+    Записывает ход загрузки во вторую строку файла-флага обновления.
+    Время начала обновления (первая строка) не меняется.
+    """
+    try:
+        with update_lock:
+            if not os.path.exists(UPDATE_IN_PROGRESS_FILE):
+                return
+            with open(UPDATE_IN_PROGRESS_FILE, 'r') as f:
+                timestamp_str = f.readline().strip()
+            with open(UPDATE_IN_PROGRESS_FILE, 'w') as f:
+                f.write(f"{timestamp_str}\n{done} {total} {stage}")
+    except Exception as e:
+        logger.error(f"Ошибка при записи хода обновления: {e}")
+
+def get_update_progress():
+    """Возвращает (загружено, всего, этап) из файла-флага или None"""
+    try:
+        with open(UPDATE_IN_PROGRESS_FILE, 'r') as f:
+            lines = f.read().splitlines()
+        if len(lines) < 2:
+            return None
+        done, total, stage = lines[1].split(' ', 2)
+        return int(done), int(total), stage
+    except (OSError, ValueError):
+        return None
+
+def is_sync_running():
+    """Проверяет, выполняется ли синхронизация файлов"""
     try:
         # Проверяем наличие файла-флага
         if os.path.exists(UPDATE_IN_PROGRESS_FILE):
             # Дополнительно можно проверить время создания флага
             # и сбросить его автоматически, если прошло слишком много времени
             with open(UPDATE_IN_PROGRESS_FILE, 'r') as f:
-                timestamp_str = f.read().strip()
+                timestamp_str = f.readline().strip()
                 start_time = datetime.fromisoformat(timestamp_str)
                 # Если прошло более 5 минут, считаем, что обновление зависло
                 if (datetime.now() - start_time).total_seconds() > SYNC_TIMEOUT_SECONDS:
@@ -408,12 +465,186 @@ def is_update_in_progress():
             pass
         return False
 
+def is_update_in_progress():
+    """
+    Проверяет, нужно ли попросить пользователя подождать окончания обновления.
+
+    Пока идет синхронизация, запросы отвечают из текущего поколения расписания,
+    поэтому ждать нужно, только если расписание еще ни разу не загружено.
+    """
+    if not is_sync_running():
+        return False
+    from schedule_generations import current_generation
+    return current_generation() is None
+
 def get_update_status_message():
     """Возвращает сообщение о статусе обновления для пользователей"""
     if is_update_in_progress():
+        progress = get_update_progress()
+        if progress and progress[1]:
+            done, total, stage = progress
+            return f"{UPDATE_IN_PROGRESS_MESSAGE}\n\nЗагружено файлов ({stage}): {done} из {total}"
         return UPDATE_IN_PROGRESS_MESSAGE
     return None
 
+def get_http_session():
+    """HTTP сессия с пулом соединений и повторами запросов с увеличивающейся задержкой"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF_FACTOR,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['GET'])
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_WORKERS, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+def fetch_url(url, headers=None):
+    """GET запрос через общую сессию; бросает исключение при ошибке HTTP"""
+    response = get_http_session().get(url, headers=headers, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response
+
+def load_sync_state():
+    """Загружает состояние загруженных файлов: {имя файла: {etag, last_modified, content_length, sha1}}"""
+    try:
+        if os.path.exists(SYNC_STATE_FILE):
+            with open(SYNC_STATE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка при чтении состояния синхронизации: {e}")
+    return {}
+
+def save_sync_state(state):
+    """Сохраняет состояние загруженных файлов (через временный файл)"""
+    try:
+        temp_file = f"{SYNC_STATE_FILE}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, SYNC_STATE_FILE)
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении состояния синхронизации: {e}")
+
+def write_file_atomically(local_path, content):
+    """Записывает файл во временный файл рядом и переименовывает его, чтобы читатели не увидели половину файла"""
+    temp_path = f"{local_path}.part"
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    os.replace(temp_path, local_path)
+
+def _local_sha1(local_path):
+    sha1 = hashlib.sha1()
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def upload_to_dropbox(dbx, local_path, filename):
+    """Загружает файл в Dropbox, повторяя попытку при ограничении частоты и ошибках сервера"""
+    for attempt in range(1, DROPBOX_UPLOAD_RETRIES + 1):
+        try:
+            with open(local_path, 'rb') as f:
+                dbx.files_upload(f.read(), f"/{filename}", mode=dropbox.files.WriteMode.overwrite)
+            return
+        except dropbox.exceptions.RateLimitError as e:
+            if attempt == DROPBOX_UPLOAD_RETRIES:
+                raise
+            delay = e.backoff or HTTP_BACKOFF_FACTOR * 2 ** (attempt - 1)
+        except (dropbox.exceptions.InternalServerError, requests.exceptions.RequestException):
+            if attempt == DROPBOX_UPLOAD_RETRIES:
+                raise
+            delay = HTTP_BACKOFF_FACTOR * 2 ** (attempt - 1)
+        logger.warning(f"Повторная загрузка {filename} в Dropbox через {delay} с (попытка {attempt + 1})")
+        time.sleep(delay)
+
+def transfer_files(dbx, files, stage, state=None, target_dir=DOWNLOADS_DIR):
+    """
+    Параллельно скачивает файлы с LMS в target_dir и загружает их в Dropbox.
+
+    Если передано состояние синхронизации, файлы запрашиваются условно
+    (If-None-Match / If-Modified-Since), а файлы с тем же содержимым
+    не перезаписываются и не загружаются в Dropbox повторно.
+
+    Args:
+        dbx: Клиент Dropbox или None
+        files: Список пар (ссылка, имя файла)
+        stage: Название этапа для логов и сообщения о ходе обновления
+        state: Состояние из load_sync_state (изменяется на месте) или None
+        target_dir: Папка для скачанных файлов; сравниваются они с файлами из DOWNLOADS_DIR
+
+    Returns:
+        list: Имена записанных (новых или изменившихся) файлов в порядке исходного списка
+    """
+    total = len(files)
+    done = 0
+    succeeded = set()
+    state_lock = threading.Lock()
+    set_update_progress(0, total, stage)
+
+    def transfer(href, filename):
+        local_path = os.path.join(DOWNLOADS_DIR, filename)
+        target_path = os.path.join(target_dir, filename)
+        with state_lock:
+            known = dict(state.get(filename, {})) if state is not None else {}
+
+        headers = {}
+        if known and os.path.exists(local_path):
+            if known.get('etag'):
+                headers['If-None-Match'] = known['etag']
+            if known.get('last_modified'):
+                headers['If-Modified-Since'] = known['last_modified']
+
+        response = fetch_url(href, headers=headers)
+        if response.status_code == 304:
+            logger.debug(f"Файл не изменился ({stage}): {filename}")
+            return False
+
+        content = response.content
+        sha1 = hashlib.sha1(content).hexdigest()
+        if state is not None and os.path.exists(local_path):
+            unchanged = sha1 == (known.get('sha1') or _local_sha1(local_path))
+        else:
+            unchanged = False
+
+        if not unchanged:
+            write_file_atomically(target_path, content)
+            logger.info(f"Загружен файл ({stage}): {filename}")
+
+            if dbx:
+                upload_to_dropbox(dbx, target_path, filename)
+                logger.info(f"Загружен файл в Dropbox ({stage}): {filename}")
+
+        if state is not None:
+            with state_lock:
+                state[filename] = {
+                    'href': href,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'content_length': len(content),
+                    'sha1': sha1
+                }
+        return not unchanged
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="sync") as executor:
+        futures = {executor.submit(transfer, href, filename): filename for href, filename in files}
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                if future.result():
+                    succeeded.add(filename)
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке файла {filename}: {e}")
+            done += 1
+            set_update_progress(done, total, stage)
+
+    return [filename for _, filename in files if filename in succeeded]
+
 # Функция для асинхронного запуска синхронизации файлов в отдельном потоке
 def sync_files_async(force_check=False):
     """
@@ -421,7 +652,7 @@ def sync_files_async(force_check=False):
     чтобы не блокировать основной поток бота
     """
     # Проверяем, не идет ли уже процесс обновления
-    if is_update_in_progress():
+    if is_sync_running():
         logger.info("Синхронизация файлов уже выполняется, пропускаем запрос")
         return
         
@@ -482,8 +713,13 @@ def sync_files(dbx=None, force_check=False):
 
         new_files = []
 
+        # Файлы скачиваются во временную папку; запросы тем временем работают
+        # с текущим поколением расписания и рабочей папкой
+        shutil.rmtree(STAGING_DIR, ignore_errors=True)
+        os.makedirs(STAGING_DIR)
+
         # Синхронизация файлов замен
-        new_replacement_files = sync_replacements(dbx, force_check)
+        new_replacement_files, removed_files = sync_replacements(dbx, force_check)
         if new_replacement_files:
             new_files.extend(new_replacement_files)
 
@@ -491,9 +727,10 @@ def sync_files(dbx=None, force_check=False):
         first_run = is_first_run()
         if force_check or should_update_schedules(new_replacement_files):
             # Синхронизация файлов расписаний групп
-            new_schedule_files = sync_group_schedules(dbx, force_check)
-            if new_schedule_files:
-                new_files.extend(new_schedule_files)
+            changed_schedule_files, removed_schedule_files = sync_group_schedules(dbx, force_check)
+            if changed_schedule_files:
+                new_files.extend(changed_schedule_files)
+            removed_files.extend(removed_schedule_files)
             
             # Обновляем время последнего обновления расписаний
             set_last_schedule_update()
@@ -504,21 +741,48 @@ def sync_files(dbx=None, force_check=False):
         else:
             logger.info("Пропуск обновления расписаний групп - недавно уже обновлялись или нет новых замен")
 
-        # Если обнаружены новые файлы, отправляем уведомления
-        if new_files:
-            # Очищаем кэш после обновления с указанием причины
+        # Если файлы изменились, публикуем новое поколение расписания и отправляем уведомления
+        old_generation = new_generation = None
+        if new_files or removed_files:
+            # Разбираем изменившиеся файлы групп и замен, публикуем поколение и сбрасываем
+            # только ответы, зависящие от изменившихся данных
             try:
-                from cache_utils import selective_cache_clear
-                selective_cache_clear(reason="new_replacements")
-                logger.info("Кэш успешно очищен после обновления файлов")
+                from schedule_generations import publish_staged_files
+                from store_snapshot import save_snapshot
+                from cache_dependencies import invalidate_changed_sources
+                old_generation, new_generation = publish_staged_files(STAGING_DIR, removed_files)
+                invalidate_changed_sources(
+                    old_generation.store if old_generation else None,
+                    dict(old_generation.replacement_sheets) if old_generation else {},
+                    new_generation.store,
+                    dict(new_generation.replacement_sheets)
+                )
+                save_snapshot()
             except Exception as e:
-                logger.error(f"Ошибка при очистке кэша: {e}")
-                
-            # Отправляем уведомления подписчикам о новых файлах
-            notify_subscribers(new_files)
+                logger.error(f"Ошибка при публикации нового поколения расписания: {e}")
+                # Не удалось определить, что изменилось, - переносим файлы и очищаем кэш целиком
+                try:
+                    from schedule_generations import move_staged_files, refresh_generation
+                    from cache_utils import selective_cache_clear
+                    if os.path.exists(STAGING_DIR):
+                        move_staged_files(STAGING_DIR, removed_files)
+                    refresh_generation()
+                    selective_cache_clear(reason="new_replacements")
+                    logger.info("Кэш успешно очищен после обновления файлов")
+                except Exception as e:
+                    logger.error(f"Ошибка при очистке кэша: {e}")
+
+            # Уведомления отправляются после публикации: новые файлы уже доступны
+            if new_files:
+                notify_subscribers(new_files, old_generation, new_generation)
         else:
+            shutil.rmtree(STAGING_DIR, ignore_errors=True)
             logger.info("Новых файлов не обнаружено")
 
+        # Заново формируем ответы групп, удаленные из кэша изменениями или истекшие
+        from prerender import start_prerender
+        start_prerender()
+
         return new_files
 
     except Exception as e:
@@ -527,7 +791,15 @@ def sync_files(dbx=None, force_check=False):
         return []
 
 def sync_replacements(dbx, force_check=False):
-    """Синхронизирует только файлы замен с LMSMGTU"""
+    """
+    Синхронизирует только файлы замен с LMSMGTU.
+
+    Новые файлы скачиваются в STAGING_DIR; старые файлы удаляются из рабочей
+    папки при публикации нового поколения.
+
+    Returns:
+        tuple: (новые файлы, файлы, которые нужно удалить)
+    """
     try:
         logger.info("Синхронизация файлов замен")
 
@@ -536,8 +808,7 @@ def sync_replacements(dbx, force_check=False):
                        if f.endswith('.xlsx') and is_replacement_file(f)]
 
         # Получаем список новых файлов с сайта
-        response = requests.get(REPLACEMENTS_URL)
-        response.raise_for_status()
+        response = fetch_url(REPLACEMENTS_URL)
         soup = BeautifulSoup(response.text, 'html.parser')
         links = soup.find_all('a')
 
@@ -596,58 +867,41 @@ def sync_replacements(dbx, force_check=False):
         if has_new_files or force_check:
             logger.info("Обнаружены новые файлы замен")
 
-            # Удаляем старые файлы замен
-            for old_file in current_files:
-                try:
-                    old_path = os.path.join(DOWNLOADS_DIR, old_file)
-                    if os.path.exists(old_path):
-                        os.remove(old_path)
-                        logger.info(f"Удален старый файл замен: {old_file}")
-
-                    # Удаляем файл из Dropbox
-                    if dbx:
-                        try:
-                            dbx.files_delete_v2(f"/{old_file}")
-                            logger.info(f"Удален старый файл замен из Dropbox: {old_file}")
-                        except Exception as e:
-                            logger.error(f"Ошибка при удалении файла из Dropbox: {e}")
+            # Старые файлы замен удаляются из рабочей папки при публикации поколения
+            removed_files = [f for f in current_files if f not in latest_filenames]
+            for old_file in removed_files:
+                logger.info(f"Старый файл замен будет удален: {old_file}")
 
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении старого файла {old_file}: {e}")
+                # Удаляем файл из Dropbox
+                if dbx:
+                    try:
+                        dbx.files_delete_v2(f"/{old_file}")
+                        logger.info(f"Удален старый файл замен из Dropbox: {old_file}")
+                    except Exception as e:
+                        logger.error(f"Ошибка при удалении файла из Dropbox: {e}")
 
             # Загружаем новые файлы
-            for href, filename in latest_files:
-                try:
-                    # Загружаем файл
-                    file_response = requests.get(href)
-                    file_response.raise_for_status()
-
-                    # Сохраняем локально
-                    local_path = os.path.join(DOWNLOADS_DIR, filename)
-                    with open(local_path, 'wb') as f:
-                        f.write(file_response.content)
-                    logger.info(f"Загружен новый файл замен: {filename}")
-
-                    # Загружаем в Dropbox
-                    if dbx:
-                        with open(local_path, 'rb') as f:
-                            dbx.files_upload(f.read(), f"/{filename}", mode=dropbox.files.WriteMode.overwrite)
-                        logger.info(f"Загружен новый файл замен в Dropbox: {filename}")
-
-                except Exception as e:
-                    logger.error(f"Ошибка при загрузке нового файла {filename}: {e}")
+            transfer_files(dbx, latest_files, "замены", target_dir=STAGING_DIR)
             
-            return new_files
+            return new_files, removed_files
         else:
             logger.info("Новых файлов замен не обнаружено")
-            return []
+            return [], []
 
     except Exception as e:
         logger.error(f"Ошибка при проверке замен: {str(e)}")
-        return []
+        return [], []
 
 def sync_group_schedules(dbx, force_check=False):
-    """Синхронизирует расписания групп с LMSMGTU"""
+    """
+    Синхронизирует расписания групп с LMSMGTU.
+
+    Скачиваются (в STAGING_DIR) только изменившиеся файлы; файлы, пропавшие с сайта,
+    удаляются из рабочей папки при публикации нового поколения.
+
+    Returns:
+        tuple: (новые или изменившиеся файлы, файлы, которые нужно удалить)
+    """
     try:
         logger.info("Синхронизация расписаний групп")
         
@@ -655,13 +909,50 @@ def sync_group_schedules(dbx, force_check=False):
         current_files = [f for f in os.listdir(DOWNLOADS_DIR) 
                        if f.endswith('.xlsx') and not is_replacement_file(f)]
         
-        # Удаляем все существующие файлы расписаний групп
-        for old_file in current_files:
-            try:
-                old_path = os.path.join(DOWNLOADS_DIR, old_file)
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-                    logger.info(f"Удален старый файл расписания: {old_file}")
+        # Получаем списки файлов со всех страниц одновременно
+        def list_group_files(url):
+            logger.info(f"Обработка URL: {url}")
+            response = fetch_url(url)
+            soup = BeautifulSoup(response.text, 'html.parser')
+            files = []
+            for link in soup.find_all('a'):
+                href = link.get('href')
+                filename = link.text.strip()
+                
+                # Проверяем, что это Excel-файл
+                if href and ('.xlsx' in href or '.xls' in href):
+                    if not filename.endswith('.xlsx'):
+                        filename += '.xlsx'
+                    files.append((href, filename))
+            return files
+        
+        group_files = {}
+        listing_complete = True
+        with ThreadPoolExecutor(max_workers=len(GROUP_SCHEDULE_URLS)) as executor:
+            futures = [(url, executor.submit(list_group_files, url)) for url in GROUP_SCHEDULE_URLS]
+            for url, future in futures:
+                try:
+                    for href, filename in future.result():
+                        group_files[filename] = href
+                except Exception as e:
+                    listing_complete = False
+                    logger.error(f"Ошибка при обработке URL {url}: {e}")
+        
+        # Скачиваем только изменившиеся файлы и загружаем их в Dropbox
+        state = {} if force_check else load_sync_state()
+        changed_files = transfer_files(
+            dbx, [(href, filename) for filename, href in group_files.items()], "расписания групп", state,
+            target_dir=STAGING_DIR
+        )
+        
+        # Удаляем файлы, которых больше нет на сайте (только если все страницы загрузились)
+        removed_files = []
+        if listing_complete:
+            for old_file in current_files:
+                if old_file in group_files:
+                    continue
+                removed_files.append(old_file)
+                logger.info(f"Старый файл расписания будет удален: {old_file}")
 
                 # Удаляем файл из Dropbox
                 if dbx:
@@ -670,71 +961,20 @@ def sync_group_schedules(dbx, force_check=False):
                         logger.info(f"Удален старый файл расписания из Dropbox: {old_file}")
                     except Exception as e:
                         logger.error(f"Ошибка при удалении файла из Dropbox: {e}")
-            except Exception as e:
-                logger.error(f"Ошибка при удалении старого файла {old_file}: {e}")
-        
-        downloaded_files = []
-        
-        # Обрабатываем каждый URL с расписаниями групп
-        for url in GROUP_SCHEDULE_URLS:
-            try:
-                logger.info(f"Обработка URL: {url}")
-                
-                # Получаем список файлов с сайта
-                response = requests.get(url)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                links = soup.find_all('a')
-                
-                # Обрабатываем каждую ссылку
-                for link in links:
-                    href = link.get('href')
-                    filename = link.text.strip()
-                    
-                    # Проверяем, что это Excel-файл
-                    if href and ('.xlsx' in href or '.xls' in href):
-                        if not filename.endswith('.xlsx'):
-                            filename += '.xlsx'
-                        
-                        try:
-                            # Загружаем файл
-                            file_response = requests.get(href)
-                            file_response.raise_for_status()
-                            
-                            # Сохраняем локально
-                            local_path = os.path.join(DOWNLOADS_DIR, filename)
-                            with open(local_path, 'wb') as f:
-                                f.write(file_response.content)
-                            logger.info(f"Загружено расписание группы: {filename}")
-                            
-                            # Загружаем в Dropbox
-                            if dbx:
-                                with open(local_path, 'rb') as f:
-                                    dbx.files_upload(f.read(), f"/{filename}", mode=dropbox.files.WriteMode.overwrite)
-                                logger.info(f"Загружено расписание группы в Dropbox: {filename}")
-                            
-                            downloaded_files.append(filename)
-                            
-                        except Exception as e:
-                            logger.error(f"Ошибка при загрузке файла {filename}: {e}")
-            
-            except Exception as e:
-                logger.error(f"Ошибка при обработке URL {url}: {e}")
-        
-        logger.info(f"Загружено расписаний групп: {len(downloaded_files)}")
-        
-        # Для уведомлений вернем только новые файлы, которых не было раньше
-        new_files = [f for f in downloaded_files if f not in current_files]
-        if new_files:
-            logger.info(f"Обнаружены новые расписания групп: {len(new_files)}")
         else:
-            logger.info("Новых расписаний групп не обнаружено")
+            logger.warning("Не все страницы с расписаниями загрузились, старые файлы не удаляются")
         
-        return new_files
+        for filename in removed_files:
+            state.pop(filename, None)
+        save_sync_state(state)
+        
+        logger.info(f"Расписаний групп на сайте: {len(group_files)}, изменилось: {len(changed_files)}, "
+                    f"удалено: {len(removed_files)}")
+        return changed_files, removed_files
         
     except Exception as e:
         logger.error(f"Ошибка при синхронизации расписаний групп: {e}")
-        return []
+        return [], []
 
 # Вспомогательная функция для проверки, является ли файл файлом замен
 def is_replacement_file(filename):
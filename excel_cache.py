@@ -2,27 +2,21 @@ import os
 import logging
 import time
 import threading
-import asyncio
 from datetime import datetime
-import openpyxl
 from functools import wraps
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
+from typing import Dict, NamedTuple, Tuple, Any
 
-logger = logging.getLogger(__name__)
+from sheet_grid import load_grid_workbook
+from task_scheduler import PREFETCH, current_priority, get_scheduler, run_task, submit_all
 
-# Cache for Excel workbooks
-excel_cache = {}
-excel_cache_lock = threading.Lock()
+logger = logging.getLogger(__name__)
 
 # Maximum cache size (number of workbooks)
 MAX_CACHE_SIZE = 40  # Increased from 30
 # Cache expiration time in seconds (30 minutes)
 CACHE_EXPIRY = 1800  # 30 minutes
 
-# Thread pool for Excel file operations
-# Increase thread pool size for better concurrency
-excel_io_pool = ThreadPoolExecutor(max_workers=15)  # Increased from 10
-
 # Track file access frequency for prioritization
 file_access_counts = {}
 access_counts_lock = threading.Lock()
@@ -48,7 +42,7 @@ def process_workbook_in_background(file_path, processor_func, *args, **kwargs):
             logger.error(f"Error in background Excel processing for {file_path}: {e}")
             raise
     
-    return excel_io_pool.submit(background_task)
+    return get_scheduler().submit(current_priority(), background_task)
 
 def update_file_access_count(file_path):
     """Track file access to identify frequently used files"""
@@ -57,80 +51,164 @@ def update_file_access_count(file_path):
             file_access_counts[file_path] = 0
         file_access_counts[file_path] += 1
         
-def get_cached_workbook(file_path):
+class CachedWorkbook(NamedTuple):
+    workbook: Any
+    signature: Tuple[float, int]    # (mtime, size) of the file the workbook was loaded from
+    last_used: float
+
+
+def load_workbook_for_reading(file_path):
     """
-    Get a cached workbook or load it if not in cache.
-    This avoids repeatedly loading the same Excel files.
+    Load the active sheet into an immutable SheetGrid.
+
+    Read-only workbooks stream cells from an open file handle and must not be shared
+    between threads; a grid is read once and can then be indexed from several threads.
     """
-    # Track file access to identify frequently used files
-    update_file_access_count(file_path)
-    
-    with excel_cache_lock:
+    return load_grid_workbook(file_path)
+
+
+class WorkbookProvider:
+    """
+    Thread-safe cache of loaded workbooks.
+
+    Parsers receive a provider explicitly and ask it for workbooks instead of calling
+    openpyxl.load_workbook. Each file is loaded at most once at a time: concurrent
+    requests for a file that is being loaded wait for that load instead of starting
+    another one. A cached workbook is reloaded when the file's mtime or size changes.
+    """
+
+    def __init__(self, max_size=None, expiry=None, loader=load_workbook_for_reading):
+        self.max_size = max_size or MAX_CACHE_SIZE
+        self.expiry = expiry or CACHE_EXPIRY
+        self._loader = loader
+        self._entries: Dict[str, CachedWorkbook] = {}
+        self._loading: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'loads': 0, 'shared_loads': 0, 'evictions': 0}
+
+    def get_workbook(self, file_path):
+        update_file_access_count(file_path)
+        stat = os.stat(file_path)
+        signature = (stat.st_mtime, stat.st_size)
+
+        while True:
+            with self._lock:
+                current_time = time.time()
+                entry = self._entries.get(file_path)
+                if entry and entry.signature == signature and current_time - entry.last_used <= self.expiry:
+                    self._entries[file_path] = entry._replace(last_used=current_time)
+                    self.stats['hits'] += 1
+                    return entry.workbook
+
+                pending = self._loading.get(file_path)
+                is_loader = pending is None
+                if is_loader:
+                    pending = Future()
+                    self._loading[file_path] = pending
+                else:
+                    self.stats['shared_loads'] += 1
+
+            if not is_loader:
+                workbook, loaded_signature = pending.result()
+                if loaded_signature == signature:
+                    return workbook
+                # The file changed while it was being loaded, try again
+                continue
+
+            try:
+                logger.debug(f"Loading workbook from {file_path}")
+                workbook = self._loader(file_path)
+            except Exception as e:
+                logger.error(f"Error loading workbook {file_path}: {e}")
+                with self._lock:
+                    self._loading.pop(file_path, None)
+                pending.set_exception(e)
+                raise
+
+            with self._lock:
+                self._loading.pop(file_path, None)
+                self.stats['loads'] += 1
+                self._store(file_path, CachedWorkbook(workbook, signature, time.time()))
+            pending.set_result((workbook, signature))
+            return workbook
+
+    def get_sheet(self, file_path):
+        """Active sheet of the workbook"""
+        return self.get_workbook(file_path).active
+
+    def _store(self, file_path, entry):
+        # Called with self._lock held
         current_time = time.time()
-        
-        # Clean expired cache entries
-        expired_keys = [
-            key for key, (wb, timestamp) in excel_cache.items() 
-            if current_time - timestamp > CACHE_EXPIRY
-        ]
-        for key in expired_keys:
-            del excel_cache[key]
-        
-        # Check if file is in cache
-        if file_path in excel_cache:
-            logger.debug(f"Using cached workbook for {file_path}")
-            # Update the timestamp to prevent early expiration of frequently used files
-            excel_cache[file_path] = (excel_cache[file_path][0], current_time)
-            return excel_cache[file_path][0]
-        
-        # If cache is full, remove least frequently accessed entries
-        if len(excel_cache) >= MAX_CACHE_SIZE:
-            # Get access counts for cached files
+        for key in [k for k, e in self._entries.items() if current_time - e.last_used > self.expiry]:
+            del self._entries[key]
+
+        if file_path not in self._entries and len(self._entries) >= self.max_size:
+            # Remove the least frequently accessed workbook
             with access_counts_lock:
-                file_scores = {
-                    path: file_access_counts.get(path, 0) for path in excel_cache.keys()
-                }
-            
-            # Remove least frequently accessed file
-            least_used_key = min(file_scores.keys(), key=lambda k: file_scores[k])
-            del excel_cache[least_used_key]
+                least_used_key = min(self._entries, key=lambda k: file_access_counts.get(k, 0))
+            del self._entries[least_used_key]
+            self.stats['evictions'] += 1
             logger.debug(f"Removed least used file {least_used_key} from cache")
-        
-        # Load workbook and add to cache
-        try:
-            logger.debug(f"Loading workbook from {file_path}")
-            wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
-            excel_cache[file_path] = (wb, current_time)
-            return wb
-        except Exception as e:
-            logger.error(f"Error loading workbook {file_path}: {e}")
-            raise
+
+        self._entries[file_path] = entry
+
+    def invalidate(self, file_path):
+        with self._lock:
+            return self._entries.pop(file_path, None) is not None
+
+    def remove_stale(self):
+        """Drop workbooks whose files were modified or deleted"""
+        with self._lock:
+            cached = {path: entry.signature for path, entry in self._entries.items()}
+        for file_path, signature in cached.items():
+            try:
+                stat = os.stat(file_path)
+                if (stat.st_mtime, stat.st_size) == signature:
+                    continue
+                logger.info(f"Removed {file_path} from cache due to modification")
+            except OSError:
+                pass
+            self.invalidate(file_path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def cached_files(self):
+        with self._lock:
+            return list(self._entries)
+
+
+# Shared provider used by the bot
+default_provider = WorkbookProvider()
+
+
+def get_workbook_provider():
+    """Workbook provider shared by all parsers"""
+    return default_provider
+
+
+def get_cached_workbook(file_path):
+    """
+    Get a cached workbook or load it if not in cache.
+    This avoids repeatedly loading the same Excel files.
+    """
+    return default_provider.get_workbook(file_path)
 
 def clear_excel_cache():
     """Clear the Excel workbook cache."""
-    with excel_cache_lock:
-        excel_cache.clear()
+    default_provider.clear()
     logger.info("Excel cache cleared")
 
 def use_excel_cache(func):
     """
-    Decorator to use cached Excel workbooks in functions that process Excel files.
-    This can significantly improve performance when the same files are accessed repeatedly.
+    Decorator that passes the shared workbook provider to functions that process Excel files.
+    The decorated function must accept a workbook_provider keyword argument.
     """
     @wraps(func)
     def wrapper(file_path, *args, **kwargs):
-        # Replace the openpyxl.load_workbook call with our cached version
-        original_load_workbook = openpyxl.load_workbook
-        
-        try:
-            # Monkey patch the load_workbook function
-            openpyxl.load_workbook = lambda path, **kw: get_cached_workbook(path)
-            
-            # Call the original function
-            return func(file_path, *args, **kwargs)
-        finally:
-            # Restore the original function
-            openpyxl.load_workbook = original_load_workbook
+        kwargs.setdefault('workbook_provider', default_provider)
+        return func(file_path, *args, **kwargs)
     
     return wrapper
 
@@ -145,31 +223,11 @@ def patch_excel_functions():
         # Save the original function
         original_parse_teacher_schedule = было.parse_teacher_schedule
         
-        # Create a wrapped version that uses the cache
+        # Create a wrapped version that reads workbooks through the shared provider
         @wraps(original_parse_teacher_schedule)
         def cached_parse_teacher_schedule(file_path, *args, **kwargs):
-            try:
-                # Use the cached workbook
-                wb = get_cached_workbook(file_path)
-                
-                # Call the original function with our cached workbook
-                # We need to modify how the function is called to use our pre-loaded workbook
-                sheet = wb.active
-                
-                # Extract the other arguments
-                date_str = args[0]
-                teacher_name = args[1]
-                
-                # Implement a simplified version of the parse logic that uses our cached workbook
-                # This is a basic implementation - you may need to adjust based on the actual function
-                group_name = str(sheet.cell(row=1, column=1).value or '').split('группы ')[-1].strip()
-                
-                # Call the original function but with our workbook
-                return original_parse_teacher_schedule(file_path, *args, **kwargs)
-            except Exception as e:
-                logger.error(f"Error in cached parse_teacher_schedule: {e}")
-                # Fall back to the original function
-                return original_parse_teacher_schedule(file_path, *args, **kwargs)
+            kwargs.setdefault('workbook_provider', default_provider)
+            return original_parse_teacher_schedule(file_path, *args, **kwargs)
         
         # Replace the original function with our cached version
         было.parse_teacher_schedule = cached_parse_teacher_schedule
@@ -178,28 +236,10 @@ def patch_excel_functions():
     except Exception as e:
         logger.error(f"Error patching Excel functions: {e}")
 
-# Monitor file changes to invalidate cache when files are updated
-last_modified_times = {}
-
 def check_file_updates():
     """Check if any Excel files have been updated and invalidate cache if needed."""
     try:
-        with excel_cache_lock:
-            for file_path in list(excel_cache.keys()):
-                if os.path.exists(file_path):
-                    current_mtime = os.path.getmtime(file_path)
-                    if file_path in last_modified_times:
-                        if current_mtime > last_modified_times[file_path]:
-                            # File has been modified, remove from cache
-                            del excel_cache[file_path]
-                            logger.info(f"Removed {file_path} from cache due to modification")
-                    last_modified_times[file_path] = current_mtime
-                else:
-                    # File no longer exists, remove from cache
-                    if file_path in excel_cache:
-                        del excel_cache[file_path]
-                    if file_path in last_modified_times:
-                        del last_modified_times[file_path]
+        default_provider.remove_stale()
     except Exception as e:
         logger.error(f"Error checking file updates: {e}")
 
@@ -274,9 +314,8 @@ def preload_excel_files():
                 except Exception as e:
                     logger.error(f"Error preloading {file_path}: {e}")
             
-            # Use ThreadPoolExecutor to load files in parallel
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                executor.map(load_file, prioritized_files)
+            # Load files in the shared scheduler below user requests
+            submit_all(PREFETCH, load_file, prioritized_files)
             
             logger.info(f"Preloaded {len(prioritized_files)} Excel files into cache")
         except Exception as e:
@@ -290,5 +329,4 @@ def preload_excel_files():
 # Async version of get_cached_workbook for use in async code
 async def get_cached_workbook_async(file_path):
     """Async version of get_cached_workbook for use in async code."""
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(excel_io_pool, get_cached_workbook, file_path)
\ No newline at end of file
+    return await run_task(get_cached_workbook, file_path)
\ No newline at end of file
@@ -5,14 +5,11 @@ import signal
 import asyncio
 import nest_asyncio
 import traceback
-import json  # Add this import
-import time
 import platform
 import subprocess
 from было import main as original_main
 from schedule_wrapper import patch_get_teacher_schedule
 from cache_utils import init_cache, selective_cache_clear
-from telegram import Bot  # Add this import
 from teacher_schedule_processor import start_background_processor  # Add this import
 
 # Configure logging
@@ -97,15 +94,13 @@ def patched_signal_handler(sig, frame):
 
 # Initialize subscribers file if it doesn't exist
 def init_subscribers_file():
-    subscribers_file = os.path.join(os.path.dirname(__file__), "subscribers.json")
-    if not os.path.exists(subscribers_file):
-        try:
-            with open(subscribers_file, 'w') as f:
-                json.dump({}, f)
-            logger.info("Created empty subscribers.json file")
-        except Exception as e:
-            logger.error(f"Error creating subscribers file: {e}")
-            logger.error(traceback.format_exc())
+    try:
+        # Opens the subscriber database, importing subscribers.json on first run
+        from subscriber_store import get_subscriber_registry
+        get_subscriber_registry()
+    except Exception as e:
+        logger.error(f"Error initializing subscriber store: {e}")
+        logger.error(traceback.format_exc())
 
 # Patch the было module to ensure json is imported
 def patch_было_module():
@@ -123,71 +118,12 @@ def patch_было_module():
 # Patch the было module to ensure notification checking is properly set up
 def patch_notification_system():
     try:
-        import было
-        
-        async def send_notifications():
-            try:
-                # Only check new_replacements_notify.json
-                notification_file = "new_replacements_notify.json"
-                
-                if os.path.exists(notification_file):
-                    logger.info(f"Found notifications file: {notification_file}")
-                    with open(notification_file, "r", encoding='utf-8') as f:
-                        notification_data = json.load(f)
-                    
-                    message = notification_data.get("message", "")
-                    chat_ids = notification_data.get("chat_ids", [])
-                    
-                    if message and chat_ids:
-                        bot = Bot(token="6280539073:AAHsryeRAeicXw_pPBQB_ME6i1Ku7Bc_IM0")
-                        
-                        for chat_id in chat_ids:
-                            try:
-                                await bot.send_message(
-                                    chat_id=int(chat_id), 
-                                    text=message,
-                                    parse_mode='Markdown'
-                                )
-                                logger.info(f"Notification sent to chat ID {chat_id}")
-                            except Exception as e:
-                                logger.error(f"Error sending notification to chat ID {chat_id}: {e}")
-                        
-                        try:
-                            os.remove(notification_file)
-                            logger.info(f"Notification file {notification_file} deleted after sending")
-                        except Exception as e:
-                            logger.error(f"Error removing notification file {notification_file}: {e}")
-                            
-            except Exception as e:
-                logger.error(f"Error processing notifications: {e}")
-                logger.error(traceback.format_exc())
+        from было import TELEGRAM_TOKEN
+        from broadcast import start_notification_sender
 
-        # Add notification checker thread
-        def start_notification_checker():
-            import threading
-            import time
-            
-            def notification_checker():
-                logger.info("Starting notification checker thread")
-                while True:
-                    try:
-                        # Create event loop for async operation
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        loop.run_until_complete(send_notifications())
-                        loop.close()
-                        time.sleep(30)  # Check every 30 seconds
-                    except Exception as e:
-                        logger.error(f"Error in notification checker thread: {e}")
-                        time.sleep(60)  # Wait longer if there's an error
-            
-            # Start the thread
-            thread = threading.Thread(target=notification_checker, daemon=True)
-            thread.start()
-            logger.info("Notification checker thread started")
-        
-        # Start the notification checker
-        start_notification_checker()
+        # One long-lived event loop sends notifications with rate limiting
+        # and resumes an interrupted broadcast after a restart
+        start_notification_sender(TELEGRAM_TOKEN)
         logger.info("Notification system initialized")
         
     except Exception as e:
@@ -336,6 +272,125 @@ def main():
         logger.error(traceback.format_exc())
         remove_lock_file()
 
+# Updates handled at once. main_direct() has always handled them one at a time;
+# traffic_replay.py --concurrent-updates shows what a higher value would change
+CONCURRENT_UPDATES = 1
+
+def build_application(token, concurrent_updates=CONCURRENT_UPDATES, base_url=None, record_traffic=None):
+    """
+    Create the Application with all command and conversation handlers.
+
+    Used by main_direct() and by traffic_replay.py, which points base_url
+    at a local Bot API stub and passes its own update processor.
+    Traffic is recorded only if record_traffic is True or, when it is None,
+    if traffic_log.TRAFFIC_RECORDING_ENABLED is set.
+    """
+    from telegram.ext import Application
+
+    builder = Application.builder().token(token).concurrent_updates(concurrent_updates)
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
+    
+    # Import all the necessary handlers
+    from было import (
+        start, subscribe_command, unsubscribe_command, manual_clear_cache,
+        classroom_schedule_command, get_my_id, error_handler, cancel,
+        CHOOSE_ACTION, ENTER_CLASSROOM, CHOOSE_DATE_FOR_CLASSROOM,
+        ENTER_TEACHER, CHOOSE_DATE_FOR_TEACHER, ENTER_GROUP, CHOOSE_SUBGROUP,
+        choose_action, enter_classroom, choose_date_for_classroom,
+        enter_teacher, choose_date_for_teacher, group_input, subgroup_choice,
+        handle_all_messages
+    )
+    from telegram.ext import CommandHandler, MessageHandler, filters, ConversationHandler
+    
+    # Apply concurrency to handlers if available
+    try:
+        from bot_concurrency import patch_application_handlers
+        patch_application_handlers(app)
+        logger.info("Applied concurrency patches to application handlers")
+    except Exception as e:
+        logger.error(f"Error patching application handlers: {e}")
+    
+    # Add handlers
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("subscribe", subscribe_command))
+    app.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
+    app.add_handler(CommandHandler("clear_cache", manual_clear_cache))
+    app.add_handler(CommandHandler("classroom", classroom_schedule_command))
+    app.add_handler(CommandHandler("myid", get_my_id))
+    
+    try:
+        from classroom_index import free_rooms_command
+        app.add_handler(CommandHandler("free_rooms", free_rooms_command))
+    except Exception as e:
+        logger.error(f"Error registering free rooms command: {e}")
+
+    # Latency metrics: /stats for admins
+    try:
+        from metrics import stats_command
+        app.add_handler(CommandHandler("stats", stats_command))
+    except Exception as e:
+        logger.error(f"Error registering stats command: {e}")
+    
+    # Add conversation handler
+    conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler('start', start),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, handle_all_messages),
+        ],
+        states={
+            CHOOSE_ACTION: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, choose_action),
+                MessageHandler(filters.Regex('^Отмена$'), cancel)
+            ],
+            ENTER_CLASSROOM: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, enter_classroom),
+                MessageHandler(filters.Regex('^Отмена$'), cancel)
+            ],
+            CHOOSE_DATE_FOR_CLASSROOM: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, choose_date_for_classroom),
+                MessageHandler(filters.Regex('^Отмена$'), cancel)
+            ],
+            ENTER_TEACHER: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, enter_teacher),
+                MessageHandler(filters.Regex('^Отмена$'), cancel)
+            ],
+            CHOOSE_DATE_FOR_TEACHER: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, choose_date_for_teacher),
+                MessageHandler(filters.Regex('^Отмена$'), cancel)
+            ],
+            ENTER_GROUP: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, group_input),
+                MessageHandler(filters.Regex('^Отмена$'), cancel)
+            ],             
+            CHOOSE_SUBGROUP: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, subgroup_choice),
+                MessageHandler(filters.Regex('^Отмена$'), cancel)
+            ],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+    )
+    app.add_handler(conv_handler)
+
+    # Record anonymized updates before any handler sees them
+    try:
+        import traffic_log
+        if record_traffic is None:
+            record_traffic = traffic_log.TRAFFIC_RECORDING_ENABLED
+        if record_traffic:
+            from telegram import Update
+            from telegram.ext import TypeHandler
+            app.add_handler(TypeHandler(Update, traffic_log.record_update), group=-1)
+            logger.info("Traffic recording is enabled")
+    except Exception as e:
+        logger.error(f"Error setting up traffic recording: {e}")
+    
+    # Add error handler
+    app.add_error_handler(error_handler)
+    return app
+
+
 def main_direct():
     """
     A completely standalone version of main() that bypasses
@@ -365,8 +420,19 @@ def main_direct():
         patch_было_module()
         patch_notification_system()
         
-        # Clear and initialize cache
-        selective_cache_clear(reason="startup")
+        # Restore parsed schedules from the snapshot of the previous run
+        snapshot_changes = None
+        try:
+            from store_snapshot import load_snapshot
+            snapshot_changes = load_snapshot()
+        except Exception as e:
+            logger.error(f"Error loading schedule snapshot: {e}")
+
+        # Clear and initialize cache. Cached answers stay valid if no source file changed
+        if snapshot_changes == []:
+            logger.info("Source files are unchanged since the last snapshot, keeping caches")
+        else:
+            selective_cache_clear(reason="startup")
         init_cache()
         
         # Apply concurrency patches
@@ -388,7 +454,26 @@ def main_direct():
             logger.info("Started background teacher schedule processor")
         except Exception as e:
             logger.error(f"Error patching teacher schedule function: {e}")
-        
+
+        # Parse group schedules once into the normalized schedule store
+        try:
+            from schedule_store import patch_schedule_parsers, start_store_loader
+            from replacements_store import patch_load_replacements
+            patch_schedule_parsers()
+            patch_load_replacements()
+            start_store_loader()
+            logger.info("Started schedule store ingestion")
+        except Exception as e:
+            logger.error(f"Error setting up schedule store: {e}")
+
+        # Answer classroom queries from the room occupancy index
+        try:
+            from classroom_index import patch_classroom_schedule
+            patch_classroom_schedule()
+            logger.info("Successfully patched classroom schedule function")
+        except Exception as e:
+            logger.error(f"Error patching classroom schedule function: {e}")
+
         # Setup Excel caching
         try:
             from excel_cache import patch_excel_functions, start_file_monitor, preload_excel_files
@@ -399,89 +484,26 @@ def main_direct():
             start_file_monitor()
             logger.info("Started file monitor thread")
             
-            # Preload Excel files to improve first-time performance
-            preload_excel_files()
-            logger.info("Started Excel file preloading")
+            # Preload Excel files to improve first-time performance.
+            # With an up-to-date snapshot workbooks are only needed by fallbacks
+            if snapshot_changes == []:
+                logger.info("Skipping Excel file preloading, schedules restored from snapshot")
+            else:
+                preload_excel_files()
+                logger.info("Started Excel file preloading")
         except Exception as e:
             logger.error(f"Error setting up Excel caching: {e}")
         
-        # Create a direct application instance
-        from telegram.ext import Application
-        from было import TELEGRAM_TOKEN
-        
-        # Create application instance directly
-        app = Application.builder().token(TELEGRAM_TOKEN).build()
-        
-        # Import all the necessary handlers
-        from было import (
-            start, subscribe_command, unsubscribe_command, manual_clear_cache,
-            classroom_schedule_command, get_my_id, error_handler, cancel,
-            CHOOSE_ACTION, ENTER_CLASSROOM, CHOOSE_DATE_FOR_CLASSROOM,
-            ENTER_TEACHER, CHOOSE_DATE_FOR_TEACHER, ENTER_GROUP, CHOOSE_SUBGROUP,
-            choose_action, enter_classroom, choose_date_for_classroom,
-            enter_teacher, choose_date_for_teacher, group_input, subgroup_choice,
-            handle_all_messages, set_commands
-        )
-        from telegram.ext import CommandHandler, MessageHandler, filters, ConversationHandler
-        
-        # Apply concurrency to handlers if available
+        # Create the application with all handlers
+        from было import TELEGRAM_TOKEN, set_commands
+        app = build_application(TELEGRAM_TOKEN)
+
+        # Local Prometheus endpoint for latency metrics
         try:
-            from bot_concurrency import patch_application_handlers
-            patch_application_handlers(app)
-            logger.info("Applied concurrency patches to application handlers")
+            from metrics import start_metrics_server
+            start_metrics_server()
         except Exception as e:
-            logger.error(f"Error patching application handlers: {e}")
-        
-        # Add handlers
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("subscribe", subscribe_command))
-        app.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
-        app.add_handler(CommandHandler("clear_cache", manual_clear_cache))
-        app.add_handler(CommandHandler("classroom", classroom_schedule_command))
-        app.add_handler(CommandHandler("myid", get_my_id))
-        
-        # Add conversation handler
-        conv_handler = ConversationHandler(
-            entry_points=[
-                CommandHandler('start', start),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_all_messages),
-            ],
-            states={
-                CHOOSE_ACTION: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, choose_action),
-                    MessageHandler(filters.Regex('^Отмена$'), cancel)
-                ],
-                ENTER_CLASSROOM: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, enter_classroom),
-                    MessageHandler(filters.Regex('^Отмена$'), cancel)
-                ],
-                CHOOSE_DATE_FOR_CLASSROOM: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, choose_date_for_classroom),
-                    MessageHandler(filters.Regex('^Отмена$'), cancel)
-                ],
-                ENTER_TEACHER: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, enter_teacher),
-                    MessageHandler(filters.Regex('^Отмена$'), cancel)
-                ],
-                CHOOSE_DATE_FOR_TEACHER: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, choose_date_for_teacher),
-                    MessageHandler(filters.Regex('^Отмена$'), cancel)
-                ],
-                ENTER_GROUP: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, group_input),
-                    MessageHandler(filters.Regex('^Отмена$'), cancel)
-                ],             
-                CHOOSE_SUBGROUP: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, subgroup_choice),
-                    MessageHandler(filters.Regex('^Отмена$'), cancel)
-                ],
-            },
-            fallbacks=[CommandHandler('cancel', cancel)],
-        )
-        app.add_handler(conv_handler)
-        
-        # Add error handler
-        app.add_error_handler(error_handler)
+            logger.error(f"Error starting metrics server: {e}")
         
         # Start command setting
         loop = asyncio.get_event_loop()
@@ -0,0 +1,318 @@
+"""
+Метрики задержек обработки запросов.
+
+Каждый этап обработки (поиск в кэше, загрузка книги, разбор расписания,
+наложение замен, форматирование, отправка в Telegram) записывается в
+гистограмму с разбивкой по виду запроса: группа, преподаватель, кабинет.
+Вид запроса задает точка входа через track_query и передается этапам через
+contextvars, поэтому этапы не знают, для какого запроса они выполняются.
+Этапы вне запросов пользователей (синхронизация, фоновое формирование
+ответов) попадают в вид "background".
+
+Рядом выводится состояние очередей планировщика задач (task_scheduler):
+глубина очереди, выполняемые и отклоненные задачи, ожидание в очереди.
+
+Метрики доступны администраторам командой /stats и в текстовом формате
+Prometheus по адресу http://METRICS_HOST:METRICS_PORT/metrics.
+"""
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import ContextDecorator, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+QUERY_TYPES = ("group", "teacher", "classroom")
+BACKGROUND = "background"
+STAGES = (
+    "total", "cache_lookup", "workbook_load", "sheet_parse",
+    "replacements_merge", "formatting", "telegram_send",
+)
+
+# Границы корзин гистограммы в секундах (как у клиентов Prometheus)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Сколько последних измерений хранится для расчета процентилей
+RECENT_SAMPLES = 2048
+
+_query_type = contextvars.ContextVar("query_type", default=BACKGROUND)
+
+
+class LatencyHistogram:
+    """Гистограмма длительностей с корзинами Prometheus и окном последних измерений"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.recent.append(seconds)
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    self.buckets[index] += 1
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.buckets), self.count, self.total, sorted(self.recent)
+
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)):
+        """Процентили по последним измерениям"""
+        _, _, _, samples = self.snapshot()
+        if not samples:
+            return {}
+        return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in quantiles}
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def _histogram(query_type, stage):
+    key = (query_type, stage)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(key, LatencyHistogram())
+    return histogram
+
+
+def observe(stage, seconds, query_type=None):
+    """Записывает длительность этапа для текущего (или указанного) вида запроса"""
+    _histogram(query_type or _query_type.get(), stage).observe(seconds)
+
+
+def current_query_type():
+    return _query_type.get()
+
+
+class timed(ContextDecorator):
+    """
+    Измеряет длительность этапа; используется как менеджер контекста или декоратор.
+
+        with timed("formatting"):
+            ...
+
+        @timed("sheet_parse")
+        def build_day_schedule(...):
+            ...
+    """
+
+    def __init__(self, stage, query_type=None):
+        self.stage = stage
+        self.query_type = query_type
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self._started, self.query_type)
+        return False
+
+    def _recreate_cm(self):
+        # Декоратор может выполняться вложенно и из нескольких потоков - каждый вызов со своим замером
+        return timed(self.stage, self.query_type)
+
+
+@contextmanager
+def track_query(query_type):
+    """Задает вид запроса для вложенных этапов и записывает общую длительность запроса"""
+    token = _query_type.set(query_type)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("total", time.perf_counter() - started, query_type)
+        _query_type.reset(token)
+
+
+def get_latency_stats():
+    """{(вид запроса, этап): {count, p50, p95, p99, avg}} по всем измерениям"""
+    with _histograms_lock:
+        items = list(_histograms.items())
+    stats = {}
+    for key, histogram in items:
+        _, count, total, samples = histogram.snapshot()
+        if not count:
+            continue
+        entry = {"count": count, "avg": total / count}
+        for q, value in histogram.percentiles().items():
+            entry[f"p{int(q * 100)}"] = value
+        stats[key] = entry
+    return stats
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:.1f}"
+
+
+def format_stats_text():
+    """Текст для команды /stats"""
+    stats = get_latency_stats()
+    if not stats:
+        return "Измерений пока нет"
+
+    lines = ["📊 Задержки, мс (p50 / p95 / p99, количество)"]
+    for query_type in QUERY_TYPES + (BACKGROUND,):
+        rows = [(stage, stats[(query_type, stage)]) for stage in STAGES if (query_type, stage) in stats]
+        if not rows:
+            continue
+        lines.append("")
+        lines.append(f"{query_type}:")
+        for stage, entry in rows:
+            lines.append(f"  {stage}: {_ms(entry['p50'])} / {_ms(entry['p95'])} / {_ms(entry['p99'])}, {entry['count']}")
+
+    try:
+        from cache_utils import get_cache_stats
+        cache_stats = get_cache_stats()
+        if cache_stats:
+            lines.append("")
+            lines.append("Кэш: " + ", ".join(f"{name} {value}" for name, value in sorted(cache_stats.items())))
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики кэша: {e}")
+
+    try:
+        from task_scheduler import get_scheduler_stats
+        lines.append("")
+        lines.append("Планировщик задач (в очереди / выполняется из лимита, отклонено, ожидание p95 мс):")
+        for priority, entry in get_scheduler_stats().items():
+            wait = _ms(entry['wait'][0.95]) if entry['wait'] else "-"
+            lines.append(f"  {priority}: {entry['queued']} / {entry['running']} из {entry['limit']}, "
+                         f"{entry['rejected']}, {wait}")
+    except Exception as e:
+        logger.error(f"Ошибка при получении состояния планировщика задач: {e}")
+
+    try:
+        from single_flight import get_flight_stats
+        for name, flight_stats in sorted(get_flight_stats().items()):
+            if not flight_stats['started']:
+                continue
+            lines.append(f"Объединение запросов {name}: запущено {flight_stats['started']}, "
+                         f"присоединилось {flight_stats['joined']}, таймаутов {flight_stats['timed_out']}")
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики объединения запросов: {e}")
+
+    return "\n".join(lines)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def prometheus_text():
+    """Гистограммы и состояние планировщика в текстовом формате Prometheus"""
+    lines = [
+        "# HELP botmpk_stage_duration_seconds Duration of request processing stages",
+        "# TYPE botmpk_stage_duration_seconds histogram",
+    ]
+    with _histograms_lock:
+        items = sorted(_histograms.items())
+    for (query_type, stage), histogram in items:
+        labels = f'query="{_label(query_type)}",stage="{_label(stage)}"'
+        lines.extend(_histogram_lines("botmpk_stage_duration_seconds", labels, histogram))
+    lines.extend(_scheduler_prometheus_lines())
+    return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name, labels, histogram):
+    buckets, count, total, _ = histogram.snapshot()
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(BUCKETS, buckets):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+    lines.append(f"{name}_sum{{{labels}}} {total}")
+    lines.append(f"{name}_count{{{labels}}} {count}")
+    return lines
+
+
+def _scheduler_prometheus_lines():
+    """Очереди планировщика задач в формате Prometheus"""
+    try:
+        from task_scheduler import get_scheduler
+        scheduler = get_scheduler()
+        stats = scheduler.stats()
+    except Exception as e:
+        logger.error(f"Ошибка при получении состояния планировщика задач: {e}")
+        return []
+
+    lines = []
+    gauges = (
+        ("botmpk_scheduler_queued", "gauge", "Tasks waiting in the scheduler queue", "queued"),
+        ("botmpk_scheduler_running", "gauge", "Tasks running in the scheduler", "running"),
+        ("botmpk_scheduler_limit", "gauge", "Concurrency cap of the priority class", "limit"),
+        ("botmpk_scheduler_completed_total", "counter", "Tasks completed by the scheduler", "completed"),
+        ("botmpk_scheduler_rejected_total", "counter", "Tasks rejected by admission control", "rejected"),
+    )
+    for name, metric_type, help_text, field in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for priority, entry in stats.items():
+            lines.append(f'{name}{{class="{_label(priority)}"}} {entry[field]}')
+    lines.append("# HELP botmpk_scheduler_queue_wait_seconds Time tasks spend in the scheduler queue")
+    lines.append("# TYPE botmpk_scheduler_queue_wait_seconds histogram")
+    for priority, histogram in scheduler.queue_wait.items():
+        lines.extend(_histogram_lines("botmpk_scheduler_queue_wait_seconds", f'class="{_label(priority)}"', histogram))
+    return lines
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+_server = None
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Запускает HTTP-сервер метрик в фоновом потоке (только на локальном адресе)"""
+    global _server
+    if _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    _server.daemon_threads = True
+    thread = threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"Метрики доступны по адресу http://{host}:{port}/metrics")
+    return _server
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handler for /stats command (только для администраторов)"""
+    from было import ADMIN_IDS
+
+    if str(update.effective_user.id) not in ADMIN_IDS:
+        await update.message.reply_text(
+            f"❌ Статистика доступна только администраторам.\n"
+            f"Ваш ID: {update.effective_user.id}"
+        )
+        return
+    await update.message.reply_text(format_stats_text())
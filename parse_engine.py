@@ -0,0 +1,88 @@
+"""
+Движок разбора файлов Excel при сборке поколения расписания.
+
+openpyxl разбирает книги на чистом Python, поэтому потоки при разборе в
+основном ждут GIL. Движок "process" разбирает файлы в отдельных процессах:
+каждый процесс открывает книгу сам и возвращает в основной процесс только
+компактные записи (LessonRecord, ReplacementSheet), объекты openpyxl не
+передаются. Движок "thread" (по умолчанию) разбирает файлы по одному в
+классе текущего контекста планировщика задач, как раньше.
+
+Пул процессов создается на один вызов parse_many (одну сборку поколения) и
+завершается после него: openpyxl не возвращает память системе, а между
+синхронизациями процессы были бы не нужны. max_tasks_per_child не
+используется - в Python 3.11 пул с ним зависает при замене процесса.
+
+Движок выбирается константой PARSE_ENGINE или set_parse_engine; если пул
+процессов не запускается или падает, разбор продолжается движком "thread".
+"""
+import os
+import logging
+import threading
+import multiprocessing
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from task_scheduler import call_task
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ("thread", "process")
+# Движок разбора: "thread" или "process"
+PARSE_ENGINE = "thread"
+# Процессов разбора для движка "process"
+PARSE_PROCESSES = os.cpu_count() or 1
+
+_lock = threading.Lock()
+_engine = PARSE_ENGINE
+_processes = PARSE_PROCESSES
+
+
+def set_parse_engine(engine, processes=None):
+    """Выбирает движок разбора (и число процессов для "process")"""
+    global _engine, _processes
+    if engine not in ENGINES:
+        raise ValueError(f"Неизвестный движок разбора: {engine}")
+    with _lock:
+        _engine = engine
+        _processes = processes or PARSE_PROCESSES
+    logger.info(f"Движок разбора: {engine}" + (f", процессов {_processes}" if engine == "process" else ""))
+
+
+def get_parse_engine():
+    return _engine, (_processes if _engine == "process" else 1)
+
+
+def _call(func, args):
+    """Выполняет разбор и возвращает (успех, результат или текст ошибки)"""
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+
+
+def parse_many(func, args_list):
+    """
+    Выполняет func(*args) для каждого набора аргументов выбранным движком.
+
+    func должна быть функцией уровня модуля (процессы получают ее по имени),
+    а ее результат - сериализуемым через pickle.
+
+    Returns:
+        list: (успех, результат или текст ошибки) в порядке args_list
+    """
+    args_list = list(args_list)
+    if not args_list:
+        return []
+    with _lock:
+        engine, processes = _engine, _processes
+    if engine == "process" and len(args_list) > 1:
+        try:
+            # spawn: процесс бота многопоточный, fork мог бы унаследовать захваченные блокировки
+            with ProcessPoolExecutor(max_workers=min(processes, len(args_list)),
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                return list(pool.map(_call, repeat(func), args_list))
+        except (BrokenProcessPool, OSError) as e:
+            logger.error(f"Пул процессов разбора недоступен, разбор продолжается в потоках: {e}")
+    return [call_task(_call, func, args) for args in args_list]
@@ -0,0 +1,142 @@
+"""
+Заранее сформированные ответы с расписанием групп.
+
+После каждой синхронизации фоновый поток формирует ответ get_schedule_for_days
+для каждой группы и подгруппы и сохраняет готовый текст в кэш расписаний
+студентов, поэтому запрос пользователя сводится к чтению из кэша.
+
+Ответы групп, затронутых изменением, удаляет из кэша инвалидация по
+зависимостям (cache_dependencies); формируются заново только они, ответы
+остальных групп уже лежат в кэше и пропускаются. Готовые ответы живут до
+полуночи: после нее меняется набор ближайших дней.
+
+Тем же проходом заново строятся расписания всех преподавателей
+(teacher_schedule_processor.precompute_teacher_schedules). Вся работа идет
+в классе prefetch планировщика задач (task_scheduler).
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from cache_utils import cache_student_schedule, get_cached_student_schedule
+from schedule_generations import get_generation
+from task_scheduler import PREFETCH, priority_class, call_task
+
+logger = logging.getLogger(__name__)
+
+# Варианты запроса для каждой группы: общее расписание и две подгруппы
+PRERENDER_SUBGROUPS = (None, 1, 2)
+# Сколько групп формируется одновременно (пул потоков общий с запросами пользователей)
+PRERENDER_CONCURRENCY = 2
+
+_state_lock = threading.Lock()
+_running = False
+_pending = False
+_last_stats = {}
+
+
+def prerender_expiration(now=None):
+    """Время жизни готового ответа в секундах - до ближайшей полуночи"""
+    now = now or datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return max(1, int((midnight - now).total_seconds()))
+
+
+def group_names(store):
+    """Названия групп так, как их вводят пользователи (имена файлов расписаний)"""
+    return sorted(os.path.splitext(file_name)[0] for file_name in store.entries)
+
+
+async def prerender_group_schedules(store=None):
+    """
+    Формирует и сохраняет в кэш ответы для всех групп и подгрупп, которых в кэше нет.
+
+    Returns:
+        dict: Количество сформированных ответов, найденных в кэше и групп без расписания
+    """
+    from было import build_schedule_for_days
+
+    if store is None:
+        generation = get_generation()
+        if generation is None:
+            return {}
+        store = generation.store
+
+    semaphore = asyncio.Semaphore(PRERENDER_CONCURRENCY)
+    stats = {'rendered': 0, 'cached': 0, 'missing': 0}
+
+    async def render(group, subgroup):
+        if get_cached_student_schedule(group, subgroup) is not None:
+            stats['cached'] += 1
+            return
+        async with semaphore:
+            await build_schedule_for_days(group, subgroup)
+        # build_schedule_for_days кэширует только найденное расписание
+        text = get_cached_student_schedule(group, subgroup)
+        if text is None:
+            stats['missing'] += 1
+            return
+        cache_student_schedule(group, subgroup, text, expiration=prerender_expiration())
+        stats['rendered'] += 1
+
+    await asyncio.gather(*(
+        render(group, subgroup) for group in group_names(store) for subgroup in PRERENDER_SUBGROUPS
+    ))
+    return stats
+
+
+def _prerender_loop():
+    # Формирование ответов уступает потоки планировщика запросам пользователей
+    with priority_class(PREFETCH):
+        _prerender_passes()
+
+
+def _prerender_passes():
+    global _running, _pending, _last_stats
+    while True:
+        started = time.time()
+        try:
+            stats = asyncio.run(prerender_group_schedules())
+            stats['seconds'] = round(time.time() - started, 2)
+            stats['finished_at'] = time.time()
+            _last_stats = stats
+            logger.info(f"Ответы групп сформированы заранее за {stats['seconds']} секунд: "
+                        f"новых {stats.get('rendered', 0)}, уже в кэше {stats.get('cached', 0)}, "
+                        f"без расписания {stats.get('missing', 0)}")
+        except Exception as e:
+            logger.error(f"Ошибка при формировании ответов групп: {e}")
+        try:
+            from teacher_schedule_processor import precompute_teacher_schedules
+            call_task(precompute_teacher_schedules)
+        except Exception as e:
+            logger.error(f"Ошибка при построении расписаний преподавателей: {e}")
+        with _state_lock:
+            if not _pending:
+                _running = False
+                return
+            _pending = False
+
+
+def start_prerender():
+    """
+    Запускает формирование ответов в фоновом потоке.
+
+    Если формирование уже идет, после его окончания будет выполнен еще один
+    проход, чтобы учесть изменения, опубликованные за это время.
+    """
+    global _running, _pending
+    with _state_lock:
+        if _running:
+            _pending = True
+            return
+        _running = True
+    thread = threading.Thread(target=_prerender_loop, name="prerender", daemon=True)
+    thread.start()
+
+
+def get_prerender_stats():
+    """Результат последнего прохода формирования ответов"""
+    return dict(_last_stats)
@@ -0,0 +1,415 @@
+"""
+Скомпилированные файлы замен.
+
+Каждый файл замен читается один раз и превращается в таблицу
+дата -> группа -> номер пары с разбором по подгруппам, отменами,
+кабинетами и преподавателями. Скомпилированные файлы входят в поколение
+расписания (schedule_generations) и используются расписанием групп,
+преподавателей и кабинетов.
+"""
+import os
+import re
+import copy
+import logging
+from datetime import datetime
+from typing import NamedTuple, Optional, Dict, Tuple, Any
+
+from sheet_grid import load_sheet_grid
+from schedule_store import normalize_room, file_digest
+from parse_engine import parse_many
+
+logger = logging.getLogger(__name__)
+
+# Разделители слов в тексте замены
+TOKEN_SPLIT_PATTERN = re.compile(r'[\s,;()]+')
+# Преподаватель в тексте замены (Фамилия И.О.)
+TEACHER_PATTERN = re.compile(r'[А-ЯЁ][а-яё]+\s+[А-ЯЁ]\.\s?[А-ЯЁ]\.?')
+# Текст отмены: только дефисы и пробелы
+CANCELLATION_PATTERN = re.compile(r'^[-\s]*$')
+
+
+class SubgroupOverride(NamedTuple):
+    """Замена для подгруппы (или для всей группы, если subgroup равен None)"""
+    subgroup: Optional[int]
+    text: str
+    is_cancelled: bool
+    rooms: Tuple[str, ...]
+    teachers: Tuple[str, ...]
+
+
+class LessonOverride(NamedTuple):
+    """Ячейка файла замен: одна пара одной группы на одну дату"""
+    group: str
+    lesson_num: Any
+    text: str
+    parts: Tuple[SubgroupOverride, ...]
+
+    @property
+    def rooms(self):
+        return tuple(room for part in self.parts for room in part.rooms)
+
+    @property
+    def teachers(self):
+        return tuple(teacher for part in self.parts for teacher in part.teachers)
+
+
+class ReplacementSheet(NamedTuple):
+    """Скомпилированный файл замен"""
+    file_path: str
+    mtime: float
+    size: int
+    digest: str
+    # {дата: {группа: {номер пары: текст ячейки}}}
+    cells: Dict[str, Dict[str, Dict[Any, str]]]
+    # {дата: {группа: {номер пары: LessonOverride}}}
+    overrides: Dict[str, Dict[str, Dict[Any, LessonOverride]]]
+    # Замены в формате load_replacements
+    legacy: Dict[str, Dict[str, Dict[Any, dict]]]
+
+
+def is_replacement_file(file_name):
+    """Файлы замен называются по датам: dd.mm.yy-dd.mm.yy.xlsx"""
+    return file_name.endswith('.xlsx') and file_name[0].isdigit()
+
+
+def _parse_file_date(text):
+    for date_format in ('%d.%m.%y', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def replacement_file_dates(file_name, allow_single=False):
+    """
+    Период файла замен по его имени.
+
+    Args:
+        file_name: Имя файла (dd.mm.yy-dd.mm.yy.xlsx, год может быть четырехзначным)
+        allow_single: Принимать также файлы на одну дату (dd.mm.yy.xlsx)
+
+    Returns:
+        tuple: (первая дата, последняя дата) или None, если имя не по формату
+    """
+    parts = os.path.basename(file_name).replace('.xlsx', '').split('-')
+    if len(parts) == 1 and allow_single:
+        parts = parts * 2
+    if len(parts) != 2:
+        return None
+    start_date, end_date = _parse_file_date(parts[0]), _parse_file_date(parts[1])
+    if start_date is None or end_date is None:
+        return None
+    return start_date, end_date
+
+
+def find_replacement_sheet(generation, date_str):
+    """
+    Файл замен поколения, в период которого входит дата (как get_replacements_file,
+    но без обращения к диску: файл, еще не вошедший в поколение, не используется).
+
+    Returns:
+        ReplacementSheet или None
+    """
+    try:
+        target_date = datetime.strptime(date_str, '%d.%m.%Y').date()
+    except ValueError:
+        return None
+    for file_path, sheet in generation.replacement_sheets.items():
+        period = replacement_file_dates(file_path)
+        if period and period[0] <= target_date <= period[1]:
+            return sheet
+    return None
+
+
+def room_tokens(text):
+    """Слова замены, похожие на кабинеты: ключ кабинета -> написание в тексте"""
+    tokens = {}
+    for token in TOKEN_SPLIT_PATTERN.split(text):
+        if not any(ch.isdigit() for ch in token):
+            continue
+        room_key = normalize_room(token)
+        if room_key:
+            tokens.setdefault(room_key, token.rstrip('.,;:'))
+    return tokens
+
+
+def _lesson_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def read_replacement_cells(file_path):
+    """
+    Читает непустые ячейки файла замен.
+
+    Returns:
+        dict: {дата: {группа: {номер пары: текст замены}}}
+    """
+    rows = load_sheet_grid(file_path).rows
+
+    if len(rows) < 2:
+        return {}
+
+    # Группы находятся во второй строке начиная с четвертой колонки
+    groups = {}
+    for idx, value in enumerate(rows[1]):
+        if idx >= 3 and value:
+            groups[idx] = str(value).strip()
+
+    cells = {}
+    current_date = None
+    for row in rows[2:]:
+        date_cell = row[1] if len(row) > 1 else None
+        if date_cell:
+            try:
+                current_date = datetime.strptime(str(date_cell), '%d.%m.%Y').strftime('%d.%m.%Y')
+            except ValueError:
+                continue
+        if not current_date:
+            continue
+
+        lesson_num = row[2] if len(row) > 2 else None
+        if not lesson_num:
+            continue
+        lesson_num = _lesson_number(lesson_num)
+
+        for idx, group_name in groups.items():
+            value = row[idx] if idx < len(row) else None
+            if value:
+                cells.setdefault(current_date, {}).setdefault(group_name, {})[lesson_num] = str(value).strip()
+
+    return cells
+
+
+def _subgroup_entry(subgroup, text):
+    """Запись о замене подгруппы в формате load_replacements"""
+    if not text or CANCELLATION_PATTERN.match(text):
+        return {
+            'status': 'cancelled',
+            'new_data': 'Пара отменена',
+            'subgroup': subgroup,
+            'is_common': False,
+            'is_cancelled': True,
+            'emoji': '❌'
+        }
+    return {
+        'status': 'replaced',
+        'new_data': ' '.join(text.split()),
+        'subgroup': subgroup,
+        'is_common': False
+    }
+
+
+def legacy_replacement(cell_value):
+    """
+    Разбирает ячейку замены так же, как load_replacements.
+
+    Returns:
+        dict: общая замена ({'status': ..., 'subgroup': None, ...})
+              или замены по подгруппам ({1: {...}, 2: {...}})
+    """
+    # Обе подгруппы в одной строке:
+    # "1. ------------                 2. (Лаб) МДК.01.04 Систем.программ. А207 Тутарова В.Д."
+    if '1. ' in cell_value and '2. ' in cell_value:
+        pos_1 = cell_value.find('1. ')
+        pos_2 = cell_value.find('2. ')
+        if pos_1 < pos_2:
+            return {
+                1: _subgroup_entry(1, cell_value[pos_1 + 2:pos_2].strip()),
+                2: _subgroup_entry(2, cell_value[pos_2 + 2:].strip())
+            }
+        return {
+            2: _subgroup_entry(2, cell_value[pos_2 + 2:pos_1].strip()),
+            1: _subgroup_entry(1, cell_value[pos_1 + 2:].strip())
+        }
+
+    lines = [line.strip() for line in cell_value.split('\n') if line.strip()]
+    has_subgroup_markers = any(line.startswith('1. ') or line.startswith('2. ') for line in lines)
+
+    # Если нет маркеров подгрупп или есть (ТО), значит это общая пара
+    if not has_subgroup_markers or cell_value.upper().startswith('(ТО)'):
+        return {
+            'status': 'replaced',
+            'subgroup': None,
+            'new_data': ' '.join(lines),
+            'is_common': True
+        }
+
+    result = {}
+    current_subgroup = None
+    current_data = []
+    for line in lines:
+        if line.startswith('1. ') or line.startswith('2. '):
+            if current_subgroup and current_data:
+                result[current_subgroup] = {
+                    'status': 'replaced',
+                    'new_data': ' '.join(current_data),
+                    'subgroup': current_subgroup,
+                    'is_common': False
+                }
+                current_data = []
+            current_subgroup = int(line[0])
+            current_data.append(line[2:].strip())
+        else:
+            current_data.append(line)
+
+    if current_subgroup and current_data:
+        result[current_subgroup] = {
+            'status': 'replaced',
+            'new_data': ' '.join(current_data),
+            'subgroup': current_subgroup,
+            'is_common': False
+        }
+    return result
+
+
+def _override_part(subgroup, text, is_cancelled):
+    return SubgroupOverride(
+        subgroup,
+        text,
+        is_cancelled,
+        tuple(room_tokens(text)),
+        tuple(TEACHER_PATTERN.findall(text))
+    )
+
+
+def compile_override(group, lesson_num, text, legacy):
+    """Структурированная замена из текста ячейки и ее разбора в формате load_replacements"""
+    if legacy and all(isinstance(key, int) for key in legacy):
+        parts = tuple(
+            _override_part(subgroup, entry['new_data'] if not entry.get('is_cancelled') else '',
+                           bool(entry.get('is_cancelled')))
+            for subgroup, entry in legacy.items()
+        )
+    else:
+        parts = (_override_part(None, text, bool(CANCELLATION_PATTERN.match(text))),)
+    return LessonOverride(group, lesson_num, text, parts)
+
+
+def compile_replacement_sheet(file_path, key_path=None):
+    """
+    Читает и компилирует файл замен.
+
+    Args:
+        file_path: Путь, откуда читать файл
+        key_path: Путь, под которым файл будет лежать в рабочей папке (по умолчанию file_path)
+    """
+    stat = os.stat(file_path)
+    digest = file_digest(file_path)
+    cells = read_replacement_cells(file_path)
+
+    overrides = {}
+    legacy = {}
+    for date_str, groups in cells.items():
+        for group, lessons in groups.items():
+            for lesson_num, text in lessons.items():
+                entry = legacy_replacement(text)
+                legacy.setdefault(date_str, {}).setdefault(group, {})[lesson_num] = entry
+                overrides.setdefault(date_str, {}).setdefault(group, {})[lesson_num] = \
+                    compile_override(group, lesson_num, text, entry)
+
+    return ReplacementSheet(key_path or file_path, stat.st_mtime, stat.st_size, digest, cells, overrides, legacy)
+
+
+def build_sheets(file_paths, old_sheets):
+    """
+    Компилирует файлы замен, переиспользуя неизменившиеся файлы предыдущего поколения.
+
+    Args:
+        file_paths: {путь в рабочей папке: путь, откуда читать файл}
+        old_sheets: Файлы замен предыдущего поколения {путь: ReplacementSheet}
+
+    Returns:
+        tuple: (новые файлы замен, имена добавленных, измененных или удаленных файлов)
+    """
+    sheets = {}
+    changed = []
+    # (путь в рабочей папке, путь для чтения) файлов, которые нужно скомпилировать
+    to_compile = []
+
+    for key_path, file_path in file_paths.items():
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+
+        sheet = old_sheets.get(key_path)
+        if sheet and sheet.mtime == stat.st_mtime and sheet.size == stat.st_size:
+            sheets[key_path] = sheet
+            continue
+
+        try:
+            if sheet and sheet.digest == file_digest(file_path):
+                # Содержимое не изменилось, обновляем только mtime и размер
+                sheets[key_path] = sheet._replace(mtime=stat.st_mtime, size=stat.st_size)
+                continue
+        except OSError as e:
+            logger.error(f"Ошибка при компиляции файла замен {file_path}: {e}")
+            sheets[key_path] = sheet
+            continue
+        to_compile.append((key_path, file_path))
+
+    # Компиляция изменившихся файлов выбранным движком (parse_engine)
+    results = parse_many(compile_replacement_sheet, [(file_path, key_path) for key_path, file_path in to_compile])
+    for (key_path, file_path), (ok, result) in zip(to_compile, results):
+        if not ok:
+            logger.error(f"Ошибка при компиляции файла замен {file_path}: {result}")
+            if key_path in old_sheets:
+                sheets[key_path] = old_sheets[key_path]
+            continue
+        sheets[key_path] = result
+        changed.append(os.path.basename(key_path))
+        logger.info(f"Файл замен {os.path.basename(key_path)} скомпилирован: {len(result.cells)} дат")
+
+    sheets = {key_path: sheets[key_path] for key_path in file_paths if key_path in sheets}
+    changed.extend(os.path.basename(path) for path in old_sheets if path not in sheets)
+    return sheets, changed
+
+
+def get_replacement_sheet(file_path, generation=None):
+    """
+    Возвращает скомпилированный файл замен из поколения расписания.
+
+    Файл, которого нет в поколении (например, синхронизация уже перенесла его
+    в рабочую папку, но еще не опубликовала поколение), не читается с диска.
+
+    Args:
+        file_path: Путь к файлу замен
+        generation: Поколение, с которым работает запрос (по умолчанию актуальное)
+    """
+    from schedule_generations import get_generation
+
+    generation = generation or get_generation()
+    return generation.replacement_sheets.get(file_path)
+
+
+def get_group_replacements(date_str, group, generation):
+    """Замены группы на дату в формате load_replacements (без копирования)"""
+    sheet = find_replacement_sheet(generation, date_str)
+    if not sheet:
+        return {}
+    return sheet.legacy.get(date_str, {}).get(group, {})
+
+
+def cached_load_replacements(replacements_file):
+    """Замена load_replacements: копия скомпилированной таблицы, чтобы вызывающий код мог ее менять"""
+    sheet = get_replacement_sheet(replacements_file)
+    if not sheet:
+        return {}
+    return copy.deepcopy(sheet.legacy)
+
+
+def replacement_sheets():
+    """Файлы замен текущего поколения (пустой словарь, если расписание еще не загружено)"""
+    from schedule_generations import current_generation
+    generation = current_generation()
+    return dict(generation.replacement_sheets) if generation else {}
+
+
+def patch_load_replacements():
+    """Подменяет load_replacements в модуле было на версию со скомпилированными заменами"""
+    import было
+    было.load_replacements = cached_load_replacements
+    logger.info("load_replacements has been patched to use compiled replacement files")
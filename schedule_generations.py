@@ -0,0 +1,244 @@
+"""
+Поколения разобранного расписания.
+
+Поколение - неизменяемый набор данных, собранный из одного состояния
+downloaded_files: хранилище расписаний групп (вместе с индексами
+преподавателей и кабинетов) и скомпилированные файлы замен. Новое поколение
+строится целиком в стороне, а затем публикуется одной заменой указателя.
+
+Запрос берет поколение один раз в начале и до конца работает с ним, даже если
+за это время синхронизация опубликовала следующее. Читатели не берут
+блокировок; старое поколение освобождается сборщиком мусора, когда на него
+не остается ссылок.
+"""
+import os
+import shutil
+import logging
+import threading
+import time
+import weakref
+import itertools
+from types import MappingProxyType
+from typing import Optional
+
+from schedule_store import (
+    DOWNLOADS_DIR, STORE_CHECK_INTERVAL, ScheduleStore, is_schedule_file, build_entries
+)
+from replacements_store import is_replacement_file, build_sheets
+from task_scheduler import SYNC, priority_class
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduleGeneration:
+    """Опубликованное поколение расписания (после создания не изменяется)"""
+
+    __slots__ = ('number', 'created_at', 'reason', 'store', 'replacement_sheets', '__weakref__')
+
+    def __init__(self, number, store, replacement_sheets, reason):
+        self.number = number
+        self.created_at = time.time()
+        self.reason = reason
+        self.store: ScheduleStore = store
+        # {путь к файлу замен: ReplacementSheet}
+        self.replacement_sheets = MappingProxyType(dict(replacement_sheets))
+
+    def __repr__(self):
+        return (f"ScheduleGeneration(#{self.number}, {self.reason}, {len(self.store.entries)} файлов групп, "
+                f"{len(self.replacement_sheets)} файлов замен)")
+
+
+# Текущее поколение. Заменяется целиком, поэтому читатели не берут блокировку.
+_current: Optional[ScheduleGeneration] = None
+# Блокировка только для тех, кто строит и публикует поколения
+_publish_lock = threading.RLock()
+_last_check_time = 0.0
+_generation_numbers = itertools.count(1)
+# Поколения, на которые еще ссылаются незавершенные запросы
+_live_generations = weakref.WeakSet()
+
+
+def current_generation():
+    """Текущее поколение без проверки файлов на диске (None, если расписание еще не загружено)"""
+    return _current
+
+
+def get_generation():
+    """
+    Возвращает текущее поколение, при необходимости сверяя его с файлами на диске.
+
+    Проверку выполняет только один поток; остальные в это время сразу получают
+    текущее поколение, не дожидаясь ее окончания.
+    """
+    if _current is None:
+        refresh_generation()
+    elif time.time() - _last_check_time > STORE_CHECK_INTERVAL and _publish_lock.acquire(blocking=False):
+        try:
+            if time.time() - _last_check_time > STORE_CHECK_INTERVAL:
+                refresh_generation()
+        finally:
+            _publish_lock.release()
+    return _current
+
+
+def live_generation_count():
+    """Сколько поколений еще не освобождено (текущее и используемые запросами)"""
+    return len(_live_generations)
+
+
+def publish_generation(store, replacement_sheets, reason):
+    """Публикует новое поколение и возвращает его"""
+    global _current
+    with _publish_lock:
+        generation = ScheduleGeneration(next(_generation_numbers), store, replacement_sheets, reason)
+        _live_generations.add(generation)
+        _current = generation
+    logger.info(f"Опубликовано поколение расписания {generation!r}; "
+                f"поколений в памяти: {live_generation_count()}")
+    return generation
+
+
+def _list_sources(files_dir):
+    """{имя файла: путь} для файлов расписаний групп и замен в папке"""
+    try:
+        file_names = os.listdir(files_dir)
+    except FileNotFoundError:
+        logger.warning(f"Директория {files_dir} не существует")
+        return {}
+    return {
+        file_name: os.path.join(files_dir, file_name)
+        for file_name in file_names
+        if is_schedule_file(file_name) or is_replacement_file(file_name)
+    }
+
+
+def _build(sources, files_dir, generation):
+    """
+    Собирает данные нового поколения, переиспользуя неизменившиеся файлы предыдущего.
+
+    Args:
+        sources: {имя файла: путь, откуда его читать}
+        files_dir: Папка, в которой файлы будут лежать, пока поколение опубликовано
+        generation: Предыдущее поколение или None
+
+    Returns:
+        tuple: (хранилище, файлы замен, имена изменившихся файлов)
+    """
+    old_entries = generation.store.entries if generation else {}
+    old_sheets = generation.replacement_sheets if generation else {}
+
+    entries, changed = build_entries(
+        {name: path for name, path in sources.items() if is_schedule_file(name)}, old_entries
+    )
+    sheets, changed_sheets = build_sheets(
+        {os.path.join(files_dir, name): path for name, path in sources.items() if is_replacement_file(name)},
+        old_sheets
+    )
+    changed.extend(changed_sheets)
+
+    if generation is None or entries != old_entries:
+        store = ScheduleStore(entries)
+    else:
+        store = generation.store
+    if generation is not None and not changed and sheets == dict(old_sheets) and store is generation.store:
+        return None, None, changed
+    return store, sheets, changed
+
+
+def refresh_generation(files_dir=DOWNLOADS_DIR):
+    """
+    Сверяет текущее поколение с файлами на диске и публикует новое, если они изменились.
+
+    Returns:
+        list: Имена файлов, которые были добавлены, изменены или удалены
+    """
+    global _last_check_time
+    with _publish_lock, priority_class(SYNC):
+        store, sheets, changed = _build(_list_sources(files_dir), files_dir, _current)
+        if store is not None:
+            publish_generation(store, sheets, "refresh")
+        _last_check_time = time.time()
+        return changed
+
+
+def publish_snapshot(store, replacement_sheets, files_dir=DOWNLOADS_DIR):
+    """
+    Публикует первое поколение из снимка (store_snapshot).
+
+    Снимок используется как предыдущее поколение сборки: заново разбираются
+    только файлы, изменившиеся со времени снимка, и в первое поколение сразу
+    попадают все группы и файлы замен.
+
+    Returns:
+        list: Имена файлов, которые добавились, изменились или удалились со времени снимка
+    """
+    global _last_check_time
+    with _publish_lock, priority_class(SYNC):
+        # Поколение снимка не публикуется и нужно только как основа сборки
+        snapshot = ScheduleGeneration(0, store, replacement_sheets, "snapshot")
+        new_store, sheets, changed = _build(_list_sources(files_dir), files_dir, snapshot)
+        if new_store is None:
+            new_store, sheets = store, replacement_sheets
+        publish_generation(new_store, sheets, "snapshot")
+        _last_check_time = time.time()
+        return changed
+
+
+def move_staged_files(staging_dir, removed=(), files_dir=DOWNLOADS_DIR):
+    """Переносит скачанные файлы в рабочую папку и удаляет файлы, пропавшие с сайта"""
+    for file_name in sorted(os.listdir(staging_dir)):
+        if file_name.endswith('.part'):
+            continue
+        try:
+            # os.replace сохраняет mtime, поэтому поколение совпадет с файлом на диске
+            os.replace(os.path.join(staging_dir, file_name), os.path.join(files_dir, file_name))
+        except OSError as e:
+            logger.error(f"Ошибка при переносе файла {file_name}: {e}")
+    for file_name in removed:
+        try:
+            os.remove(os.path.join(files_dir, file_name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Ошибка при удалении файла {file_name}: {e}")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def publish_staged_files(staging_dir, removed=(), files_dir=DOWNLOADS_DIR, reason="sync"):
+    """
+    Разбирает скачанные во временную папку файлы и публикует их как новое поколение.
+
+    Файлы разбираются прямо из временной папки, пока запросы продолжают работать
+    с текущим поколением; затем файлы переносятся в рабочую папку и указатель
+    на поколение заменяется.
+
+    Args:
+        staging_dir: Папка со скачанными файлами
+        removed: Имена файлов, которые нужно удалить из рабочей папки
+        files_dir: Рабочая папка
+        reason: Причина обновления для логов
+
+    Returns:
+        tuple: (предыдущее поколение, опубликованное поколение)
+    """
+    global _last_check_time
+    started = time.time()
+    with _publish_lock:
+        old_generation = _current
+        sources = _list_sources(files_dir)
+        for file_name in removed:
+            sources.pop(file_name, None)
+        sources.update(_list_sources(staging_dir))
+
+        with priority_class(SYNC):
+            store, sheets, changed = _build(sources, files_dir, old_generation)
+        move_staged_files(staging_dir, removed, files_dir)
+
+        new_generation = old_generation
+        if store is not None:
+            new_generation = publish_generation(store, sheets, reason)
+        _last_check_time = time.time()
+
+    logger.info(f"Поколение расписания собрано за {time.time() - started:.2f} секунд, "
+                f"изменилось файлов: {len(changed)}")
+    return old_generation, new_generation
@@ -0,0 +1,550 @@
+"""
+Хранилище нормализованного расписания групп.
+
+Каждый файл расписания группы из downloaded_files разбирается один раз
+в компактный список записей о парах (группа, тип недели, день, номер пары,
+подгруппа, предмет, преподаватель, аудитория). Дальнейшие запросы по группам
+читают готовые записи из словарей вместо повторного открытия Excel.
+"""
+import os
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional, Dict, List, Tuple, Any
+
+from sheet_grid import load_sheet_grid
+from metrics import timed
+from parse_engine import parse_many
+
+logger = logging.getLogger(__name__)
+
+DOWNLOADS_DIR = "downloaded_files"
+
+# Как часто (в секундах) проверять, не изменились ли файлы на диске
+STORE_CHECK_INTERVAL = 30
+
+# Максимальное количество строк, занимаемых одним днем в файле группы
+MAX_DAY_ROWS = 20
+
+DAY_NAMES = {
+    'понедельник': 0,
+    'вторник': 1,
+    'среда': 2,
+    'четверг': 3,
+    'пятница': 4,
+    'суббота': 5
+}
+
+WEEK_TYPE_MARKERS = {
+    'четная неделя': 'четная',
+    'нечетная неделя': 'нечетная'
+}
+
+# Латинские буквы, которые пишут вместо кириллических в номерах кабинетов
+LATIN_TO_CYRILLIC = {
+    'A': 'А', 'B': 'В', 'C': 'С', 'E': 'Е', 'H': 'Н',
+    'K': 'К', 'M': 'М', 'O': 'О', 'P': 'Р', 'T': 'Т', 'X': 'Х'
+}
+
+
+class LessonRecord(NamedTuple):
+    """Одна пара из базового расписания группы"""
+    group: str
+    parity: str                 # 'четная' или 'нечетная'
+    weekday: int                # 0 - понедельник, 5 - суббота
+    lesson_num: Any             # номер пары в том виде, в котором он записан в файле
+    subgroup: Optional[int]     # None - пара для всей группы
+    subject: Any
+    teacher: Any
+    room: Any
+    is_common: bool
+    # Запись только для индекса преподавателей: не попадает в расписание групп и кабинетов
+    teacher_only: bool = False
+
+
+class FileEntry(NamedTuple):
+    """Результат разбора одного файла расписания группы"""
+    file_name: str
+    mtime: float
+    size: int
+    digest: str                 # sha1 содержимого файла
+    group: str
+    records: Tuple[LessonRecord, ...]
+
+
+def file_digest(file_path):
+    """Хэш содержимого файла: по нему узнаем, что файл не изменился, даже если поменялся mtime"""
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def is_schedule_file(file_name):
+    """Проверяет, является ли файл расписанием группы (а не файлом замен)"""
+    return file_name.endswith('.xlsx') and not file_name[0].isdigit()
+
+
+def _lesson_number(value):
+    """Приводит номер пары к int, если это возможно"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def normalize_teacher(teacher):
+    """Ключ преподавателя для индекса: текст ячейки без лишних пробелов в нижнем регистре"""
+    if not teacher:
+        return ''
+    text = ' '.join(str(teacher).split()).lower()
+    return '' if text == 'none' else text
+
+
+def normalize_room(room):
+    """Ключ кабинета: верхний регистр, кириллица вместо латиницы, без точки в конце"""
+    if not room:
+        return ''
+    text = str(room).strip().upper().rstrip('.,;:')
+    if text == 'NONE':
+        return ''
+    for latin, cyrillic in LATIN_TO_CYRILLIC.items():
+        text = text.replace(latin, cyrillic)
+    return text
+
+
+def _parse_lesson_rows(rows, day_col, header_row, group, parity, weekday):
+    """Разбирает пары одного дня так же, как это делает parse_schedule"""
+    from было import is_theory_lesson
+
+    def cell(row, col):
+        # row и col - номера строки и колонки Excel (с единицы)
+        if row - 1 >= len(rows):
+            return None
+        values = rows[row - 1]
+        if col - 1 >= len(values):
+            return None
+        return values[col - 1]
+
+    records = []
+    current_row = header_row + 1
+    while current_row < header_row + MAX_DAY_ROWS:
+        lesson_num = cell(current_row, day_col)
+        if not lesson_num:
+            break
+        lesson_num = _lesson_number(lesson_num)
+
+        subject_first = cell(current_row, day_col + 1)
+        subject_second = cell(current_row, day_col + 3)
+        teacher_first = cell(current_row + 1, day_col + 1)
+        teacher_second = cell(current_row + 1, day_col + 3)
+        room_first = cell(current_row + 1, day_col + 2)
+        room_second = cell(current_row + 1, day_col + 4)
+
+        def make(subgroup, subject, teacher, room, is_common):
+            return LessonRecord(group, parity, weekday, lesson_num, subgroup,
+                                subject, teacher, room, is_common)
+
+        if is_theory_lesson(subject_first):
+            # Общая теоретическая пара - аудитория всегда в правой колонке
+            records.append(make(None, subject_first, teacher_first, room_second, True))
+        else:
+            # Общая практическая пара: одна и та же практика у обеих подгрупп
+            # или практика без второй подгруппы, но с правой аудиторией
+            is_common = False
+            if subject_first and '(пр)' in str(subject_first).lower():
+                if not subject_second:
+                    is_common = bool(room_second)
+                elif subject_second == subject_first:
+                    is_common = True
+
+            if is_common:
+                records.append(make(None, subject_first, teacher_first, room_second, True))
+                # У второй подгруппы свой преподаватель - пара остается и в его расписании
+                if subject_second and normalize_teacher(teacher_second) not in ('', normalize_teacher(teacher_first)):
+                    records.append(make(2, subject_second, teacher_second, room_second, False)._replace(
+                        teacher_only=True))
+            else:
+                if subject_first:
+                    records.append(make(1, subject_first, teacher_first, room_first or room_second, False))
+                if subject_second:
+                    records.append(make(2, subject_second, teacher_second, room_second, False))
+
+        current_row += 2
+
+    return records
+
+
+@timed("sheet_parse")
+def parse_group_rows(rows, file_name):
+    """
+    Превращает ячейки листа расписания группы в список записей о парах.
+
+    Args:
+        rows: Список строк листа (значения ячеек)
+        file_name: Имя файла, используется если в шапке нет названия группы
+
+    Returns:
+        tuple: (название группы, список LessonRecord)
+    """
+    group = os.path.splitext(file_name)[0]
+    if rows and rows[0] and rows[0][0]:
+        header = str(rows[0][0])
+        if 'группы ' in header:
+            group = header.split('группы ')[-1].strip() or group
+
+    records = []
+    parity = None
+    for row_idx, values in enumerate(rows, start=1):
+        if not values:
+            continue
+        marker = str(values[0] or '').strip().lower()
+        if marker in WEEK_TYPE_MARKERS:
+            parity = WEEK_TYPE_MARKERS[marker]
+            continue
+        if parity is None:
+            continue
+        for col_idx, value in enumerate(values, start=1):
+            if not isinstance(value, str):
+                continue
+            weekday = DAY_NAMES.get(value.strip().lower())
+            if weekday is None:
+                continue
+            records.extend(_parse_lesson_rows(rows, col_idx, row_idx, group, parity, weekday))
+
+    return group, records
+
+
+def parse_group_workbook(file_path):
+    """Читает файл расписания группы и возвращает (группа, записи о парах)"""
+    return parse_group_rows(load_sheet_grid(file_path).rows, os.path.basename(file_path))
+
+
+class ScheduleStore:
+    """Неизменяемый срез разобранных файлов расписания с индексами для поиска"""
+
+    def __init__(self, entries: Dict[str, FileEntry]):
+        self.entries = entries
+        # (группа в верхнем регистре, тип недели, день) -> пары
+        self.by_slot: Dict[Tuple[str, str, int], List[LessonRecord]] = {}
+        # имя файла / группа в верхнем регистре -> имя файла
+        self.group_files: Dict[str, str] = {}
+        # преподаватель (текст ячейки в нижнем регистре) -> пары преподавателя
+        self.by_teacher: Dict[str, List[LessonRecord]] = {}
+        self.teacher_display_names: Dict[str, str] = {}
+        self.teacher_file_names: Dict[str, List[str]] = {}
+        # (кабинет, тип недели, день, номер пары) -> пары в кабинете
+        self.by_room: Dict[Tuple[str, str, int, Any], List[LessonRecord]] = {}
+        # (тип недели, день, номер пары) -> занятые кабинеты
+        self.rooms_by_slot: Dict[Tuple[str, int, Any], set] = {}
+        self.room_display_names: Dict[str, str] = {}
+        self.lesson_numbers: set = set()
+
+        for file_name, entry in entries.items():
+            stem = os.path.splitext(file_name)[0]
+            self.group_files[stem.upper()] = file_name
+            self.group_files.setdefault(entry.group.upper(), file_name)
+            for record in entry.records:
+                teacher_key = normalize_teacher(record.teacher)
+                if teacher_key:
+                    self.by_teacher.setdefault(teacher_key, []).append(record)
+                    self.teacher_display_names.setdefault(teacher_key, ' '.join(str(record.teacher).split()))
+                    teacher_files = self.teacher_file_names.setdefault(teacher_key, [])
+                    if file_name not in teacher_files:
+                        teacher_files.append(file_name)
+                if record.teacher_only:
+                    continue
+
+                key = (stem.upper(), record.parity, record.weekday)
+                self.by_slot.setdefault(key, []).append(record)
+
+                self.lesson_numbers.add(record.lesson_num)
+                room_key = normalize_room(record.room)
+                if room_key:
+                    self.room_display_names.setdefault(room_key, str(record.room).strip())
+                    slot = (record.parity, record.weekday, record.lesson_num)
+                    self.by_room.setdefault((room_key,) + slot, []).append(record)
+                    self.rooms_by_slot.setdefault(slot, set()).add(room_key)
+
+    def find_group_file(self, group):
+        """Ищет файл группы без учета регистра (как get_schedule_for_days)"""
+        group_upper = group.upper()
+        if group_upper in self.group_files:
+            return self.group_files[group_upper]
+        for file_name in sorted(self.entries):
+            if file_name.upper().startswith(group_upper):
+                return file_name
+        return None
+
+    def get_group_name(self, file_name):
+        entry = self.entries.get(file_name)
+        return entry.group if entry else None
+
+    def lessons_for(self, file_name, parity, weekday):
+        """Возвращает пары файла группы для типа недели и дня"""
+        stem = os.path.splitext(file_name)[0].upper()
+        return self.by_slot.get((stem, parity, weekday), [])
+
+    def room_lessons(self, room, parity, weekday, lesson_num):
+        """Пары основного расписания в кабинете на конкретную пару"""
+        return self.by_room.get((normalize_room(room), parity, weekday, lesson_num), [])
+
+    def find_teacher_keys(self, teacher_name):
+        """
+        Ключи индекса, подходящие под имя преподавателя.
+
+        Как и в parse_teacher_schedule, имя ищется как подстрока ячейки без учета регистра.
+        """
+        query = normalize_teacher(teacher_name)
+        if not query:
+            return []
+        if query in self.by_teacher:
+            return [query]
+        return [key for key in self.by_teacher if query in key]
+
+    def teacher_lessons(self, teacher_name, parity=None, weekday=None):
+        """Пары преподавателя, при необходимости отфильтрованные по типу недели и дню"""
+        lessons = []
+        for key in self.find_teacher_keys(teacher_name):
+            for record in self.by_teacher[key]:
+                if parity is not None and record.parity != parity:
+                    continue
+                if weekday is not None and record.weekday != weekday:
+                    continue
+                lessons.append(record)
+        return lessons
+
+    def teacher_groups(self, teacher_name):
+        """Группы, в расписании которых встречается преподаватель"""
+        groups = []
+        for record in self.teacher_lessons(teacher_name):
+            if record.group not in groups:
+                groups.append(record.group)
+        return groups
+
+    def teacher_files(self):
+        """Преподаватель -> список файлов, где он встречается"""
+        return {
+            self.teacher_display_names[key]: list(file_names)
+            for key, file_names in self.teacher_file_names.items()
+        }
+
+
+def build_entries(file_paths, old_entries):
+    """
+    Разбирает файлы расписаний групп, переиспользуя записи неизменившихся файлов.
+
+    Args:
+        file_paths: {имя файла: путь, откуда его читать}
+        old_entries: Записи предыдущего среза {имя файла: FileEntry}
+
+    Returns:
+        tuple: (новые записи, имена добавленных, измененных или удаленных файлов)
+    """
+    new_entries = {}
+    changed = []
+    # (имя файла, путь, stat, хэш) файлов, которые нужно разобрать
+    to_parse = []
+
+    for file_name, file_path in file_paths.items():
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+
+        old_entry = old_entries.get(file_name)
+        if old_entry and old_entry.mtime == stat.st_mtime and old_entry.size == stat.st_size:
+            new_entries[file_name] = old_entry
+            continue
+
+        try:
+            digest = file_digest(file_path)
+        except OSError as e:
+            logger.error(f"Ошибка при разборе файла расписания {file_name}: {e}")
+            if old_entry:
+                new_entries[file_name] = old_entry
+            continue
+        if old_entry and old_entry.digest == digest:
+            # Файл скачали заново, но содержимое то же - разбирать не нужно
+            new_entries[file_name] = old_entry._replace(mtime=stat.st_mtime, size=stat.st_size)
+            continue
+        to_parse.append((file_name, file_path, stat, digest))
+
+    # Разбор изменившихся файлов выбранным движком (parse_engine)
+    results = parse_many(parse_group_workbook, [(file_path,) for _, file_path, _, _ in to_parse])
+    for (file_name, file_path, stat, digest), (ok, result) in zip(to_parse, results):
+        if not ok:
+            logger.error(f"Ошибка при разборе файла расписания {file_name}: {result}")
+            if file_name in old_entries:
+                new_entries[file_name] = old_entries[file_name]
+            continue
+        group, records = result
+        new_entries[file_name] = FileEntry(file_name, stat.st_mtime, stat.st_size, digest, group, tuple(records))
+        changed.append(file_name)
+
+    # Порядок файлов как в file_paths: от него зависят индексы хранилища
+    new_entries = {file_name: new_entries[file_name] for file_name in file_paths if file_name in new_entries}
+    changed.extend(f for f in old_entries if f not in new_entries)
+    if changed:
+        logger.info(f"Разобрано файлов расписаний групп: {len(new_entries)}, изменено {len(changed)}")
+    return new_entries, changed
+
+
+def current_store():
+    """Хранилище текущего поколения без проверки файлов на диске (None, если еще не загружено)"""
+    from schedule_generations import current_generation
+    generation = current_generation()
+    return generation.store if generation else None
+
+
+def get_store():
+    """Хранилище актуального поколения расписания"""
+    from schedule_generations import get_generation
+    return get_generation().store
+
+
+def get_group_name(file_path):
+    """Название группы из шапки файла расписания"""
+    return get_store().get_group_name(os.path.basename(file_path))
+
+
+def get_date_parity_and_weekday(date_str):
+    """Тип недели и номер дня недели для даты в формате dd.mm.YYYY"""
+    from было import get_week_type
+    date_obj = datetime.strptime(date_str, '%d.%m.%Y')
+    return get_week_type(date_str), date_obj.weekday()
+
+
+@timed("sheet_parse")
+def build_day_schedule(file_path, date_str, selected_subgroup=None, store=None):
+    """
+    Собирает расписание группы на дату из хранилища.
+
+    Формат результата совпадает с parse_schedule, поэтому его можно передавать
+    в format_schedule и в обработку замен без изменений.
+    """
+    file_name = os.path.basename(file_path)
+    store = store or get_store()
+    if file_name not in store.entries:
+        return {}
+
+    parity, weekday = get_date_parity_and_weekday(date_str)
+    schedule = {}
+    for record in store.lessons_for(file_name, parity, weekday):
+        if record.is_common:
+            schedule[record.lesson_num] = {
+                'subject': record.subject,
+                'teacher': record.teacher,
+                'room': record.room,
+                'is_common': True,
+                'subgroup': None
+            }
+            continue
+
+        if selected_subgroup is not None and selected_subgroup != record.subgroup:
+            continue
+        lesson_key = f"{record.lesson_num}_{record.subgroup}" if selected_subgroup is None else record.lesson_num
+        schedule[lesson_key] = {
+            'subject': record.subject,
+            'teacher': record.teacher,
+            'room': record.room,
+            'is_common': False,
+            'subgroup': record.subgroup,
+            'original_num': record.lesson_num
+        }
+    return schedule
+
+
+def store_parse_schedule(file_path, date_str, selected_subgroup=None):
+    """Замена parse_schedule, читающая расписание из хранилища"""
+    try:
+        return build_day_schedule(file_path, date_str, selected_subgroup)
+    except Exception as e:
+        logger.error(f"Ошибка при получении расписания из хранилища: {e}")
+        return {}
+
+
+def apply_group_replacements(schedule, group_replacements, group_name, selected_subgroup=None):
+    """
+    Накладывает замены группы на ее расписание на дату (изменяет schedule на месте).
+
+    Args:
+        schedule: Расписание из build_day_schedule
+        group_replacements: Замены группы на дату в формате load_replacements
+        group_name: Название группы
+        selected_subgroup: Подгруппа или None
+
+    Returns:
+        dict: schedule
+    """
+    # Таблица замен общая для всех запросов, поэтому записи копируются
+    for lesson_num, replacement_data in group_replacements.items():
+        # Замены для разных подгрупп
+        if isinstance(replacement_data, dict) and any(isinstance(k, int) for k in replacement_data.keys()):
+            for subgroup, replacement in replacement_data.items():
+                if selected_subgroup is None or selected_subgroup == subgroup:
+                    lesson_key = f"{lesson_num}_{subgroup}" if selected_subgroup is None else lesson_num
+                    replacement = dict(replacement)
+                    replacement['original_num'] = lesson_num
+                    replacement['is_replacement'] = True
+                    replacement['group'] = group_name
+                    schedule[lesson_key] = replacement
+        else:
+            # Замена для всей группы
+            replacement_subgroup = replacement_data.get('subgroup')
+            if selected_subgroup is None or replacement_subgroup is None or replacement_subgroup == selected_subgroup:
+                schedule[lesson_num] = dict(replacement_data)
+
+    return schedule
+
+
+def store_process_schedule_with_replacements(schedule_file, replacements_file, date_str, selected_subgroup=None):
+    """Замена process_schedule_with_replacements без повторного открытия файла группы"""
+    schedule = {}
+    try:
+        from schedule_generations import get_generation
+        from replacements_store import get_group_replacements
+
+        # Расписание и замены берутся из одного поколения, даже если во время
+        # запроса синхронизация опубликует следующее
+        generation = get_generation()
+        schedule = build_day_schedule(schedule_file, date_str, selected_subgroup, generation.store)
+        group_name = generation.store.get_group_name(os.path.basename(schedule_file))
+
+        with timed("replacements_merge"):
+            group_replacements = get_group_replacements(date_str, group_name, generation)
+            return apply_group_replacements(schedule, group_replacements, group_name, selected_subgroup)
+
+    except Exception as e:
+        logger.error(f"Ошибка при обработке замен из хранилища: {e}")
+        return schedule
+
+
+def start_store_loader():
+    """Запускает первичную загрузку хранилища в фоновом потоке"""
+    def loader():
+        try:
+            from schedule_generations import refresh_generation
+            from store_snapshot import save_snapshot
+            started = time.time()
+            refresh_generation()
+            save_snapshot()
+            logger.info(f"Хранилище расписаний загружено за {time.time() - started:.2f} секунд")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке хранилища расписаний: {e}")
+
+    thread = threading.Thread(target=loader, daemon=True)
+    thread.start()
+
+
+def patch_schedule_parsers():
+    """
+    Подменяет функции разбора расписания групп в модуле было на версии,
+    работающие с хранилищем.
+    """
+    import было
+    было.parse_schedule = store_parse_schedule
+    было.process_schedule_with_replacements = store_process_schedule_with_replacements
+    logger.info("Group schedule parsers have been patched to use the schedule store")
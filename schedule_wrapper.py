@@ -11,11 +11,13 @@ from teacher_schedule_processor import (
     preload_teacher_schedules,
     get_teacher_schedule_with_index,
     build_schedule_index,
-    precache_popular_teachers
+    precache_teacher_schedules
 )
 from было import get_teacher_schedule as original_get_teacher_schedule
 from было import parse_teacher_schedule, format_teacher_schedule, run_blocking
 from cache_utils import get_cached_teacher_schedule, cache_teacher_schedule
+from single_flight import get_flight_group
+from metrics import track_query
 
 logger = logging.getLogger(__name__)
 
@@ -37,31 +39,16 @@ def is_replacement_file(filename):
     
     return False
 
-# Dictionary to track ongoing teacher schedule requests
-ongoing_requests = {}
-ongoing_requests_lock = threading.Lock()
-REQUEST_TIMEOUT = 45  # Seconds to wait before considering a request as hung
+# Concurrent identical teacher requests share one build
+REQUEST_TIMEOUT = 75  # Seconds before a shared request is considered hung (index 40s + fallback 30s)
+teacher_flights = get_flight_group("teacher", REQUEST_TIMEOUT)
 
 # Flag to track if we've done initial setup
 initial_setup_done = False
 initial_setup_lock = threading.Lock()
 
-def timeout_checker(key, start_time):
-    """Check if a request has been running too long and remove it from ongoing_requests"""
-    with ongoing_requests_lock:
-        if key in ongoing_requests and ongoing_requests[key]['start_time'] == start_time:
-            if (datetime.now() - start_time).total_seconds() > REQUEST_TIMEOUT:
-                logger.warning(f"Request timed out for {key}. Removing from ongoing requests.")
-                # Resolve the future with an error message to unblock any waiting clients
-                if not ongoing_requests[key]['future'].done():
-                    teacher_name = key.split('_')[0]  # Extract teacher name from the key
-                    ongoing_requests[key]['future'].set_result(
-                        f"Не удалось получить расписание для {teacher_name} из-за таймаута. Пожалуйста, попробуйте позже."
-                    )
-                del ongoing_requests[key]
-
 async def do_initial_setup():
-    """Initialize the index and cache popular teachers"""
+    """Initialize the index and precompute schedules of all teachers"""
     global initial_setup_done
     
     # Use a lock to prevent multiple threads from doing setup simultaneously
@@ -72,11 +59,11 @@ async def do_initial_setup():
         logger.info("Building schedule index...")
         await build_schedule_index()
         
-        # Start precaching popular teachers in the background
-        asyncio.create_task(precache_popular_teachers())
+        # Start precomputing schedules of all teachers in the background
+        asyncio.create_task(precache_teacher_schedules())
         
         initial_setup_done = True
-        logger.info("Initial setup completed - schedule index built and started preloading popular teachers")
+        logger.info("Initial setup completed - schedule index built and started precomputing teacher schedules")
 
 async def get_teacher_schedule(teacher_name: str, start_date: str, end_date: str) -> str:
     """Patched version of the teacher schedule retrieval function that uses optimized implementation"""
@@ -123,133 +110,15 @@ async def get_teacher_schedule(teacher_name: str, start_date: str, end_date: str
                     logger.error(f"Error processing single date file {file}: {e}")
                     continue
         
-        # Create a unique key for this request
-        request_key = f"{teacher_name}_{start_date}_{end_date}"
-        start_time = datetime.now()
-        
-        # Check if this request is already ongoing
-        with ongoing_requests_lock:
-            if request_key in ongoing_requests:
-                # Get the existing future
-                existing_request = ongoing_requests[request_key]
-                # Check if the request has been running for too long
-                if (datetime.now() - existing_request['start_time']).total_seconds() > REQUEST_TIMEOUT:
-                    logger.warning(f"Request for {request_key} appears to be hanging. Creating a new request.")
-                    # Create a new future
-                    future = asyncio.Future()
-                    ongoing_requests[request_key] = {
-                        'future': future,
-                        'start_time': start_time
-                    }
-                    # Schedule a timeout check
-                    asyncio.get_event_loop().call_later(
-                        REQUEST_TIMEOUT, 
-                        lambda: timeout_checker(request_key, start_time)
-                    )
-                else:
-                    logger.info(f"Joining existing request for {teacher_name} from {start_date} to {end_date}")
-                    try:
-                        # Add a timeout to waiting for the existing request
-                        return await asyncio.wait_for(existing_request['future'], timeout=30)
-                    except asyncio.TimeoutError:
-                        logger.warning(f"Timeout waiting for existing request for {teacher_name}")
-                        # Clear the ongoing request
-                        with ongoing_requests_lock:
-                            ongoing_requests.pop(request_key, None)
-            else:
-                # Create a new future for this request
-                future = asyncio.Future()
-                ongoing_requests[request_key] = {
-                    'future': future,
-                    'start_time': start_time
-                }
-                # Schedule a timeout check
-                asyncio.get_event_loop().call_later(
-                    REQUEST_TIMEOUT, 
-                    lambda: timeout_checker(request_key, start_time)
-                )
-        
-        # Use the indexed version with a timeout
-        try:
-            logger.info(f"Using indexed teacher schedule for {teacher_name}")
-            
-            # Add a timeout to the indexed method
-            result = await asyncio.wait_for(
-                get_teacher_schedule_with_index(teacher_name, start_date, end_date),
-                timeout=40  # 40 seconds max wait
-            )
-            
-            # Complete the future with the result
-            with ongoing_requests_lock:
-                if request_key in ongoing_requests and not ongoing_requests[request_key]['future'].done():
-                    ongoing_requests[request_key]['future'].set_result(result)
-                    # Remove the request after a short delay to allow other waiters to get the result
-                    asyncio.get_event_loop().call_later(
-                        5, 
-                        lambda: ongoing_requests.pop(request_key, None)
-                    )
-            
-            return result
-        except asyncio.TimeoutError:
-            logger.error(f"Timeout using indexed method for {teacher_name}")
-            
-            # Try a simplified fallback method that directly searches only replacement files
-            # This is much faster but less comprehensive
-            simple_result = await get_simple_teacher_schedule(teacher_name, start_date, end_date)
-            
-            # Complete the future with the result
-            with ongoing_requests_lock:
-                if request_key in ongoing_requests and not ongoing_requests[request_key]['future'].done():
-                    ongoing_requests[request_key]['future'].set_result(simple_result)
-                    # Remove the request
-                    ongoing_requests.pop(request_key, None)
-            
-            return simple_result
-        except Exception as e:
-            logger.error(f"Error using indexed method for {teacher_name}: {e}")
-            logger.info(f"Falling back to optimized method")
-            
-            try:
-                # Use the optimized method with a timeout
-                result = await asyncio.wait_for(
-                    get_teacher_schedule_optimized(teacher_name, start_date, end_date),
-                    timeout=30  # 30 seconds timeout
-                )
-                
-                # Complete the future with the result
-                with ongoing_requests_lock:
-                    if request_key in ongoing_requests and not ongoing_requests[request_key]['future'].done():
-                        ongoing_requests[request_key]['future'].set_result(result)
-                        # Remove the request after a short delay to allow other waiters to get the result
-                        asyncio.get_event_loop().call_later(
-                            5, 
-                            lambda: ongoing_requests.pop(request_key, None)
-                        )
-                
-                return result
-            except (asyncio.TimeoutError, Exception) as e:
-                # Try a simplified fallback method that directly searches only replacement files
-                logger.error(f"Error or timeout in optimized method: {e}")
-                simple_result = await get_simple_teacher_schedule(teacher_name, start_date, end_date)
-                
-                # Complete the future with the result
-                with ongoing_requests_lock:
-                    if request_key in ongoing_requests and not ongoing_requests[request_key]['future'].done():
-                        ongoing_requests[request_key]['future'].set_result(simple_result)
-                        # Remove the request
-                        ongoing_requests.pop(request_key, None)
-                
-                return simple_result
-            
+        # Normalized key: the same teacher and range typed differently joins one request
+        request_key = (" ".join(teacher_name.split()).lower(), start_date, end_date)
+        with track_query("teacher"):
+            return await teacher_flights.do(request_key, build_teacher_schedule, teacher_name, start_date, end_date)
+    except asyncio.TimeoutError:
+        logger.warning(f"Request timed out for {teacher_name} from {start_date} to {end_date}")
+        return f"Не удалось получить расписание для {teacher_name} из-за таймаута. Пожалуйста, попробуйте позже."
     except Exception as e:
         logger.error(f"Error in patched get_teacher_schedule: {e}")
-        # Mark the future as failed (if it exists)
-        with ongoing_requests_lock:
-            if request_key in ongoing_requests and not ongoing_requests[request_key]['future'].done():
-                ongoing_requests[request_key]['future'].set_exception(e)
-                # Remove the request
-                ongoing_requests.pop(request_key, None)
-        
         # As a last resort, try a simplified method
         try:
             return await get_simple_teacher_schedule(teacher_name, start_date, end_date)
@@ -257,6 +126,38 @@ async def get_teacher_schedule(teacher_name: str, start_date: str, end_date: str
             # If all else fails, return an error message
             return f"Не удалось получить расписание для {teacher_name}. Пожалуйста, попробуйте позже."
 
+async def build_teacher_schedule(teacher_name: str, start_date: str, end_date: str) -> str:
+    """Build the teacher schedule once for all concurrent identical requests"""
+    # Use the indexed version with a timeout
+    try:
+        logger.info(f"Using indexed teacher schedule for {teacher_name}")
+
+        # Add a timeout to the indexed method
+        return await asyncio.wait_for(
+            get_teacher_schedule_with_index(teacher_name, start_date, end_date),
+            timeout=40  # 40 seconds max wait
+        )
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout using indexed method for {teacher_name}")
+
+        # Try a simplified fallback method that directly searches only replacement files
+        # This is much faster but less comprehensive
+        return await get_simple_teacher_schedule(teacher_name, start_date, end_date)
+    except Exception as e:
+        logger.error(f"Error using indexed method for {teacher_name}: {e}")
+        logger.info(f"Falling back to optimized method")
+
+        try:
+            # Use the optimized method with a timeout
+            return await asyncio.wait_for(
+                get_teacher_schedule_optimized(teacher_name, start_date, end_date),
+                timeout=30  # 30 seconds timeout
+            )
+        except (asyncio.TimeoutError, Exception) as e:
+            # Try a simplified fallback method that directly searches only replacement files
+            logger.error(f"Error or timeout in optimized method: {e}")
+            return await get_simple_teacher_schedule(teacher_name, start_date, end_date)
+
 async def get_simple_teacher_schedule(teacher_name: str, start_date: str, end_date: str) -> str:
     """Simplified fallback method that only checks replacement files - very fast but may miss some lessons"""
     try:
@@ -376,8 +277,5 @@ def log_execution_time(func):
 # Function to cancel all ongoing teacher schedule requests
 def cancel_all_schedule_requests():
     """Cancel all ongoing teacher schedule requests."""
-    with ongoing_requests_lock:
-        for key, task in list(ongoing_requests.items()):
-            task.cancel()
-        ongoing_requests.clear()
-    logger.info("Cancelled all ongoing teacher schedule requests") 
\ No newline at end of file
+    teacher_flights.cancel_all()
+    logger.info("Cancelled all ongoing teacher schedule requests")
@@ -0,0 +1,124 @@
+"""
+Листы Excel в виде неизменяемой таблицы значений.
+
+Активный лист читается один раз через iter_rows(values_only=True) в кортежи
+(строки интернируются), после чего sheet.cell(row, column) - это обращение по
+индексу, а не повторный проход по XML, как в режиме read_only. Для поиска дня
+недели заранее строится таблица (тип недели, день) -> (колонка, строка),
+поэтому find_day_column не перебирает лист при каждом вызове.
+
+SheetGrid повторяет ту часть API листа openpyxl, которой пользуются парсеры
+(cell, max_row, max_column, iter_rows), и безопасен для чтения из нескольких потоков.
+"""
+import sys
+import threading
+from typing import NamedTuple, Any, Dict, Tuple, Optional
+
+import openpyxl
+
+from metrics import timed
+
+WEEK_TYPE_TEXTS = ("четная неделя", "нечетная неделя")
+
+# Сколько строк после маркера недели просматривает find_day_column
+DAY_SEARCH_ROWS = 30
+
+
+class GridCell(NamedTuple):
+    """Ячейка таблицы: только значение, как у ячейки openpyxl в режиме values_only"""
+    value: Any
+
+
+EMPTY_CELL = GridCell(None)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class SheetGrid:
+    """Неизменяемая таблица значений листа (нумерация строк и колонок с единицы, как в openpyxl)"""
+
+    def __init__(self, rows, title=None):
+        self.rows: Tuple[tuple, ...] = tuple(tuple(_intern(value) for value in row) for row in rows)
+        self.title = title
+        self.max_row = len(self.rows)
+        self.max_column = max((len(row) for row in self.rows), default=0)
+        self._day_anchors: Optional[Dict[Tuple[str, str], Tuple[int, int]]] = None
+        self._anchors_lock = threading.Lock()
+
+    def value(self, row, column):
+        if row < 1 or column < 1 or row > self.max_row:
+            return None
+        values = self.rows[row - 1]
+        if column > len(values):
+            return None
+        return values[column - 1]
+
+    def cell(self, row, column):
+        value = self.value(row, column)
+        return EMPTY_CELL if value is None else GridCell(value)
+
+    def iter_rows(self, min_row=1, max_row=None, values_only=True):
+        """Строки таблицы (только значения)"""
+        for values in self.rows[min_row - 1:max_row]:
+            yield values
+
+    def _build_day_anchors(self):
+        """
+        Таблица (тип недели, текст ячейки) -> (колонка, строка) первого совпадения
+        в том же порядке обхода, что и у find_day_column.
+        """
+        anchors = {}
+        for week_type_text in WEEK_TYPE_TEXTS:
+            week_rows = [
+                row for row in range(1, self.max_row)
+                if str(self.value(row, 1) or '').strip().lower() == week_type_text
+            ]
+            for week_row in week_rows:
+                for row in range(week_row, min(week_row + DAY_SEARCH_ROWS, self.max_row)):
+                    for col in range(1, self.max_column + 1):
+                        text = str(self.value(row, col) or '').strip().lower()
+                        if text:
+                            anchors.setdefault((week_type_text, text), (col, row))
+        return anchors
+
+    def find_day(self, day_name, is_even_week):
+        """
+        Колонка и строка заголовка дня недели (как find_day_column).
+
+        Returns:
+            tuple: (колонка, строка) или (None, None)
+        """
+        if self._day_anchors is None:
+            with self._anchors_lock:
+                if self._day_anchors is None:
+                    self._day_anchors = self._build_day_anchors()
+        week_type_text = WEEK_TYPE_TEXTS[0] if is_even_week else WEEK_TYPE_TEXTS[1]
+        return self._day_anchors.get((week_type_text, day_name.lower()), (None, None))
+
+
+class GridWorkbook:
+    """Книга с единственным листом-таблицей (парсерам нужен только активный лист)"""
+
+    def __init__(self, sheet: SheetGrid):
+        self.active = sheet
+
+    def close(self):
+        pass
+
+
+@timed("workbook_load")
+def load_sheet_grid(file_path):
+    """Читает активный лист файла в SheetGrid"""
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheet = wb.active
+        return SheetGrid(sheet.iter_rows(values_only=True), sheet.title)
+    finally:
+        wb.close()
+
+
+def load_grid_workbook(file_path):
+    """Читает файл в GridWorkbook"""
+    return GridWorkbook(load_sheet_grid(file_path))
@@ -0,0 +1,143 @@
+"""
+Объединение одинаковых одновременных запросов (single-flight).
+
+Если несколько пользователей одновременно запрашивают одно и то же
+расписание, оно строится один раз: первый запрос запускает задачу, остальные
+ждут ее результата. Ключ запроса нормализуется, поэтому "ИП-21" и " ИП-21 "
+попадают в одну задачу.
+
+Задача выполняется отдельно от ожидающих: отмена одного ожидающего (например,
+пользователь ушел из диалога) не отменяет задачу для остальных. Время работы
+задачи ограничено таймаутом; по его истечении все ожидающие получают
+asyncio.TimeoutError, и следующий запрос с тем же ключом запускает задачу заново.
+"""
+import asyncio
+import logging
+import threading
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# Таймаут задачи по умолчанию, секунд
+DEFAULT_TIMEOUT = 45
+
+
+class SingleFlight:
+    """Выполняемые задачи по ключам запроса"""
+
+    def __init__(self, name, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+        # {ключ: asyncio.Task}
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.started = 0
+        self.joined = 0
+        self.timed_out = 0
+
+    async def do(self, key, func, *args, timeout=None, **kwargs):
+        """
+        Возвращает результат func(*args, **kwargs), объединяя одновременные вызовы с одним ключом.
+
+        Args:
+            key: Нормализованный ключ запроса
+            func: Асинхронная функция, строящая результат
+            timeout: Таймаут для этого ключа (по умолчанию - таймаут объекта)
+
+        Raises:
+            asyncio.TimeoutError: Если задача не завершилась за отведенное время
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._flights.get(key)
+            # Задачу другого цикла событий (например, потока рассылки) ждать нельзя
+            if task is None or task.done() or task.get_loop() is not loop:
+                task = loop.create_task(self._run(key, func, args, kwargs, timeout or self.timeout))
+                task.add_done_callback(lambda finished: self._forget(key, finished))
+                self._flights[key] = task
+                self.started += 1
+            else:
+                self.joined += 1
+                logger.info(f"{self.name}: присоединение к выполняющемуся запросу {key}")
+        # shield: отмена ожидающего не отменяет общую задачу
+        return await asyncio.shield(task)
+
+    async def _run(self, key, func, args, kwargs, timeout):
+        try:
+            return await asyncio.wait_for(func(*args, **kwargs), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            logger.warning(f"{self.name}: запрос {key} не выполнен за {timeout} секунд")
+            raise
+
+    def _forget(self, key, task):
+        with self._lock:
+            if self._flights.get(key) is task:
+                del self._flights[key]
+        # Забираем исключение, даже если все ожидающие уже отменены
+        if not task.cancelled():
+            task.exception()
+
+    def cancel_all(self):
+        """Отменяет все выполняющиеся задачи"""
+        with self._lock:
+            tasks = list(self._flights.values())
+            self._flights.clear()
+        for task in tasks:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+        return len(tasks)
+
+    def in_flight(self):
+        return len(self._flights)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight(),
+            "started": self.started,
+            "joined": self.joined,
+            "timed_out": self.timed_out,
+        }
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def get_flight_group(name, timeout=DEFAULT_TIMEOUT):
+    """Общий SingleFlight для вида запросов (создается при первом обращении)"""
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight(name, timeout)
+        return _groups[name]
+
+
+def coalesced(name, key_func, timeout=DEFAULT_TIMEOUT):
+    """
+    Декоратор асинхронной функции запроса: одновременные вызовы с одинаковым
+    ключом key_func(*args, **kwargs) выполняются один раз.
+    """
+    def decorator(func):
+        flights = get_flight_group(name, timeout)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await flights.do(key_func(*args, **kwargs), func, *args, **kwargs)
+
+        wrapper.flights = flights
+        return wrapper
+    return decorator
+
+
+def cancel_all_flights():
+    """Отменяет выполняющиеся задачи всех видов запросов"""
+    with _groups_lock:
+        groups = list(_groups.values())
+    cancelled = sum(flights.cancel_all() for flights in groups)
+    logger.info(f"Отменено выполняющихся запросов: {cancelled}")
+    return cancelled
+
+
+def get_flight_stats():
+    """Статистика объединения запросов по видам"""
+    with _groups_lock:
+        return {name: flights.stats() for name, flights in _groups.items()}
@@ -0,0 +1,96 @@
+"""
+Снимок разобранного расписания на диске.
+
+После перезапуска бот загружает хранилище расписаний групп (вместе с индексами
+преподавателей и кабинетов) и скомпилированные файлы замен из одного
+бинарного файла вместо повторного разбора всех Excel файлов. Каждая запись
+снимка хранит sha1 исходного файла, поэтому заново разбираются только файлы,
+содержимое которых изменилось: снимок служит предыдущим поколением сборки.
+"""
+import os
+import pickle
+import logging
+import threading
+import time
+
+from cache_utils import CACHE_DIR
+from schedule_store import DOWNLOADS_DIR
+from schedule_generations import current_generation, publish_snapshot
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = os.path.join(CACHE_DIR, "schedule_snapshot.pickle")
+
+# Увеличивать при любом изменении формата FileEntry, LessonRecord, ReplacementSheet
+# или логики разбора, чтобы старый снимок не загружался
+SNAPSHOT_VERSION = 2
+
+_snapshot_lock = threading.Lock()
+
+
+def save_snapshot(snapshot_file=SNAPSHOT_FILE):
+    """Записывает текущее поколение расписания в снимок (атомарно, через временный файл)"""
+    generation = current_generation()
+    if generation is None:
+        return False
+
+    store = generation.store
+    data = {
+        'version': SNAPSHOT_VERSION,
+        'saved_at': time.time(),
+        'store': store,
+        'replacement_sheets': dict(generation.replacement_sheets)
+    }
+
+    with _snapshot_lock:
+        temp_file = f"{snapshot_file}.tmp"
+        try:
+            os.makedirs(os.path.dirname(snapshot_file) or '.', exist_ok=True)
+            with open(temp_file, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, snapshot_file)
+            logger.info(f"Снимок расписания сохранен: {len(store.entries)} файлов групп, "
+                        f"{len(data['replacement_sheets'])} файлов замен")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении снимка расписания: {e}")
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+            return False
+
+
+def load_snapshot(snapshot_file=SNAPSHOT_FILE, files_dir=DOWNLOADS_DIR):
+    """
+    Загружает снимок и публикует его как первое поколение расписания.
+
+    Файлы, изменившиеся или добавившиеся со времени снимка, разбираются перед
+    публикацией, удаленные в поколение не попадают.
+
+    Returns:
+        list: Имена исходных файлов, которые добавились, изменились или удалились
+              со времени снимка, или None, если снимок не загружен
+    """
+    if not os.path.exists(snapshot_file):
+        return None
+
+    started = time.time()
+    try:
+        with open(snapshot_file, 'rb') as f:
+            data = pickle.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка при чтении снимка расписания: {e}")
+        return None
+
+    if not isinstance(data, dict) or data.get('version') != SNAPSHOT_VERSION:
+        logger.info("Снимок расписания устарел, файлы будут разобраны заново")
+        return None
+
+    changed = publish_snapshot(data['store'], data['replacement_sheets'], files_dir)
+
+    generation = current_generation()
+    logger.info(f"Снимок расписания загружен за {time.time() - started:.2f} секунд: "
+                f"{len(generation.store.entries)} файлов групп, {len(generation.replacement_sheets)} файлов замен, "
+                f"изменилось {len(changed)}")
+    return changed
@@ -0,0 +1,183 @@
+"""
+Хранилище подписчиков на уведомления.
+
+Подписчики хранятся в SQLite (одна строка на подписчика), а в памяти
+держится их копия, поэтому проверка подписки - это поиск в словаре,
+а подписка и отписка меняют одну строку вместо перезаписи всего файла.
+Запись выполняется в транзакции с synchronous=FULL и не теряется при сбое.
+
+При первом запуске подписчики переносятся из subscribers.json.
+"""
+import os
+import json
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBERS_DB_FILE = "subscribers.sqlite3"
+# Файл подписчиков прежних версий бота
+LEGACY_SUBSCRIBERS_FILE = "subscribers.json"
+
+# Настройки подписчика, которые хранятся в отдельных колонках
+PREFERENCE_FIELDS = ("group", "subgroup", "teacher")
+
+
+class SubscriberRegistry:
+    """Подписчики в памяти с записью изменений в SQLite"""
+
+    def __init__(self, db_file=SUBSCRIBERS_DB_FILE, legacy_file=LEGACY_SUBSCRIBERS_FILE):
+        self.db_file = db_file
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_file, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS subscribers ("
+            " chat_id TEXT PRIMARY KEY,"
+            " username TEXT,"
+            " subscribed_at TEXT,"
+            " active INTEGER NOT NULL DEFAULT 1,"
+            " group_name TEXT,"
+            " subgroup INTEGER,"
+            " teacher TEXT)"
+        )
+        self._subscribers = {
+            row[0]: self._record(*row[1:])
+            for row in self._conn.execute(
+                "SELECT chat_id, username, subscribed_at, active, group_name, subgroup, teacher FROM subscribers"
+            )
+        }
+        if not self._subscribers and legacy_file and os.path.exists(legacy_file):
+            self._import_legacy(legacy_file)
+
+    @staticmethod
+    def _record(username, subscribed_at, active, group, subgroup, teacher):
+        record = {"username": username, "subscribed_at": subscribed_at, "active": bool(active)}
+        for field, value in zip(PREFERENCE_FIELDS, (group, subgroup, teacher)):
+            if value is not None:
+                record[field] = value
+        return record
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    @staticmethod
+    def _row(chat_id, record):
+        return (
+            chat_id, record.get("username"), record.get("subscribed_at"), int(bool(record.get("active", True))),
+            record.get("group"), record.get("subgroup"), record.get("teacher")
+        )
+
+    def _upsert(self, conn, chat_id, record):
+        conn.execute(
+            "INSERT OR REPLACE INTO subscribers"
+            " (chat_id, username, subscribed_at, active, group_name, subgroup, teacher)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            self._row(chat_id, record)
+        )
+
+    def _import_legacy(self, legacy_file):
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                subscribers = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка при чтении {legacy_file}: {e}")
+            return
+        self.replace_all(subscribers)
+        logger.info(f"Подписчики перенесены из {legacy_file}: {len(self._subscribers)}")
+
+    def is_subscribed(self, chat_id):
+        return str(chat_id) in self._subscribers
+
+    def get(self, chat_id):
+        """Копия данных подписчика или None"""
+        record = self._subscribers.get(str(chat_id))
+        return dict(record) if record is not None else None
+
+    def subscribe(self, chat_id, username, preferences=None):
+        """
+        Добавляет подписчика или меняет его настройки.
+
+        Args:
+            chat_id: ID чата
+            username: Имя пользователя
+            preferences: {group, subgroup, teacher}; отсутствующие настройки сбрасываются
+
+        Returns:
+            dict: Данные подписчика
+        """
+        chat_id = str(chat_id)
+        with self._lock:
+            record = dict(self._subscribers.get(chat_id) or {
+                "username": username,
+                "subscribed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "active": True
+            })
+            for field in PREFERENCE_FIELDS:
+                record.pop(field, None)
+            record.update(preferences or {})
+            with self._transaction() as conn:
+                self._upsert(conn, chat_id, record)
+            self._subscribers[chat_id] = record
+            return dict(record)
+
+    def unsubscribe(self, chat_id):
+        """Удаляет подписчика; возвращает False, если он не был подписан"""
+        chat_id = str(chat_id)
+        with self._lock:
+            if chat_id not in self._subscribers:
+                return False
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,))
+            del self._subscribers[chat_id]
+            return True
+
+    def replace_all(self, subscribers):
+        """Заменяет список подписчиков целиком (для save_subscribers и переноса из JSON)"""
+        subscribers = {str(chat_id): dict(record or {}) for chat_id, record in subscribers.items()}
+        with self._lock:
+            with self._transaction() as conn:
+                removed = [chat_id for chat_id in self._subscribers if chat_id not in subscribers]
+                conn.executemany("DELETE FROM subscribers WHERE chat_id = ?", [(chat_id,) for chat_id in removed])
+                for chat_id, record in subscribers.items():
+                    if self._subscribers.get(chat_id) != record:
+                        self._upsert(conn, chat_id, record)
+            self._subscribers = subscribers
+
+    def all(self):
+        """Снимок всех подписчиков {chat_id: данные} (для рассылки)"""
+        with self._lock:
+            return {chat_id: dict(record) for chat_id, record in self._subscribers.items()}
+
+    def chat_ids(self):
+        """ID чатов всех подписчиков"""
+        return list(self._subscribers)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_subscriber_registry():
+    """Общее хранилище подписчиков (создается при первом обращении)"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = SubscriberRegistry()
+                logger.info(f"Загружено подписчиков: {len(_registry)}")
+    return _registry
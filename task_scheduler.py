@@ -0,0 +1,286 @@
+"""
+Общий планировщик блокирующей работы с классами приоритета.
+
+Вся блокирующая работа бота (чтение и разбор Excel, формирование ответов,
+предзагрузка, разбор файлов при синхронизации) выполняется одним набором
+потоков. Задачи делятся на классы:
+
+- interactive - запросы пользователей;
+- prefetch - заранее формируемые ответы, расписания преподавателей, предзагрузка книг;
+- sync - разбор файлов при синхронизации и загрузке расписания.
+
+Свободный общий поток берет задачу самого приоритетного класса, у которого
+не исчерпан лимит одновременно выполняемых задач, поэтому предзагрузка
+занимает не больше своих потоков и не задерживает запросы пользователей.
+Задачи sync выполняются отдельным потоком: синхронизация разбирает файлы,
+удерживая блокировку публикации поколения, которую могут ждать запросы
+в общих потоках, и не должна зависеть от того, освободятся ли они.
+Очередь каждого класса ограничена: при переполнении submit отклоняет задачу
+исключением SchedulerOverloaded (контроль допуска).
+
+Класс задачи задается для участка кода через priority_class и передается
+через contextvars, как вид запроса в metrics.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+PREFETCH = "prefetch"
+SYNC = "sync"
+# Порядок - порядок приоритета
+PRIORITY_CLASSES = (INTERACTIVE, PREFETCH, SYNC)
+
+# Потоков на весь бот: разбор Excel упирается в процессор, больше потоков не ускоряет
+SCHEDULER_WORKERS = max(4, min(8, 2 * (os.cpu_count() or 1)))
+# Сколько задач класса может выполняться одновременно
+CLASS_LIMITS = {INTERACTIVE: SCHEDULER_WORKERS, PREFETCH: 2, SYNC: 1}
+# Классы со своими потоками (по лимиту класса) вместо общих
+DEDICATED_CLASSES = (SYNC,)
+# Сколько задач класса может ждать в очереди
+QUEUE_LIMITS = {INTERACTIVE: 200, PREFETCH: 1000, SYNC: 200}
+
+_priority = contextvars.ContextVar("task_priority", default=INTERACTIVE)
+_worker_state = threading.local()
+
+
+class SchedulerOverloaded(RuntimeError):
+    """Очередь класса заполнена, задача не принята"""
+
+
+class PriorityScheduler:
+    """Потоки, выбирающие задачи по классам приоритета с лимитами на класс"""
+
+    def __init__(self, workers=SCHEDULER_WORKERS, class_limits=None, queue_limits=None, name="scheduler"):
+        # workers - общие потоки для классов, кроме DEDICATED_CLASSES
+        self.workers = workers
+        self.name = name
+        self.class_limits = dict(CLASS_LIMITS, **(class_limits or {}))
+        self.queue_limits = dict(QUEUE_LIMITS, **(queue_limits or {}))
+        self._cond = threading.Condition()
+        self._queues = {priority: deque() for priority in PRIORITY_CLASSES}
+        self._running = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self._counters = {priority: {"submitted": 0, "completed": 0, "rejected": 0, "max_queued": 0}
+                          for priority in PRIORITY_CLASSES}
+        self.queue_wait = {priority: LatencyHistogram() for priority in PRIORITY_CLASSES}
+        self._threads = {}
+        self._shutdown = False
+
+    def submit(self, priority, fn, *args, **kwargs):
+        """
+        Ставит задачу в очередь класса priority.
+
+        Returns:
+            concurrent.futures.Future: Результат задачи
+
+        Raises:
+            SchedulerOverloaded: Если очередь класса заполнена
+        """
+        if priority not in self._queues:
+            raise ValueError(f"Неизвестный класс задач: {priority}")
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("Планировщик остановлен")
+            queue = self._queues[priority]
+            counters = self._counters[priority]
+            if len(queue) >= self.queue_limits[priority]:
+                counters["rejected"] += 1
+                raise SchedulerOverloaded(f"Очередь {priority} заполнена ({len(queue)} задач)")
+            queue.append((future, fn, args, kwargs, time.perf_counter()))
+            counters["submitted"] += 1
+            counters["max_queued"] = max(counters["max_queued"], len(queue))
+            self._ensure_workers(priority)
+            # Задачу может взять только поток, обслуживающий ее класс
+            self._cond.notify_all()
+        return future
+
+    def _ensure_workers(self, priority):
+        if priority in DEDICATED_CLASSES:
+            classes, count = (priority,), self.class_limits[priority]
+        else:
+            classes = tuple(p for p in PRIORITY_CLASSES if p not in DEDICATED_CLASSES)
+            count = self.workers
+        threads = self._threads.setdefault(classes, [])
+        while len(threads) < count:
+            thread = threading.Thread(target=self._work, args=(classes,), daemon=True,
+                                      name=f"{self.name}-{'-'.join(classes)}-{len(threads)}")
+            threads.append(thread)
+            thread.start()
+
+    def _next_task(self, classes):
+        for priority in classes:
+            if self._queues[priority] and self._running[priority] < self.class_limits[priority]:
+                return priority, self._queues[priority].popleft()
+        return None
+
+    def _work(self, classes):
+        _worker_state.scheduler = self
+        while True:
+            with self._cond:
+                task = self._next_task(classes)
+                while task is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                    task = self._next_task(classes)
+                priority, (future, fn, args, kwargs, queued_at) = task
+                self._running[priority] += 1
+            self.queue_wait[priority].observe(time.perf_counter() - queued_at)
+            try:
+                # Отмененная в очереди задача не выполняется
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running[priority] -= 1
+                    self._counters[priority]["completed"] += 1
+                    # Освободилось место класса - задачу может взять любой ожидающий поток
+                    self._cond.notify_all()
+
+    def stats(self):
+        """{класс: queued, running, submitted, completed, rejected, max_queued, limit}"""
+        with self._cond:
+            return {
+                priority: dict(self._counters[priority], queued=len(self._queues[priority]),
+                               running=self._running[priority], limit=self.class_limits[priority])
+                for priority in PRIORITY_CLASSES
+            }
+
+    def shutdown(self, wait_for_tasks=True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait_for_tasks:
+            for threads in list(self._threads.values()):
+                for thread in threads:
+                    thread.join()
+
+
+class SchedulerExecutor(ThreadPoolExecutor):
+    """
+    Executor для loop.run_in_executor, который отправляет задачи в
+    планировщик с классом текущего контекста.
+
+    Собственных потоков не создает; наследуется от ThreadPoolExecutor, чтобы
+    его можно было передавать туда же, куда и обычный пул потоков. Исполнителем
+    по умолчанию цикла событий его не делаем: туда попадают DNS-запросы
+    httpx, которые не должны ждать разбора Excel в очереди планировщика.
+    """
+
+    def __init__(self, scheduler=None):
+        super().__init__(max_workers=1)
+        self._scheduler = scheduler
+
+    def submit(self, fn, /, *args, **kwargs):
+        scheduler = self._scheduler or get_scheduler()
+        return scheduler.submit(_priority.get(), fn, *args, **kwargs)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        pass
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Общий планировщик (создается при первом обращении)"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = PriorityScheduler()
+                logger.info(f"Планировщик задач: {SCHEDULER_WORKERS} потоков, лимиты {_scheduler.class_limits}")
+    return _scheduler
+
+
+def current_priority():
+    return _priority.get()
+
+
+@contextmanager
+def priority_class(priority):
+    """Задает класс задач, которые код внутри блока отправляет в планировщик"""
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Неизвестный класс задач: {priority}")
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+async def run_task(func, *args, **kwargs):
+    """Выполняет func в планировщике с классом текущего контекста и ждет результат"""
+    # Контекстные переменные (класс задачи, вид запроса для метрик) переходят в поток
+    context = contextvars.copy_context()
+    future = get_scheduler().submit(_priority.get(), context.run, func, *args, **kwargs)
+    return await asyncio.wrap_future(future)
+
+
+def _must_run_inline():
+    # Поток планировщика не ждет другую задачу планировщика (иначе потоки могут
+    # занять друг друга ожиданием), а поток цикла событий не блокируется ожиданием очереди
+    if getattr(_worker_state, "scheduler", None) is not None:
+        return True
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def call_task(func, *args, **kwargs):
+    """
+    Синхронный вариант run_task для фоновых потоков (синхронизация, загрузка расписания).
+
+    Из потока планировщика или цикла событий func выполняется сразу в текущем потоке.
+    """
+    if _must_run_inline():
+        return func(*args, **kwargs)
+    context = contextvars.copy_context()
+    return get_scheduler().submit(_priority.get(), context.run, func, *args, **kwargs).result()
+
+
+def submit_all(priority, func, items):
+    """
+    Отправляет func(item) для каждого элемента в класс priority и ждет завершения.
+
+    Элементы, не принятые из-за переполнения очереди, пропускаются.
+
+    Returns:
+        int: Сколько задач выполнено
+    """
+    scheduler = get_scheduler()
+    futures = []
+    for item in items:
+        try:
+            futures.append(scheduler.submit(priority, func, item))
+        except SchedulerOverloaded as e:
+            logger.warning(f"{e}, оставшиеся задачи пропущены")
+            break
+    wait(futures)
+    return len(futures)
+
+
+def get_scheduler_stats():
+    """Состояние очередей планировщика с процентилями ожидания в очереди"""
+    scheduler = get_scheduler()
+    stats = scheduler.stats()
+    for priority, entry in stats.items():
+        entry["wait"] = scheduler.queue_wait[priority].percentiles()
+    return stats
@@ -0,0 +1,169 @@
+"""
+Проверка расписаний преподавателей на известных парах преподаватель/дата.
+
+teacher_regression.json хранит для нескольких преподавателей и дат ожидаемое
+расписание дня, которое build_teacher_day_schedule строит из индекса
+хранилища и замен по файлам downloaded_files этого репозитория (отпечаток
+набора файлов записан там же). Проверка строит расписания заново на
+замороженной копии файлов и сравнивает их с ожидаемыми; при расхождении код
+возврата - 1.
+
+С --legacy для тех же пар выводится и результат исходного
+parse_teacher_schedule из было.py (объединение по файлам групп
+преподавателя): так видно, чем расписание из индекса намеренно отличается
+от прежнего ответа бота.
+
+    python teacher_regression.py
+    python teacher_regression.py --legacy
+    python teacher_regression.py --update   # после намеренного изменения ответа
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+
+import benchmark
+
+FIXTURE_FILE = os.path.join(benchmark.REPO_DIR, "teacher_regression.json")
+
+logger = logging.getLogger("teacher_regression")
+
+
+def _jsonable(schedule):
+    """Расписание дня в том виде, в котором оно хранится в ожиданиях"""
+    return json.loads(json.dumps({str(lesson_num): lesson for lesson_num, lesson in sorted(
+        schedule.items(), key=lambda item: str(item[0]))}, ensure_ascii=False))
+
+
+def build_schedule(generation, replacement_cells, teacher, date_str):
+    """Расписание преподавателя на дату, как его строит бот"""
+    from teacher_schedule_processor import build_teacher_day_schedule
+    return _jsonable(build_teacher_day_schedule(
+        generation.store, teacher, date_str, replacement_cells.get(date_str, {})
+    ))
+
+
+def build_legacy_schedule(generation, teacher, date_str):
+    """Расписание преподавателя на дату по исходному parse_teacher_schedule"""
+    import было
+    schedule = {}
+    for file_name in generation.store.teacher_files().get(teacher, []):
+        result = было.parse_teacher_schedule(os.path.join("downloaded_files", file_name), date_str, teacher)
+        if result:
+            schedule.update(result)
+    return _jsonable(schedule)
+
+
+def diff_schedules(expected, actual):
+    """Строки с отличиями двух расписаний дня"""
+    lines = []
+    for lesson_num in sorted(set(expected) | set(actual), key=lambda num: (len(num), num)):
+        before, after = expected.get(lesson_num), actual.get(lesson_num)
+        if before == after:
+            continue
+        if before is None or after is None:
+            lines.append(f"  пара {lesson_num}: {before} -> {after}")
+            continue
+        for key in sorted(set(before) | set(after)):
+            if before.get(key) != after.get(key):
+                lines.append(f"  пара {lesson_num}, {key}: {before.get(key)!r} -> {after.get(key)!r}")
+    return lines
+
+
+def run_checks(fixture, legacy=False, update=False):
+    """
+    Строит расписания для пар из ожиданий.
+
+    Returns:
+        tuple: (количество расхождений, обновленные ожидания)
+    """
+    from schedule_generations import get_generation
+    from teacher_schedule_processor import collect_replacement_cells
+
+    generation = get_generation()
+    replacement_cells = collect_replacement_cells(generation.replacement_sheets.values())
+
+    failures = 0
+    cases = []
+    for case in fixture["cases"]:
+        teacher, date_str = case["teacher"], case["date"]
+        actual = build_schedule(generation, replacement_cells, teacher, date_str)
+        title = f"{teacher}, {date_str}" + (f" ({case['note']})" if case.get("note") else "")
+
+        if update:
+            print(f"{title}: {len(actual)} пар")
+        else:
+            lines = diff_schedules(case["expected"], actual)
+            if lines:
+                failures += 1
+                print(f"ОТЛИЧАЕТСЯ {title}")
+                print("\n".join(lines))
+            else:
+                print(f"ок {title}")
+
+        if legacy:
+            lines = diff_schedules(build_legacy_schedule(generation, teacher, date_str), actual)
+            print("  parse_teacher_schedule -> индекс:" if lines else "  совпадает с parse_teacher_schedule")
+            for line in lines:
+                print("  " + line)
+
+        cases.append(dict(case, expected=actual))
+    return failures, dict(fixture, cases=cases)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка расписаний преподавателей на известных датах")
+    parser.add_argument("--files", default=os.path.join(benchmark.REPO_DIR, "downloaded_files"),
+                        help="Папка с файлами расписаний и замен (копируется перед запуском)")
+    parser.add_argument("--fixture", default=FIXTURE_FILE, help="Файл с ожидаемыми расписаниями")
+    parser.add_argument("--legacy", action="store_true",
+                        help="Показать отличия от исходного parse_teacher_schedule")
+    parser.add_argument("--update", action="store_true",
+                        help="Записать текущие расписания как ожидаемые")
+    parser.add_argument("--verbose", action="store_true", help="Показывать логи бота")
+    args = parser.parse_args(argv)
+    args.files = os.path.abspath(args.files)
+    args.fixture = os.path.abspath(args.fixture)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO if args.verbose else logging.ERROR)
+
+    with open(args.fixture, encoding="utf-8") as f:
+        fixture = json.load(f)
+
+    work_dir = benchmark.freeze_files(args.files)
+    sys.path.insert(0, benchmark.REPO_DIR)
+    try:
+        import было  # noqa: F401 - parse_teacher_schedule и зависимости модулей расписания
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.ERROR)
+        digest = benchmark.files_digest("downloaded_files")
+        if digest != fixture["files_digest"] and not args.update:
+            print(f"Файлы ({digest}) отличаются от тех, по которым записаны ожидания "
+                  f"({fixture['files_digest']}): укажите --files с исходным набором или --update")
+            return 2
+        failures, updated = run_checks(fixture, args.legacy, args.update)
+    finally:
+        os.chdir(benchmark.REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.update:
+        updated["files_digest"] = digest
+        with open(args.fixture, "w", encoding="utf-8") as f:
+            json.dump(updated, f, ensure_ascii=False, indent=1)
+            f.write("\n")
+        print(f"Ожидания записаны в {args.fixture}")
+        return 0
+
+    print(f"Расхождений: {failures} из {len(fixture['cases'])}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,15 +2,17 @@ import os
 import logging
 import asyncio
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-import openpyxl
 import threading
 import time
 import json
 import re
 from cache_utils import get_cached_teacher_schedule, cache_teacher_schedule
 from excel_cache import use_excel_cache, get_cached_workbook_async
+from schedule_store import get_store, get_date_parity_and_weekday, normalize_teacher
+from schedule_generations import get_generation
+from replacements_store import replacement_file_dates
+from metrics import timed
+from task_scheduler import PREFETCH, priority_class, run_task
 
 # Import necessary functions from было.py without modifying it
 # We'll use these imported functions to maintain compatibility
@@ -22,14 +24,6 @@ from было import (
 
 logger = logging.getLogger(__name__)
 
-# Create a dedicated thread pool for Excel file processing
-# This is separate from the main thread_pool in было.py
-excel_thread_pool = ThreadPoolExecutor(max_workers=25)  # Increased from 20
-
-# Create a semaphore to limit concurrent file operations
-# This prevents overwhelming the system with too many file operations
-file_semaphore = asyncio.Semaphore(20)  # Increased from 15
-
 # Lock for thread-safe operations
 excel_lock = threading.Lock()
 
@@ -97,17 +91,15 @@ def load_popular_teachers():
         logger.error(f"Error loading popular teachers: {e}")
 
 async def run_excel_task(func, *args, **kwargs):
-    """Run Excel processing tasks in a dedicated thread pool with semaphore control."""
-    loop = asyncio.get_running_loop()
-    async with file_semaphore:
-        return await loop.run_in_executor(excel_thread_pool, partial(func, *args, **kwargs))
+    """Run Excel processing tasks in the shared task scheduler (priority class of the caller)."""
+    return await run_task(func, *args, **kwargs)
 
 # Apply the Excel cache decorator to our processing function
 @use_excel_cache
-def cached_parse_teacher_schedule(file_path, date_str, teacher_name):
+def cached_parse_teacher_schedule(file_path, date_str, teacher_name, workbook_provider=None):
     """Cached version of parse_teacher_schedule that uses the Excel cache."""
     try:
-        return parse_teacher_schedule(file_path, date_str, teacher_name)
+        return parse_teacher_schedule(file_path, date_str, teacher_name, workbook_provider=workbook_provider)
     except Exception as e:
         logger.error(f"Error in cached_parse_teacher_schedule for {file_path}, {date_str}, {teacher_name}: {e}")
         return {}
@@ -519,8 +511,9 @@ def _run_background_processor():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         
-        # Run the background processor loop
-        loop.run_until_complete(_background_processor_loop())
+        # Run the background processor loop; its blocking work yields to user requests
+        with priority_class(PREFETCH):
+            loop.run_until_complete(_background_processor_loop())
     except Exception as e:
         logger.error(f"Error in background processor: {e}")
         with background_processor_lock:
@@ -535,33 +528,14 @@ async def _background_processor_loop():
         # First, build the schedule index
         await build_schedule_index()
         
-        # Second, precache popular teacher schedules
-        await precache_popular_teachers()
+        # Second, precompute schedules of all teachers
+        await precache_teacher_schedules()
         
-        # Now continue with other background tasks
+        # Rebuild every hour so the table keeps covering the coming days even without syncs
         while True:
             try:
-                # Define the current time period for processing
-                now = datetime.now()
-                today = now.strftime('%d.%m.%Y')
-                
-                # Process next week's schedule for popular teachers
-                future_date = (now + timedelta(days=7)).strftime('%d.%m.%Y')
-                
-                with popular_teachers_lock:
-                    teachers_to_process = POPULAR_TEACHERS.copy() if POPULAR_TEACHERS else []
-                
-                if teachers_to_process:
-                    logger.info(f"Background processing schedules for {len(teachers_to_process)} popular teachers")
-                    for teacher in teachers_to_process[:10]:  # Process top 10 to avoid overload
-                        try:
-                            # Use indexed version for better performance
-                            await get_teacher_schedule_with_index(teacher, today, future_date)
-                        except Exception as e:
-                            logger.error(f"Error background processing teacher {teacher}: {e}")
-                
-                # Sleep for a while before next processing cycle
                 await asyncio.sleep(3600)  # Sleep for 1 hour
+                await precache_teacher_schedules()
                 
             except Exception as e:
                 logger.error(f"Error in background processor cycle: {e}")
@@ -570,37 +544,6 @@ async def _background_processor_loop():
     except Exception as e:
         logger.error(f"Background processor loop terminated: {e}")
 
-def extract_teachers_from_file(file_path):
-    """Извлекает всех преподавателей из файла расписания"""
-    teachers = set()
-    try:
-        # Use read_only for better performance
-        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
-        sheet = wb.active
-        
-        # Ищем ячейки с именами преподавателей (обычно под предметами)
-        # Формат обычно: Фамилия И.О.
-        teacher_pattern = re.compile(r'[А-Яа-я]+\s+[А-Я]\.[А-Я]\.')
-        
-        # Limit search to rows 1-50 and columns 1-12 to improve performance
-        max_row = min(sheet.max_row, 50)
-        max_col = min(sheet.max_column, 12)
-        
-        for row in range(1, max_row + 1):
-            for col in range(1, max_col + 1):
-                cell_value = sheet.cell(row=row, column=col).value
-                if cell_value and isinstance(cell_value, str):
-                    # Ищем все совпадения с паттерном ФИО
-                    matches = teacher_pattern.findall(cell_value)
-                    teachers.update(matches)
-        
-        # Close the workbook to release resources
-        wb.close()
-        return teachers
-    except Exception as e:
-        logger.error(f"Ошибка при извлечении преподавателей из {file_path}: {e}")
-        return set()
-
 async def build_schedule_index():
     """Строит индекс всех файлов расписания и замен"""
     global schedule_index, schedule_index_initialized
@@ -664,23 +607,11 @@ async def build_schedule_index():
                     dates_index[date] = []
                 dates_index[date].append(file_path)
             
-            # Добавляем преподавателей из файла замен
-            teachers = await run_excel_task(extract_teachers_from_file, file_path)
-            for teacher in teachers:
-                if teacher not in teachers_index:
-                    teachers_index[teacher] = []
-                teachers_index[teacher].append(file_path)
-        
-        # Обрабатываем обычные файлы расписания
-        for file_name in regular_files:
-            file_path = os.path.join(files_dir, file_name)
-            
-            # Добавляем преподавателей из обычного файла
-            teachers = await run_excel_task(extract_teachers_from_file, file_path)
-            for teacher in teachers:
-                if teacher not in teachers_index:
-                    teachers_index[teacher] = []
-                teachers_index[teacher].append(file_path)
+        # Преподаватели берутся из хранилища разобранных файлов групп,
+        # без повторного открытия Excel
+        store = await run_excel_task(get_store)
+        for teacher, file_names in store.teacher_files().items():
+            teachers_index[teacher] = [os.path.join(files_dir, f) for f in file_names]
         
         # Обновляем глобальный индекс
         with schedule_index_lock:
@@ -728,38 +659,538 @@ def get_relevant_files_for_teacher_and_date(teacher_name, date_str):
     
     return list(relevant_files)
 
-async def precache_popular_teachers():
-    """Предварительно кэширует расписания популярных преподавателей"""
+async def precache_teacher_schedules():
+    """Заранее строит расписания всех преподавателей из текущего поколения"""
     try:
-        # Получаем список популярных преподавателей
-        with popular_teachers_lock:
-            teachers_to_cache = POPULAR_TEACHERS.copy() if POPULAR_TEACHERS else []
-        
-        if not teachers_to_cache:
-            logger.info("Нет популярных преподавателей для кэширования")
-            return
-
-        # Получаем текущую неделю и следующую
-        today = datetime.now()
-        start_date = today.strftime('%d.%m.%Y')
-        end_date = (today + timedelta(days=14)).strftime('%d.%m.%Y')
-        
-        logger.info(f"Начинаем предварительное кэширование для {len(teachers_to_cache)} преподавателей")
-        
-        # Запускаем задачи кэширования для каждого преподавателя
-        tasks = []
-        for teacher_name in teachers_to_cache:
-            task = asyncio.create_task(
-                get_teacher_schedule_optimized(teacher_name, start_date, end_date)
-            )
-            tasks.append(task)
-        
-        # Ждем завершения всех задач кэширования
-        await asyncio.gather(*tasks)
-        logger.info("Предварительное кэширование популярных преподавателей завершено")
-        
+        with priority_class(PREFETCH):
+            await run_excel_task(precompute_teacher_schedules)
     except Exception as e:
-        logger.error(f"Ошибка при предварительном кэшировании: {e}")
+        logger.error(f"Ошибка при предварительном построении расписаний преподавателей: {e}")
+
+# Номер аудитории в тексте замены
+ROOM_PATTERN = re.compile(r'[АA]\d{3,4}')
+# Преподаватель в тексте замены (Фамилия И.О.)
+REPLACEMENT_TEACHER_PATTERN = re.compile(r'[А-Я][а-я]+\s+[А-Я]\.[А-Я]\.')
+
+
+def _is_dash_only(text):
+    """Текст состоит только из дефисов и пробелов (отмена)"""
+    return set(text.strip('- ')).issubset({'-', ' '})
+
+
+def _is_cancellation_text(text):
+    """Проверяет, является ли текст замены отменой пары (как в parse_teacher_schedule)"""
+    if not text:
+        return True
+    text = text.strip()
+    if '----' in text.replace(' ', ''):
+        return True
+    if text.startswith('1.') and _is_dash_only(text[2:]):
+        return True
+    return text in ('-', '---')
+
+
+def _cancelled_lesson(teacher_name, group_name, subgroup):
+    return {
+        'subject': '❌ Пара отменена',
+        'teacher': teacher_name,
+        'room': '',
+        'is_common': False,
+        'subgroup': subgroup,
+        'group': group_name,
+        'is_replacement': True,
+        'is_cancelled': True,
+        'emoji': '❌'
+    }
+
+
+def _subgroup_block(lines, marker):
+    """Строки замены, относящиеся к подгруппе (от маркера "1." до "2." или от "2." до конца)"""
+    block = ""
+    found = False
+    for line in lines:
+        if marker == '1' and line.strip().startswith('2. '):
+            break
+        if line.strip().startswith(f'{marker}. '):
+            found = True
+        if found:
+            block += line + '\n'
+    return block
+
+
+def _replacement_subject(subgroup_text, marker, teacher_name, room, lines):
+    """Название предмета для подгруппы из текста замены"""
+    teacher_lower = teacher_name.lower()
+
+    def is_empty(text):
+        return not text or text.isspace() or _is_dash_only(text)
+
+    clean_text = subgroup_text.replace(teacher_name, '').strip()
+    if room:
+        clean_text = clean_text.replace(room, '').strip()
+
+    subject_match = (re.search(rf'{marker}\.\s+\(.*?\)(.*?)(?=[АA]\d{{3,4}}|\n|$)', subgroup_text) or
+                     re.search(rf'{marker}\.\s+(.*?)(?=[АA]\d{{3,4}}|\n|$)', subgroup_text))
+    if subject_match:
+        clean_text = subject_match.group(1).strip()
+    else:
+        clean_text = re.sub(rf'^{marker}\.\s*', '', clean_text)
+
+    if is_empty(clean_text):
+        # Название предмета в строке с маркером подгруппы
+        for part in lines:
+            if part.startswith(f'{marker}. ') and not _is_dash_only(part[2:]):
+                clean_text = re.sub(rf'^{marker}\.\s*', '', part).strip()
+                break
+
+    if is_empty(clean_text):
+        # Любая строка подгруппы с типом занятия в скобках
+        in_block = marker == '1'
+        for part in lines:
+            if part.startswith('2. '):
+                if marker == '1':
+                    break
+                in_block = True
+                continue
+            if in_block and '(' in part and ')' in part and teacher_lower not in part.lower():
+                clean_text = part.strip()
+                break
+
+    if is_empty(clean_text):
+        clean_text = 'Ин.яз (проф.)'
+
+    return clean_text
+
+
+def _teacher_replacement_lesson(teacher_name, group_name, replacement_text):
+    """Пара из замены, в которой упоминается преподаватель"""
+    teacher_lower = teacher_name.lower()
+
+    # Отмена по шаблону "1. ------------"
+    if replacement_text.startswith('1.') and _is_dash_only(replacement_text[2:]):
+        return _cancelled_lesson(teacher_name, group_name, 1)
+
+    lines = replacement_text.split('\n')
+    subgroup1_text = ""
+    subgroup2_text = ""
+    current_subgroup = None
+
+    for part in lines:
+        part = part.strip()
+        if not part:
+            continue
+
+        if part.startswith('1. ') or '1 п/г' in part:
+            current_subgroup = 1
+            if part.startswith('1. ') and _is_dash_only(part[2:]) and \
+                    teacher_lower in _subgroup_block(lines, '1').lower():
+                return _cancelled_lesson(teacher_name, group_name, 1)
+            subgroup1_text += part + '\n'
+        elif part.startswith('2. ') or '2 п/г' in part:
+            current_subgroup = 2
+            if part.startswith('2. ') and _is_dash_only(part[2:]) and \
+                    teacher_lower in _subgroup_block(lines, '2').lower():
+                return _cancelled_lesson(teacher_name, group_name, 2)
+            subgroup2_text += part + '\n'
+        elif current_subgroup == 1:
+            subgroup1_text += part + '\n'
+        elif current_subgroup == 2:
+            subgroup2_text += part + '\n'
+        else:
+            subgroup1_text += part + '\n'
+            subgroup2_text += part + '\n'
+
+    for subgroup, marker, subgroup_text in ((2, '2', subgroup2_text), (1, '1', subgroup1_text)):
+        if teacher_lower in subgroup_text.lower():
+            room_match = ROOM_PATTERN.search(subgroup_text)
+            room = room_match.group(0) if room_match else ''
+            subject = _replacement_subject(subgroup_text, marker, teacher_name, room, lines)
+            return {
+                'subject': f"✏️ {subject}",
+                'teacher': teacher_name,
+                'room': room,
+                'is_common': False,
+                'subgroup': subgroup,
+                'group': group_name,
+                'is_replacement': True,
+                'emoji': '✏️'
+            }
+
+    # Замена для всей группы
+    room_match = ROOM_PATTERN.search(replacement_text)
+    room = room_match.group(0) if room_match else ''
+    clean_text = replacement_text.replace(room, '') if room else replacement_text
+    clean_text = re.sub(r'(?i)' + re.escape(teacher_name), '', clean_text).strip()
+    if not clean_text:
+        clean_text = lines[0].replace(room, '').replace(teacher_name, '').strip()
+
+    return {
+        'subject': clean_text or replacement_text,
+        'teacher': teacher_name,
+        'room': room,
+        'is_common': True,
+        'subgroup': None,
+        'group': group_name,
+        'is_replacement': True,
+        'is_cancelled': False,
+        'emoji': None
+    }
+
+
+def _teacher_lesson_cancellation(teacher_name, group_name, lesson, replacement_text):
+    """
+    Проверяет, отменяет ли замена без упоминания преподавателя его пару.
+
+    Returns:
+        dict или None: отмененная пара, если замена ее отменяет
+    """
+    subgroup = lesson.get('subgroup')
+    if _is_cancellation_text(replacement_text):
+        return _cancelled_lesson(teacher_name, group_name, subgroup)
+
+    lines = replacement_text.split('\n')
+    is_kp = '(КП)' in str(lesson.get('subject', ''))
+
+    # Отмена для одной из подгрупп: "1. ------------" или "2. ------------"
+    for part in lines:
+        part = part.strip()
+        if part.startswith('1. ') and _is_dash_only(part[2:]):
+            if is_kp and subgroup == 2:
+                continue
+            if subgroup in (1, None):
+                return _cancelled_lesson(teacher_name, group_name, 1)
+        elif part.startswith('2. ') and _is_dash_only(part[2:]):
+            if is_kp and subgroup == 1:
+                continue
+            if subgroup in (2, None):
+                return _cancelled_lesson(teacher_name, group_name, 2)
+
+    # Пару подгруппы ведет другой преподаватель
+    texts = {1: '', 2: ''}
+    has_teacher = {1: False, 2: False}
+    current_subgroup = None
+    for part in lines:
+        part = part.strip()
+        if not part:
+            continue
+        if part.startswith('1. '):
+            current_subgroup = 1
+        elif part.startswith('2. '):
+            current_subgroup = 2
+        elif current_subgroup and REPLACEMENT_TEACHER_PATTERN.search(part):
+            has_teacher[current_subgroup] = True
+        if current_subgroup:
+            texts[current_subgroup] += part + '\n'
+
+    teacher_lower = teacher_name.lower()
+    for own, other in ((1, 2), (2, 1)):
+        if subgroup in (own, None) and has_teacher[own] and \
+                teacher_lower not in texts[own].lower() and teacher_lower not in texts[other].lower():
+            return _cancelled_lesson(teacher_name, group_name, own)
+
+    return None
+
+
+def _replacement_covers_lesson(lesson, replacement_text):
+    """Относится ли запись в файле замен к паре преподавателя (для КП - с учетом подгруппы)"""
+    if lesson is None or '(КП)' not in str(lesson.get('subject', '')):
+        return True
+    if '1.' in replacement_text and '2.' in replacement_text:
+        return True
+    if '1.' in replacement_text:
+        return lesson.get('subgroup') == 1
+    if '2.' in replacement_text:
+        return lesson.get('subgroup') == 2
+    return False
+
+
+def _teacher_new_lesson(teacher_name, group_name, replacement_text):
+    """Пара преподавателя из замены в группе, где у него нет пар по основному расписанию"""
+    teacher_lower = teacher_name.lower()
+    lines = replacement_text.split('\n')
+    subgroup = None
+    subject = ""
+    room = ""
+    teacher_found = False
+
+    for i, line in enumerate(lines):
+        if teacher_lower not in line.lower():
+            continue
+        teacher_found = True
+        # Подгруппа определяется по ближайшему маркеру выше строки с преподавателем
+        for j in range(i, -1, -1):
+            marker_line = lines[j].strip()
+            if marker_line.startswith('1.') or marker_line.startswith('2.'):
+                marker = marker_line[0]
+                subgroup = int(marker)
+                subject_match = re.search(rf'{marker}\.\s*(\(.*?\))?\s*(.*?)(?=[АA]\d{{3,4}}|\n|$)', lines[j])
+                if subject_match:
+                    subject = ((subject_match.group(1) or '') + ' ' + (subject_match.group(2) or '')).strip()
+                break
+
+        if not subgroup and '.' not in line:
+            subject_match = re.search(r'(\(.*?\))?\s*(.*?)(?=[АA]\d{3,4}|\n|$)', line)
+            if subject_match:
+                subject = ((subject_match.group(1) or '') + ' ' + (subject_match.group(2) or '')).strip()
+
+        room_match = ROOM_PATTERN.search(line)
+        if room_match:
+            room = room_match.group(0)
+        break
+
+    if not teacher_found:
+        return None
+
+    if not room:
+        room_match = ROOM_PATTERN.search(replacement_text)
+        if room_match:
+            room = room_match.group(0)
+
+    if not (subject or room):
+        return None
+
+    if '(' not in subject:
+        type_match = re.search(r'\((Пр|Лаб|КП|ТО)\)', replacement_text)
+        if type_match:
+            subject = f"({type_match.group(1)}) {subject}"
+
+    return {
+        'subject': f"✏️ {subject}",
+        'teacher': teacher_name,
+        'room': room,
+        'is_common': subgroup is None,
+        'subgroup': subgroup,
+        'group': group_name,
+        'is_replacement': True,
+        'emoji': '✏️'
+    }
+
+
+def _group_replacement_cells(day_cells, group_name):
+    """Замены группы на дату (колонка группы ищется по вхождению названия, как в parse_teacher_schedule)"""
+    for replacement_group, cells in day_cells.items():
+        if group_name in replacement_group:
+            return cells
+    return {}
+
+
+def build_teacher_day_schedule(store, teacher_name, date_str, day_cells):
+    """
+    Собирает расписание преподавателя на дату из индекса хранилища и замен.
+
+    Args:
+        store: Срез ScheduleStore
+        teacher_name: Имя преподавателя
+        date_str: Дата в формате dd.mm.YYYY
+        day_cells: Замены на эту дату {группа: {номер пары: текст}}
+
+    Returns:
+        dict: {номер пары: данные пары} в формате parse_teacher_schedule
+    """
+    parity, weekday = get_date_parity_and_weekday(date_str)
+    teacher_lower = teacher_name.lower()
+
+    # Пары преподавателя по основному расписанию, сгруппированные по группам
+    lessons_by_group = {group: {} for group in store.teacher_groups(teacher_name)}
+    for record in store.teacher_lessons(teacher_name, parity, weekday):
+        lesson_num = record.lesson_num
+        if not isinstance(lesson_num, int):
+            num_str = ''.join(filter(str.isdigit, str(lesson_num)))
+            if not num_str:
+                continue
+            lesson_num = int(num_str)
+        lessons_by_group[record.group][lesson_num] = {
+            'subject': record.subject,
+            'teacher': record.teacher,
+            'room': record.room,
+            'subgroup': record.subgroup,
+            'is_common': record.is_common
+        }
+
+    schedule = {}
+
+    # Новые пары из замен в группах, где преподаватель не ведет пар по расписанию
+    for replacement_group, cells in day_cells.items():
+        if any(group in replacement_group for group in lessons_by_group):
+            continue
+        for lesson_num, replacement_text in cells.items():
+            if teacher_lower in replacement_text.lower():
+                lesson = _teacher_new_lesson(teacher_name, replacement_group, replacement_text)
+                if lesson:
+                    schedule.setdefault(lesson_num, lesson)
+
+    # Группы преподавателя: замены поверх основного расписания
+    for group_name, teacher_lessons in lessons_by_group.items():
+        group_schedule = {}
+        replacement_applied = set()
+
+        for lesson_num, replacement_text in _group_replacement_cells(day_cells, group_name).items():
+            lesson = teacher_lessons.get(lesson_num)
+            if _replacement_covers_lesson(lesson, replacement_text):
+                replacement_applied.add(lesson_num)
+
+            if teacher_lower in replacement_text.lower():
+                group_schedule[lesson_num] = _teacher_replacement_lesson(teacher_name, group_name, replacement_text)
+            elif lesson:
+                cancelled = _teacher_lesson_cancellation(teacher_name, group_name, lesson, replacement_text)
+                if cancelled:
+                    group_schedule[lesson_num] = cancelled
+
+        # Пары основного расписания, которые не были заменены
+        for lesson_num, lesson in teacher_lessons.items():
+            current = group_schedule.get(lesson_num)
+            if current is None or (current.get('is_cancelled') and lesson_num not in replacement_applied):
+                group_schedule[lesson_num] = dict(lesson, group=group_name, is_replacement=False)
+
+        schedule.update(group_schedule)
+
+    return schedule
+
+
+def collect_replacement_cells(sheets):
+    """
+    Объединяет замены нескольких файлов замен.
+
+    Returns:
+        dict: {дата: {группа: {номер пары: текст}}} (только пары с целым номером)
+    """
+    replacement_cells = {}
+    for sheet in sheets:
+        for date_str, groups in sheet.cells.items():
+            date_cells = replacement_cells.setdefault(date_str, {})
+            for group_name, cells in groups.items():
+                group_cells = date_cells.setdefault(group_name, {})
+                group_cells.update((num, text) for num, text in cells.items() if isinstance(num, int))
+    return replacement_cells
+
+
+def build_teacher_schedule_from_index(teacher_name, dates, replacement_files, generation):
+    """
+    Строит расписание преподавателя на несколько дат без разбора файлов групп.
+
+    Замены берутся из скомпилированных файлов замен, базовые пары - из индекса.
+
+    Args:
+        teacher_name: Имя преподавателя
+        dates: Список дат в формате dd.mm.YYYY
+        replacement_files: Пути к файлам замен поколения, относящимся к датам
+        generation: Поколение, из которого берутся базовое расписание и замены
+
+    Returns:
+        dict: {дата: {номер пары: данные пары}}
+    """
+    store = generation.store
+
+    with timed("replacements_merge"):
+        sheets = [generation.replacement_sheets.get(file_path) for file_path in replacement_files]
+        replacement_cells = collect_replacement_cells(sheet for sheet in sheets if sheet)
+
+    all_schedules = {}
+    with timed("sheet_parse"):
+        for date_str in dates:
+            date_schedule = build_teacher_day_schedule(store, teacher_name, date_str, replacement_cells.get(date_str, {}))
+            if date_schedule:
+                all_schedules[date_str] = date_schedule
+    return all_schedules
+
+# Сколько дней вперед заранее строятся расписания всех преподавателей
+PRECOMPUTE_DAYS = 14
+
+
+class TeacherScheduleTable:
+    """Расписания всех преподавателей на несколько дат, построенные из одного поколения"""
+
+    __slots__ = ('generation_number', 'dates', 'display_names', 'schedules')
+
+    def __init__(self, generation_number, dates, display_names, schedules):
+        self.generation_number = generation_number
+        self.dates = frozenset(dates)
+        # {ключ преподавателя: имя так, как оно записано в расписании}
+        self.display_names = display_names
+        # {ключ преподавателя: {дата: {номер пары: данные пары}}}
+        self.schedules = schedules
+
+    def lookup(self, teacher_name, dates, generation):
+        """
+        Расписание преподавателя на даты или None, если таблица не подходит для запроса.
+
+        Имя должно совпадать с записью в расписании: от него зависят поиск
+        в заменах и текст пар, поэтому для других вариантов имени расписание
+        строится обычным образом.
+        """
+        if generation is None or generation.number != self.generation_number:
+            return None
+        teacher_key = normalize_teacher(teacher_name)
+        if self.display_names.get(teacher_key) != teacher_name or not self.dates.issuperset(dates):
+            return None
+        teacher_days = self.schedules[teacher_key]
+        return {date_str: teacher_days[date_str] for date_str in dates if date_str in teacher_days}
+
+
+_teacher_table = None
+
+
+def precompute_dates(replacement_cells, days=PRECOMPUTE_DAYS, today=None):
+    """Даты заранее построенных расписаний: ближайшие дни без воскресений и все даты замен"""
+    today = today or datetime.now().date()
+    dates = set(replacement_cells)
+    for offset in range(days + 1):
+        day = today + timedelta(days=offset)
+        if day.weekday() != 6:
+            dates.add(day.strftime('%d.%m.%Y'))
+    return dates
+
+
+def precompute_teacher_schedules(generation=None, days=PRECOMPUTE_DAYS):
+    """
+    Строит расписания всех преподавателей за один проход по поколению.
+
+    Замены всех файлов объединяются один раз, тип недели и день вычисляются
+    один раз на дату; файлы Excel не открываются.
+
+    Returns:
+        TeacherScheduleTable или None, если расписание еще не загружено
+    """
+    global _teacher_table
+    generation = generation or get_generation()
+    if generation is None:
+        return None
+
+    started = time.time()
+    store = generation.store
+    replacement_cells = collect_replacement_cells(generation.replacement_sheets.values())
+    dates = sorted(precompute_dates(replacement_cells, days))
+
+    # Поколение и даты не изменились - таблица уже актуальна
+    table = _teacher_table
+    if table is not None and table.generation_number == generation.number and table.dates == frozenset(dates):
+        return table
+
+    display_names = dict(store.teacher_display_names)
+    schedules = {}
+    for teacher_key, teacher_name in display_names.items():
+        teacher_days = {}
+        for date_str in dates:
+            day_schedule = build_teacher_day_schedule(store, teacher_name, date_str, replacement_cells.get(date_str, {}))
+            if day_schedule:
+                teacher_days[date_str] = day_schedule
+        schedules[teacher_key] = teacher_days
+
+    table = TeacherScheduleTable(generation.number, dates, display_names, schedules)
+    _teacher_table = table
+    logger.info(f"Расписания {len(schedules)} преподавателей на {len(dates)} дат построены "
+                f"за {time.time() - started:.2f} секунд (поколение #{generation.number})")
+    return table
+
+
+@timed("cache_lookup")
+def precomputed_teacher_schedule(teacher_name, dates, generation):
+    """Заранее построенное расписание преподавателя на даты поколения generation или None"""
+    table = _teacher_table
+    if table is None:
+        return None
+    return table.lookup(teacher_name, dates, generation)
+
 
 # Модифицируем существующую функцию для использования индекса файлов
 async def get_teacher_schedule_with_index(teacher_name: str, start_date: str, end_date: str) -> str:
@@ -774,73 +1205,17 @@ async def get_teacher_schedule_with_index(teacher_name: str, start_date: str, en
             logger.info(f"Using cached schedule for {teacher_name} from {start_date} to {end_date}")
             return cached_schedule
 
-        all_schedules = {}
         start_date_obj = datetime.strptime(start_date, '%d.%m.%Y').date()
         end_date_obj = datetime.strptime(end_date, '%d.%m.%Y').date()
         
-        # Собираем информацию о файлах замен и их датах
+        # Файлы замен и их периоды берутся из поколения, по которому строится ответ:
+        # файл, уже перенесенный синхронизацией на диск, но еще не опубликованный, не учитывается
+        generation = await run_excel_task(get_generation)
         replacement_files_info = []
-        files_dir = "downloaded_files"
-        
-        # Получаем список всех файлов Excel
-        file_list = os.listdir(files_dir)
-        excel_files = [f for f in file_list if f.endswith('.xlsx')]
-        
-        # Находим файлы с заменами (имя файла содержит дату в формате DD.MM.YY-DD.MM.YY.xlsx или DD.MM.YY.xlsx)
-        import re
-        date_range_pattern = re.compile(r'^(\d{2}\.\d{2}\.\d{2,4})-(\d{2}\.\d{2}\.\d{2,4})\.xlsx$')
-        single_date_pattern = re.compile(r'^(\d{2}\.\d{2}\.\d{2,4})\.xlsx$')
-        
-        for file in excel_files:
-            match_range = date_range_pattern.match(file)
-            match_single = single_date_pattern.match(file)
-            
-            if match_range:
-                try:
-                    dates = file.replace('.xlsx', '').split('-')
-                    if len(dates) == 2:
-                        # Пробуем разные форматы даты
-                        try:
-                            # Сначала пробуем формат с двузначным годом
-                            start_file_date = datetime.strptime(dates[0], '%d.%m.%y').date()
-                            end_file_date = datetime.strptime(dates[1], '%d.%m.%y').date()
-                        except ValueError:
-                            try:
-                                # Затем пробуем формат с четырехзначным годом
-                                start_file_date = datetime.strptime(dates[0], '%d.%m.%Y').date()
-                                end_file_date = datetime.strptime(dates[1], '%d.%m.%Y').date()
-                            except ValueError:
-                                logger.warning(f"Не удалось распознать формат даты в файле: {file}")
-                                continue
-                        
-                        file_path = os.path.join(files_dir, file)
-                        replacement_files_info.append((start_file_date, end_file_date, file_path))
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке файла {file}: {str(e)}")
-                    continue
-            
-            elif match_single:
-                try:
-                    date_str = match_single.group(1)
-                    
-                    # Пробуем разные форматы даты
-                    try:
-                        # Сначала пробуем формат с двузначным годом
-                        file_date = datetime.strptime(date_str, '%d.%m.%y').date()
-                    except ValueError:
-                        try:
-                            # Затем пробуем формат с четырехзначным годом
-                            file_date = datetime.strptime(date_str, '%d.%m.%Y').date()
-                        except ValueError:
-                            logger.warning(f"Не удалось распознать формат даты в файле: {file}")
-                            continue
-                    
-                    # Для файлов с одной датой используем ту же дату как начало и конец
-                    file_path = os.path.join(files_dir, file)
-                    replacement_files_info.append((file_date, file_date, file_path))
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке файла с одной датой {file}: {str(e)}")
-                    continue
+        for file_path in generation.replacement_sheets:
+            period = replacement_file_dates(file_path, allow_single=True)
+            if period:
+                replacement_files_info.append((period[0], period[1], file_path))
         
         # Собираем только даты, которые действительно относятся к файлам с заменами
         dates_to_check = set()
@@ -885,98 +1260,25 @@ async def get_teacher_schedule_with_index(teacher_name: str, start_date: str, en
         if not dates_to_check:
             return f"Расписание для {teacher_name} на указанный период не найдено (нет актуальных файлов замен)"
         
-        # Получаем все файлы, которые содержат упоминание преподавателя
-        teacher_files = set()
-        with schedule_index_lock:
-            if schedule_index_initialized and teacher_name in schedule_index["teachers"]:
-                teacher_files = set(schedule_index["teachers"][teacher_name])
-        
-        # Добавляем файлы замен
-        replacement_files = set([file_path for _, _, file_path in replacement_files_info])
-        
-        # Объединяем все релевантные файлы
-        all_relevant_files = teacher_files.union(replacement_files)
-        
-        if not all_relevant_files:
-            logger.warning(f"Не найдено релевантных файлов для {teacher_name} на период {start_date} - {end_date}")
-            return f"Расписание для {teacher_name} на указанный период не найдено"
-            
-        # Логирование найденных файлов
-        logger.info(f"Для {teacher_name} найдено {len(teacher_files)} файлов с упоминанием преподавателя")
-        logger.info(f"Найдено {len(replacement_files)} файлов замен для дат в диапазоне {start_date} - {end_date}")
-        
-        # Устанавливаем общий таймаут на всю операцию
-        overall_start_time = time.time()
-        overall_timeout = 30  # 30 секунд на весь процесс
-        
-        # Ограничиваем количество одновременно обрабатываемых файлов
-        MAX_CONCURRENT_TASKS = 10
-        dates_processed = []
+        # Базовые пары берутся из индекса преподавателей, файлы групп не открываются.
+        # Читаются только файлы замен, пересекающиеся с запрошенным периодом.
+        replacement_files = [
+            file_path for start_file_date, end_file_date, file_path in replacement_files_info
+            if start_file_date <= latest_end_date and end_file_date >= earliest_start_date
+        ]
+        dates_processed = sorted(dates_to_check)
+        all_schedules = precomputed_teacher_schedule(teacher_name, dates_processed, generation)
+        if all_schedules is None:
+            all_schedules = await run_excel_task(
+                build_teacher_schedule_from_index, teacher_name, dates_processed, replacement_files, generation
+            )
         
-        # Обрабатываем только отфильтрованные даты
-        for date_str in sorted(dates_to_check):
-            if time.time() - overall_start_time >= overall_timeout:
-                break
-                
-            dates_processed.append(date_str)
-            # Обрабатываем файлы для этой даты
-            date_schedule = {}
-            
-            # Создаем задачи для обработки файлов
-            files_to_process = []
-            
-            for file_path in all_relevant_files:
-                if os.path.exists(file_path):
-                    # Проверяем, применим ли файл к текущей дате
-                    file_name = os.path.basename(file_path)
-                    if is_file_applicable_for_date(file_name, date_str) or not '-' in file_name:
-                        files_to_process.append(file_path)
-                else:
-                    logger.warning(f"Файл не найден: {file_path}")
-            
-            # Обрабатываем файлы партиями, чтобы избежать перегрузки
-            for i in range(0, len(files_to_process), MAX_CONCURRENT_TASKS):
-                if time.time() - overall_start_time >= overall_timeout:
-                    break
-                    
-                batch = files_to_process[i:i+MAX_CONCURRENT_TASKS]
-                batch_tasks = [process_excel_file_for_teacher(file_path, date_str, teacher_name) 
-                              for file_path in batch]
-                
-                if batch_tasks:
-                    logger.info(f"Обрабатываем партию из {len(batch_tasks)} файлов для {teacher_name} на дату {date_str}")
-                    try:
-                        # Добавляем таймаут на уровне партии
-                        results = await asyncio.wait_for(
-                            asyncio.gather(*batch_tasks, return_exceptions=True),
-                            timeout=20  # 20 секунд на партию файлов
-                        )
-                        
-                        # Объединяем результаты, игнорируя ошибки
-                        for result in results:
-                            if isinstance(result, Exception):
-                                logger.error(f"Ошибка при обработке файла: {result}")
-                            elif result:
-                                date_schedule.update(result)
-                    except asyncio.TimeoutError:
-                        logger.warning(f"Превышен таймаут обработки партии файлов для {date_str}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при выполнении задач для даты {date_str}: {e}")
-            
-            # Сохраняем результаты для этой даты
-            if date_schedule:
-                all_schedules[date_str] = date_schedule
-                logger.info(f"Для даты {date_str} найдено {len(date_schedule)} пар")
+        for date_str in dates_processed:
+            if date_str in all_schedules:
+                logger.info(f"Для даты {date_str} найдено {len(all_schedules[date_str])} пар")
             else:
                 logger.info(f"Для даты {date_str} не найдено пар")
         
-        # Проверяем, не истек ли общий таймаут
-        if time.time() - overall_start_time >= overall_timeout:
-            logger.warning(f"Превышен общий таймаут обработки расписания для {teacher_name}")
-            # Если есть хотя бы какие-то данные, продолжаем обработку
-            if not all_schedules:
-                return f"Не удалось получить расписание для {teacher_name} в указанный срок. Пожалуйста, попробуйте еще раз."
-        
         # Если мы не смогли найти ни одной пары для всех дат
         if not all_schedules:
             logger.warning(f"Расписание не найдено для {teacher_name} на {start_date}-{end_date} (обработано дат: {len(dates_processed)})")
@@ -0,0 +1,180 @@
+"""
+Запись обезличенного входящего трафика бота.
+
+Запись выключена по умолчанию и включается константой TRAFFIC_RECORDING_ENABLED
+на время сбора трафика. Каждое входящее сообщение записывается строкой JSON в файл за день
+(traffic/updates-ГГГГ-ММ-ДД.jsonl): время получения, обезличенный
+пользователь и текст. По этим записям traffic_replay.py воспроизводит
+диалоги пользователей (выбор действия -> ввод группы -> подгруппа и т. д.)
+с исходными интервалами или в несколько раз быстрее.
+
+Обезличивание:
+- идентификатор пользователя заменяется на HMAC с секретом, который хранится
+  рядом с записями и не покидает сервер; один пользователь получает один и
+  тот же идентификатор во всех файлах;
+- текст сохраняется, только если это кнопка бота, команда, дата, кабинет,
+  группа или преподаватель из расписания (все это - публичные данные
+  расписания); любой другой текст заменяется на "<text:длина>".
+"""
+import os
+import re
+import hmac
+import json
+import time
+import glob
+import secrets
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# Записывать входящие сообщения (main.build_application добавляет обработчик только при True)
+TRAFFIC_RECORDING_ENABLED = False
+TRAFFIC_DIR = "traffic"
+TRAFFIC_SECRET_FILE = os.path.join(TRAFFIC_DIR, "secret")
+# Сколько дней хранятся записи
+TRAFFIC_RETENTION_DAYS = 14
+
+# Тексты кнопок клавиатур бота
+BUTTON_TEXTS = frozenset({
+    "👥 Расписание группы", "🎓 Расписание преподавателя(бета)", "⏰ Расписание звонков",
+    "🚪 Расписание кабинета(бета)", "Подписаться на замены", "Отписаться от замен",
+    "Первая подгруппа", "Вторая подгруппа", "Ввести другого преподавателя",
+    "Другой кабинет", "Другая дата", "Расписание звонков", "Отмена",
+})
+COMMAND_PATTERN = re.compile(r'^/[A-Za-z_]+(@\w+)?$')
+# 15.09.2025, 15.09.25 и кнопки выбора даты кабинета вида "15.09 (пн)"
+DATE_PATTERN = re.compile(r'^\d{2}\.\d{2}(\.\d{2,4})?( \(\w+\))?$')
+CLASSROOM_PATTERN = re.compile(r'^[А-ЯA-Z]\d{2,}$', re.IGNORECASE)
+MASKED_PATTERN = re.compile(r'^<text:(\d+)>$')
+
+_lock = threading.Lock()
+_secret = None
+_last_cleanup_day = None
+
+
+def _get_secret():
+    global _secret
+    if _secret is None:
+        os.makedirs(TRAFFIC_DIR, exist_ok=True)
+        if not os.path.exists(TRAFFIC_SECRET_FILE):
+            with open(TRAFFIC_SECRET_FILE, 'w') as f:
+                f.write(secrets.token_hex(16))
+        with open(TRAFFIC_SECRET_FILE) as f:
+            _secret = f.read().strip().encode()
+    return _secret
+
+
+def anonymize_user(user_id):
+    """Постоянный обезличенный идентификатор пользователя"""
+    return hmac.new(_get_secret(), str(user_id).encode(), hashlib.sha256).hexdigest()[:12]
+
+
+def _is_public_token(token, store):
+    if token in BUTTON_TEXTS or DATE_PATTERN.match(token) or CLASSROOM_PATTERN.match(token):
+        return True
+    if store is None:
+        return False
+    from schedule_store import normalize_teacher
+    return store.find_group_file(token) is not None or normalize_teacher(token) in store.by_teacher
+
+
+def anonymize_text(text, store=None):
+    """Текст сообщения, если он не содержит ничего, кроме публичных данных расписания"""
+    text = (text or "").strip()
+    if _is_public_token(text, store):
+        return text
+    parts = text.split()
+    # Команда с аргументами (/classroom А403 15.09.2025)
+    if parts and COMMAND_PATTERN.match(parts[0]):
+        return " ".join([parts[0]] + [part if _is_public_token(part, store) else f"<text:{len(part)}>"
+                                      for part in parts[1:]])
+    return f"<text:{len(text)}>"
+
+
+def restore_text(text):
+    """Текст для воспроизведения: скрытый текст заменяется строкой той же длины"""
+    match = MASKED_PATTERN.match(text)
+    if match:
+        return "x" * int(match.group(1))
+    return re.sub(r'<text:(\d+)>', lambda m: "x" * int(m.group(1)), text)
+
+
+def traffic_file(day=None):
+    day = day or datetime.now()
+    return os.path.join(TRAFFIC_DIR, f"updates-{day.strftime('%Y-%m-%d')}.jsonl")
+
+
+def _remove_old_files(today):
+    oldest = (today - timedelta(days=TRAFFIC_RETENTION_DAYS)).strftime('%Y-%m-%d')
+    for path in glob.glob(os.path.join(TRAFFIC_DIR, "updates-*.jsonl")):
+        if os.path.basename(path)[len("updates-"):-len(".jsonl")] < oldest:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Не удалось удалить старую запись трафика {path}: {e}")
+
+
+def write_record(user, text, chat_type="private", received_at=None):
+    """Дописывает запись в файл текущего дня"""
+    global _last_cleanup_day
+    received_at = received_at or time.time()
+    record = {"t": round(received_at, 3), "user": user, "chat": chat_type, "text": text}
+    now = datetime.now()
+    with _lock:
+        os.makedirs(TRAFFIC_DIR, exist_ok=True)
+        if _last_cleanup_day != now.date():
+            _last_cleanup_day = now.date()
+            _remove_old_files(now)
+        with open(traffic_file(now), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик группы -1: записывает входящее сообщение и пропускает его дальше"""
+    message = update.message
+    if not message or not message.text or not update.effective_user:
+        return
+    try:
+        from schedule_store import current_store
+        write_record(
+            anonymize_user(update.effective_user.id),
+            anonymize_text(message.text, current_store()),
+            update.effective_chat.type if update.effective_chat else "private",
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при записи трафика: {e}")
+
+
+def load_traffic(paths):
+    """
+    Читает записи из файлов или папок с файлами updates-*.jsonl.
+
+    Returns:
+        list: Записи, упорядоченные по времени получения
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "updates-*.jsonl"))))
+        else:
+            files.append(path)
+
+    records = []
+    for path in files:
+        with open(path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"{path}:{line_number}: поврежденная запись пропущена")
+    records.sort(key=lambda record: record["t"])
+    return records
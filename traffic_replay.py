@@ -0,0 +1,455 @@
+"""
+Воспроизведение записанного трафика на настоящем Application.
+
+Записи traffic_log (обезличенные сообщения пользователей с временем
+получения) подаются в update_queue приложения, собранного
+main.build_application с теми же обработчиками и concurrent_updates, что и
+в работе. Bot API заменен локальной заглушкой: она отвечает на getMe,
+sendMessage, deleteMessage и остальные методы и считает вызовы. Диалоги
+проходят все шаги ConversationHandler (выбор действия -> группа -> подгруппа,
+выбор действия -> преподаватель -> дата и т. д.), потому что у каждого
+пользователя сохраняется свое состояние диалога.
+
+Запись воспроизводится с ускорением ×1, ×2, ×4... (--speed): для каждого
+ускорения выводятся ожидание обновления в очереди (свободного места среди
+concurrent_updates), время обработки, пропускная способность, наибольшее
+число одновременно обрабатываемых обновлений и загрузка планировщика задач
+(task_scheduler, класс interactive). По этой таблице видно, при каком
+ускорении упираются concurrent_updates и потоки планировщика.
+
+Файлы расписаний копируются и часы бота замораживаются так же, как в
+benchmark.py; по умолчанию - на день начала записи.
+
+    python traffic_replay.py replay traffic/
+    python traffic_replay.py replay traffic/updates-2025-09-15.jsonl --speed 1,5,10,20 --window 600
+    python traffic_replay.py synthesize --out synthetic.jsonl --users 300
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from datetime import datetime
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import benchmark
+from traffic_log import load_traffic, restore_text
+
+logger = logging.getLogger("traffic_replay")
+
+STUB_TOKEN = "123456:replay"
+DEFAULT_SPEEDS = "1,2,4,8,16,32"
+# Длина воспроизводимого отрезка записи (самый загруженный), секунд реального времени
+DEFAULT_WINDOW = 300
+# Период опроса очереди планировщика задач, секунд
+SAMPLE_INTERVAL = 0.02
+# Признак насыщения: p95 ожидания в очереди обновлений
+SATURATION_WAIT = 0.1
+# Признак насыщения: доля замеров, когда в очереди планировщика есть задачи (все потоки заняты)
+SATURATION_BUSY = 0.1
+# Пауза пользователя между шагами диалога при синтезе записи, секунд
+THINK_TIME = (2.0, 8.0)
+
+
+class StubBotApi:
+    """Локальная заглушка Bot API в фоновом потоке"""
+
+    def __init__(self, latency=0.0, host="127.0.0.1"):
+        self.latency = latency
+        self.calls = {}
+        self._message_ids = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                result = stub.handle(method, self._params(body))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def _params(self, body):
+                content_type = self.headers.get('Content-Type', '')
+                if 'json' in content_type:
+                    return json.loads(body or b'{}')
+                if 'x-www-form-urlencoded' in content_type:
+                    return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                return {}
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, 0), Handler)
+        self._server.daemon_threads = True
+        self.base_url = f"http://{host}:{self._server.server_address[1]}/bot"
+        threading.Thread(target=self._server.serve_forever, name="bot-api-stub", daemon=True).start()
+
+    def handle(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self._message_ids += 1
+            message_id = self._message_ids
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "botMPK", "username": "botmpk_replay_bot"}
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            return {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        return True
+
+    def reset_calls(self):
+        with self._lock:
+            calls, self.calls = self.calls, {}
+        return calls
+
+    def close(self):
+        self._server.shutdown()
+
+
+def measuring_processor(max_concurrent_updates, expected):
+    """Процессор обновлений с concurrent_updates, который замеряет ожидание и обработку"""
+    from telegram.ext import SimpleUpdateProcessor
+
+    class MeasuringUpdateProcessor(SimpleUpdateProcessor):
+        def __init__(self):
+            super().__init__(max_concurrent_updates)
+            self.enqueued = {}
+            self.waits = []
+            self.durations = []
+            self.finished_at = []
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.idle = asyncio.Event()
+
+        async def do_process_update(self, update, coroutine):
+            started = time.perf_counter()
+            queued = self.enqueued.pop(getattr(update, 'update_id', None), started)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+                finished = time.perf_counter()
+                self.waits.append(started - queued)
+                self.durations.append(finished - started)
+                self.finished_at.append(finished)
+                if len(self.durations) >= expected:
+                    self.idle.set()
+
+    return MeasuringUpdateProcessor()
+
+
+def busiest_window(records, window):
+    """Отрезок записи длиной window секунд с наибольшим числом сообщений"""
+    if not window or not records or records[-1]["t"] - records[0]["t"] <= window:
+        return records
+    best_start, best_count, start = 0, 0, 0
+    for end, record in enumerate(records):
+        while record["t"] - records[start]["t"] > window:
+            start += 1
+        if end - start + 1 > best_count:
+            best_start, best_count = start, end - start + 1
+    return records[best_start:best_start + best_count]
+
+
+def make_update(update_id, record, user_id, bot):
+    from telegram import Update, MessageEntity
+    text = restore_text(record["text"])
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(record["t"]),
+            "chat": {"id": user_id, "type": record.get("chat", "private")},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Replay"},
+            "text": text,
+        },
+    }
+    if text.startswith("/"):
+        data["message"]["entities"] = [
+            {"type": MessageEntity.BOT_COMMAND, "offset": 0, "length": len(text.split()[0])}
+        ]
+    return Update.de_json(data, bot)
+
+
+async def _sample(processor, limit, samples, stop):
+    from task_scheduler import INTERACTIVE, get_scheduler
+    scheduler = get_scheduler()
+    while not stop.is_set():
+        samples["total"] += 1
+        if processor.in_flight >= limit:
+            samples["updates_full"] += 1
+        # Задачи ждут в очереди - все потоки планировщика для запросов заняты
+        depth = scheduler.stats()[INTERACTIVE]["queued"]
+        samples["scheduler_max_queue"] = max(samples.get("scheduler_max_queue", 0), depth)
+        if depth:
+            samples["scheduler_busy"] = samples.get("scheduler_busy", 0) + 1
+        try:
+            await asyncio.wait_for(stop.wait(), SAMPLE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+
+async def replay(records, speed, concurrent_updates, stub):
+    """Воспроизводит записи с ускорением speed и возвращает замеры"""
+    from main import build_application
+    from cache_utils import clear_cache
+
+    clear_cache()
+    stub.reset_calls()
+    processor = measuring_processor(concurrent_updates, len(records))
+    app = build_application(STUB_TOKEN, processor, base_url=stub.base_url, record_traffic=False)
+    errors = 0
+
+    async def count_error(update, context):
+        nonlocal errors
+        errors += 1
+
+    app.add_error_handler(count_error)
+
+    # Пользователи записи получают отдельные идентификаторы в каждом прогоне
+    user_ids = {}
+    samples = {"total": 0, "updates_full": 0}
+    stop = asyncio.Event()
+    async with app:
+        await app.start()
+        sampler = asyncio.create_task(_sample(processor, concurrent_updates, samples, stop))
+        first_t = records[0]["t"]
+        started = time.perf_counter()
+        for update_id, record in enumerate(records, start=1):
+            delay = (record["t"] - first_t) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            user_id = user_ids.setdefault(record["user"], 1_000_000_000 + len(user_ids))
+            processor.enqueued[update_id] = time.perf_counter()
+            await app.update_queue.put(make_update(update_id, record, user_id, app.bot))
+        offered_seconds = time.perf_counter() - started
+        await processor.idle.wait()
+        stop.set()
+        await sampler
+        await app.stop()
+
+    elapsed = max(processor.finished_at) - started
+    total = max(samples["total"], 1)
+    return {
+        "speed": speed,
+        "updates": len(records),
+        "users": len(user_ids),
+        "offered_rate": round(len(records) / offered_seconds, 2) if offered_seconds else 0.0,
+        "throughput": round(len(records) / elapsed, 2) if elapsed else 0.0,
+        "wait_p50_ms": round(_percentile(processor.waits, 0.5) * 1000, 1),
+        "wait_p95_ms": round(_percentile(processor.waits, 0.95) * 1000, 1),
+        "handle_p50_ms": round(_percentile(processor.durations, 0.5) * 1000, 1),
+        "handle_p95_ms": round(_percentile(processor.durations, 0.95) * 1000, 1),
+        "handle_p99_ms": round(_percentile(processor.durations, 0.99) * 1000, 1),
+        "max_in_flight": processor.max_in_flight,
+        "updates_full": round(samples["updates_full"] / total, 3),
+        "scheduler_busy": round(samples.get("scheduler_busy", 0) / total, 3),
+        "scheduler_max_queue": samples.get("scheduler_max_queue", 0),
+        "errors": errors,
+        "api_calls": stub.reset_calls(),
+    }
+
+
+def saturation(result):
+    """Что упирается при этом ускорении (пустой список - ничего)"""
+    limits = []
+    if result["wait_p95_ms"] > SATURATION_WAIT * 1000 or result["updates_full"] > SATURATION_BUSY:
+        limits.append("concurrent_updates")
+    if result["scheduler_busy"] > SATURATION_BUSY:
+        limits.append("task_scheduler")
+    return limits
+
+
+def print_results(results, concurrent_updates):
+    print(f"{'ускор.':>7}{'обн/с':>9}{'обраб/с':>9}{'ждать p50':>10}{'p95':>8}{'обраб p50':>10}{'p95':>8}"
+          f"{'p99':>8}{'одновр.':>9}{'пул занят':>10}{'очередь':>9}{'ошибок':>8}")
+    saturated_at = None
+    for result in results:
+        print(f"{'×' + str(result['speed']):>7}{result['offered_rate']:>9}{result['throughput']:>9}"
+              f"{result['wait_p50_ms']:>10}{result['wait_p95_ms']:>8}{result['handle_p50_ms']:>10}"
+              f"{result['handle_p95_ms']:>8}{result['handle_p99_ms']:>8}"
+              f"{str(result['max_in_flight']) + '/' + str(concurrent_updates):>9}"
+              f"{result['scheduler_busy']:>10}{result['scheduler_max_queue']:>9}{result['errors']:>8}")
+        limits = saturation(result)
+        if limits and saturated_at is None:
+            saturated_at = (result, limits)
+    if saturated_at:
+        result, limits = saturated_at
+        print(f"\nНасыщение при ×{result['speed']} ({result['offered_rate']} обновлений/с): упирается {', '.join(limits)}")
+    else:
+        print("\nНасыщения не достигнуто")
+
+
+def run_replay(args):
+    records = busiest_window(load_traffic(args.paths), args.window)
+    if not records:
+        print("Нет записей для воспроизведения")
+        return 1
+    if args.limit:
+        records = records[:args.limit]
+
+    work_dir = benchmark.freeze_files(args.files)
+    sys.path.insert(0, benchmark.REPO_DIR)
+    stub = None
+    try:
+        import было  # noqa: F401 - обработчики и их зависимости
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.ERROR)
+        if not args.raw:
+            benchmark.apply_production_patches()
+        from main import CONCURRENT_UPDATES
+        if args.concurrent_updates is None:
+            args.concurrent_updates = CONCURRENT_UPDATES
+        import cache_utils, prerender, classroom_index, schedule_wrapper, teacher_schedule_processor  # noqa: F401,E401
+        today = (datetime.strptime(args.today, '%d.%m.%Y').date() if args.today
+                 else datetime.fromtimestamp(records[0]["t"]).date())
+        benchmark.freeze_clock(today)
+
+        span = records[-1]["t"] - records[0]["t"]
+        print(f"Запись: {len(records)} сообщений, {len({record['user'] for record in records})} пользователей, "
+              f"{round(span)} с; день {today.strftime('%d.%m.%Y')}, concurrent_updates {args.concurrent_updates}, "
+              f"режим {'raw' if args.raw else 'production'}")
+
+        async def run_all():
+            await benchmark.warm_up(args.raw)
+            return [await replay(records, speed, args.concurrent_updates, stub) for speed in args.speed]
+
+        stub = StubBotApi(args.api_latency / 1000)
+        results = asyncio.run(run_all())
+    finally:
+        if stub:
+            stub.close()
+        os.chdir(benchmark.REPO_DIR)
+        benchmark.shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_results(results, args.concurrent_updates)
+    return 0
+
+
+def synthesize(args):
+    """
+    Синтетическая запись в формате traffic_log для проверки без записанного трафика:
+    пользователи начинают диалоги в случайные моменты окна и проходят их по шагам.
+    """
+    sys.path.insert(0, benchmark.REPO_DIR)
+    work_dir = benchmark.freeze_files(args.files)
+    try:
+        import было
+        logging.getLogger().setLevel(logging.ERROR)
+        from schedule_generations import get_generation
+        generation = get_generation()
+        today = benchmark.default_today("downloaded_files")
+    finally:
+        os.chdir(benchmark.REPO_DIR)
+        benchmark.shutil.rmtree(work_dir, ignore_errors=True)
+
+    rng = random.Random(args.seed)
+    groups = benchmark.build_workload("morning_rush", generation, args.users, rng)
+    teachers = benchmark.build_workload("teacher_ranges", generation, args.users, rng)
+    rooms = benchmark.build_workload("classroom_sweep", generation, args.users, rng)
+    dates = sorted({date_str for sheet in generation.replacement_sheets.values() for date_str in sheet.cells
+                    if datetime.strptime(date_str, '%d.%m.%Y').date() >= today})
+    date_buttons = [f"{date_str[:5]} ({было.days_ru[datetime.strptime(date_str, '%d.%m.%Y').weekday()]})"
+                    for date_str in dates]
+
+    start = datetime(today.year, today.month, today.day, *benchmark.FROZEN_TIME).timestamp()
+    records = []
+    for index in range(args.users):
+        user = f"synthetic{index:05d}"
+        kind = rng.choices(("group", "teacher", "classroom"), weights=(6, 3, 1))[0]
+        if kind == "group":
+            group, subgroup_button = groups[index][1]
+            steps = ["👥 Расписание группы", group, subgroup_button]
+        elif kind == "teacher":
+            steps = ["🎓 Расписание преподавателя(бета)", teachers[index][1][0]]
+        else:
+            steps = ["🚪 Расписание кабинета(бета)", rooms[index][1][0]]
+            if date_buttons:
+                steps.append(rng.choice(date_buttons))
+        t = start + rng.uniform(0, args.minutes * 60)
+        for text in ["/start"] + steps:
+            records.append({"t": round(t, 3), "user": user, "chat": "private", "text": text})
+            t += rng.uniform(*THINK_TIME)
+
+    records.sort(key=lambda record: record["t"])
+    with open(args.out, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    print(f"Записано {len(records)} сообщений {args.users} пользователей в {args.out}")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = commands.add_parser("replay", help="Воспроизвести запись")
+    replay_parser.add_argument("paths", nargs="+", help="Файлы updates-*.jsonl или папки с ними")
+    replay_parser.add_argument("--speed", default=DEFAULT_SPEEDS,
+                               help=f"Ускорения через запятую (по умолчанию {DEFAULT_SPEEDS})")
+    replay_parser.add_argument("--window", type=float, default=DEFAULT_WINDOW,
+                               help="Воспроизводить самый загруженный отрезок записи такой длины, секунд (0 - всю)")
+    replay_parser.add_argument("--limit", type=int, help="Не больше стольких сообщений")
+    replay_parser.add_argument("--concurrent-updates", type=int, help="По умолчанию - как в main.py")
+    replay_parser.add_argument("--api-latency", type=float, default=0.0, help="Задержка ответа заглушки Bot API, мс")
+    replay_parser.add_argument("--files", default=os.path.join(benchmark.REPO_DIR, "downloaded_files"),
+                               help="Папка с файлами расписаний и замен (копируется перед запуском)")
+    replay_parser.add_argument("--today", help="Дата замороженных часов бота, DD.MM.YYYY (по умолчанию - день записи)")
+    replay_parser.add_argument("--raw", action="store_true", help="Без замен функций из main.py")
+    replay_parser.add_argument("--json", action="store_true", help="Вывести результат в JSON")
+    replay_parser.add_argument("--verbose", action="store_true", help="Показывать логи бота")
+
+    synth_parser = commands.add_parser("synthesize", help="Создать синтетическую запись")
+    synth_parser.add_argument("--out", required=True, help="Файл записи")
+    synth_parser.add_argument("--users", type=int, default=300, help="Сколько пользователей")
+    synth_parser.add_argument("--minutes", type=float, default=5, help="За сколько минут они приходят")
+    synth_parser.add_argument("--seed", type=int, default=1, help="Зерно генератора")
+    synth_parser.add_argument("--files", default=os.path.join(benchmark.REPO_DIR, "downloaded_files"),
+                              help="Папка с файлами расписаний и замен")
+
+    args = parser.parse_args(argv)
+    if args.command == "replay":
+        args.speed = [float(value) if '.' in value else int(value) for value in args.speed.split(',')]
+        args.paths = [os.path.abspath(path) for path in args.paths]
+        args.files = os.path.abspath(args.files)
+    else:
+        args.out = os.path.abspath(args.out)
+        args.files = os.path.abspath(args.files)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO if getattr(args, 'verbose', False) else logging.ERROR)
+    if args.command == "synthesize":
+        return synthesize(args)
+    return run_replay(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -26,7 +26,6 @@ from functools import lru_cache
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import asyncio
 import re
-import json  # Added missing json import
 from cache_utils import (
     get_cached_student_schedule,
     cache_student_schedule,
@@ -37,8 +36,11 @@ from cache_utils import (
     get_cached_classroom_schedule,
     selective_cache_clear
 )
+from subscriber_store import get_subscriber_registry
+from single_flight import coalesced
+from metrics import timed, track_query
+from task_scheduler import SchedulerExecutor, run_task
 
-from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from threading import Thread
 import httpx  # Add this import
@@ -79,8 +81,8 @@ days_ru = {
     6: 'воскресенье'
 }
 
-# Глобальный ThreadPoolExecutor для обработки тяжелых задач
-thread_pool = ThreadPoolExecutor(max_workers=20)  # Increased number of workers
+# Тяжелые задачи выполняются общим планировщиком (task_scheduler) с классом приоритета текущего контекста
+thread_pool = SchedulerExecutor()
 # Improve the non_blocking_handler to handle connection errors during shutdown
 # Improve the non_blocking_handler to handle connection errors during shutdown
 def non_blocking_handler(handler_func):
@@ -102,12 +104,8 @@ def non_blocking_handler(handler_func):
 
     # First, make sure we have a proper run_blocking function
 async def run_blocking(func, *args, **kwargs):
-    """Run blocking function in threadpool."""
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(
-        thread_pool, 
-        lambda: func(*args, **kwargs)
-    )
+    """Run blocking function in the shared task scheduler."""
+    return await run_task(func, *args, **kwargs)
 
 async def _run_handler(update, context, handler_func):
     """Helper function to run the handler in the current event loop"""
@@ -153,58 +151,97 @@ def get_cached_schedule(file_path, date_str, teacher_name):
                 return cached_data['schedule']
     return None
 
-# Функция для загрузки списка подписчиков
+# Функция для загрузки списка подписчиков (снимок хранилища подписчиков)
 def load_subscribers():
     try:
-        if os.path.exists(SUBSCRIBERS_FILE):
-            with open(SUBSCRIBERS_FILE, 'r') as f:
-                return json.load(f)
-        return {}
+        return get_subscriber_registry().all()
     except Exception as e:
         logger.error(f"Ошибка при загрузке списка подписчиков: {e}")
         return {}
 
-# Функция для сохранения списка подписчиков
+# Функция для сохранения списка подписчиков (записываются только изменившиеся)
 def save_subscribers(subscribers):
     try:
-        with open(SUBSCRIBERS_FILE, 'w') as f:
-            json.dump(subscribers, f)
+        get_subscriber_registry().replace_all(subscribers)
     except Exception as e:
         logger.error(f"Ошибка при сохранении списка подписчиков: {e}")
 
 # Функция для проверки подписки пользователя
 def is_subscribed(user_id):
-    subscribers = load_subscribers()
-    return str(user_id) in subscribers
+    return get_subscriber_registry().is_subscribed(user_id)
+
+# Слова, после которых в /subscribe указывается преподаватель
+TEACHER_SUBSCRIPTION_WORDS = ("препод", "преподаватель", "teacher")
+
+def parse_subscription_args(args):
+    """
+    Разбирает настройки подписки из аргументов /subscribe.
+
+    /subscribe ИСпП-22-1 [1|2] - изменения для группы (и подгруппы)
+    /subscribe препод Иванов И.И. - изменения для преподавателя
+
+    Returns:
+        tuple: (настройки, текст ошибки или None)
+    """
+    from schedule_store import get_store
+
+    store = get_store()
+    if args[0].lower() in TEACHER_SUBSCRIPTION_WORDS:
+        teacher = ' '.join(args[1:]).strip()
+        keys = store.find_teacher_keys(teacher) if teacher else []
+        if not keys:
+            return None, "❌ Преподаватель не найден. Пример: /subscribe препод Иванов И.И."
+        return {"teacher": store.teacher_display_names[keys[0]]}, None
+
+    file_name = store.find_group_file(args[0])
+    if not file_name:
+        return None, "❌ Группа не найдена. Пример: /subscribe ИСпП-22-1 1"
+    preferences = {"group": os.path.splitext(file_name)[0]}
+    if len(args) > 1:
+        if args[1] not in ("1", "2"):
+            return None, "❌ Подгруппа указывается числом 1 или 2. Пример: /subscribe ИСпП-22-1 1"
+        preferences["subgroup"] = int(args[1])
+    return preferences, None
 
 # Обработчик для команды подписки
 async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     username = update.effective_user.username or "Unknown"
+    args = context.args or []
     
-    # Проверяем, подписан ли уже пользователь
-    if is_subscribed(user_id):
+    # Без аргументов - общая подписка на все замены
+    preferences = {}
+    if args:
+        # Поиск группы или преподавателя может сверять расписание с диском
+        preferences, error = await run_blocking(parse_subscription_args, args)
+        if error:
+            await update.message.reply_text(error)
+            return
+    elif is_subscribed(user_id):
         await update.message.reply_text(
             "✅ У вас уже есть активная подписка на уведомления о заменах.\n"
-            "Вы будете получать уведомления о новых заменах."
+            "Вы будете получать уведомления о новых заменах.\n\n"
+            "Чтобы получать только изменения для своей группы или преподавателя:\n"
+            "/subscribe ИСпП-22-1 1\n"
+            "/subscribe препод Иванов И.И."
         )
         return
     
     # Добавляем пользователя в список подписчиков
-    subscribers = load_subscribers()
-    subscribers[str(user_id)] = {
-        "username": username,
-        "subscribed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "active": True
-    }
-    save_subscribers(subscribers)
+    get_subscriber_registry().subscribe(user_id, username, preferences)
     
+    if preferences.get("teacher"):
+        details = f"Вы будете получать изменения в расписании преподавателя {preferences['teacher']}."
+    elif preferences.get("group"):
+        subgroup_info = f", {preferences['subgroup']}-я подгруппа" if preferences.get("subgroup") else ""
+        details = f"Вы будете получать изменения в расписании группы {preferences['group']}{subgroup_info}."
+    else:
+        details = "Теперь вы будете получать уведомления о новых заменах "
     await update.message.reply_text(
-        "✅ Подписка успешно активирована!\n\n"
-        "Теперь вы будете получать уведомления о новых заменах "
+        "✅ Подписка успешно активирована!\n\n" + details
     )
     
-    logger.info(f"Новый подписчик: {username} (ID: {user_id})")
+    logger.info(f"Новый подписчик: {username} (ID: {user_id}), настройки: {preferences or 'все замены'}")
 
 # Обработчик для команды отписки
 async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -218,10 +255,7 @@ async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     # Удаляем пользователя из списка подписчиков
-    subscribers = load_subscribers()
-    if str(user_id) in subscribers:
-        del subscribers[str(user_id)]
-        save_subscribers(subscribers)
+    get_subscriber_registry().unsubscribe(user_id)
     
     await update.message.reply_text(
         "✅ Вы успешно отписались от уведомлений о заменах."
@@ -229,34 +263,6 @@ async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     logger.info(f"Пользователь отписался: ID: {user_id}")
 
-# Обработчик для проверки и отправки уведомлений
-async def check_notifications(context: ContextTypes.DEFAULT_TYPE) -> None:
-    try:
-        if os.path.exists("pending_notifications.json"):
-            with open("pending_notifications.json", "r") as f:
-                notification_data = json.load(f)
-            
-            message = notification_data.get("message", "")
-            
-            if message:
-                # Загружаем актуальный список подписчиков
-                current_subscribers = load_subscribers()
-                
-                # Отправляем уведомления всем активным подписчикам
-                for user_id in current_subscribers:
-                    try:
-                        await context.bot.send_message(chat_id=user_id, text=message)
-                        logger.info(f"Уведомление отправлено пользователю {user_id}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
-                
-                # Удаляем файл после отправки
-                os.remove("pending_notifications.json")
-                logger.info("Все уведомления отправлены и файл удален")
-    
-    except Exception as e:
-        logger.error(f"Ошибка при проверке и отправке уведомлений: {e}")
-
 def get_week_type(date_str):
     """Определяет тип недели на основе референсной даты"""
     # Начальная дата семестра (первая неделя - нечетная)
@@ -289,6 +295,10 @@ def find_day_column(sheet, day_name, start_row, is_even_week):
     """
     Ищет колонку и строку начала расписания для конкретного дня
     """
+    # Для SheetGrid положение дней недели вычислено заранее
+    if hasattr(sheet, 'find_day'):
+        return sheet.find_day(day_name, is_even_week)
+
     logger.info(f"Searching for day: {day_name}")
     logger.info(f"Is even week: {is_even_week}")
 
@@ -339,7 +349,14 @@ def is_theory_lesson(subject):
     # Если есть хотя бы один индикатор не теоретической пары, значит пара не теоретическая
     return not any(indicator in subject for indicator in non_theory_indicators)
 
-def parse_teacher_schedule(schedule_file, date_str, teacher_name):
+def open_workbook(file_path, workbook_provider=None):
+    """Открывает книгу Excel через переданный кэш книг или напрямую с диска"""
+    if workbook_provider is not None:
+        return workbook_provider.get_workbook(file_path)
+    return openpyxl.load_workbook(file_path)
+
+
+def parse_teacher_schedule(schedule_file, date_str, teacher_name, workbook_provider=None):
     """Парсит расписание для преподавателя"""
     try:
         # Remove general info logs
@@ -417,7 +434,7 @@ def parse_teacher_schedule(schedule_file, date_str, teacher_name):
                         # logger.info(f"Найден подходящий файл замен: {replacement_file} для даты {date_str}")
                         
                         # Загружаем файл замен
-                        wb_replacements = openpyxl.load_workbook(replacement_path)
+                        wb_replacements = open_workbook(replacement_path, workbook_provider)
                         sheet_replacements = wb_replacements.active
                         
                         # Ищем замены для текущей даты
@@ -546,7 +563,7 @@ def parse_teacher_schedule(schedule_file, date_str, teacher_name):
             
             return new_lessons
             
-        wb = openpyxl.load_workbook(schedule_file)
+        wb = open_workbook(schedule_file, workbook_provider)
         sheet = wb.active
         schedule = {}
         
@@ -657,7 +674,7 @@ def parse_teacher_schedule(schedule_file, date_str, teacher_name):
 
                     if start_date <= check_date <= end_date:
                         # Загружаем файл замен
-                        wb_replacements = openpyxl.load_workbook(replacement_path)
+                        wb_replacements = open_workbook(replacement_path, workbook_provider)
                         sheet_replacements = wb_replacements.active
 
                         # Ищем колонку группы
@@ -1212,6 +1229,7 @@ def parse_teacher_schedule(schedule_file, date_str, teacher_name):
         return {}
 
 
+@timed("formatting")
 def format_teacher_schedule(schedule_data, teacher_name, start_date, end_date):
     """Форматирует расписание преподавателя"""
     try:
@@ -2318,7 +2336,8 @@ async def choose_date_for_classroom(update: Update, context: ContextTypes.DEFAUL
         ], resize_keyboard=True)
         
         # Send the schedule
-        await update.message.reply_text(schedule, reply_markup=keyboard)
+        with timed("telegram_send", "classroom"):
+            await update.message.reply_text(schedule, reply_markup=keyboard)
         
         # Store date in context for potential "Other date" selection
         context.user_data['last_checked_date'] = selected_date
@@ -2542,7 +2561,8 @@ async def enter_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
             ['Отмена']
         ], resize_keyboard=True)
         
-        await update.message.reply_text(schedule_result, reply_markup=keyboard)
+        with timed("telegram_send", "teacher"):
+            await update.message.reply_text(schedule_result, reply_markup=keyboard)
         return CHOOSE_ACTION
     
     except Exception as e:
@@ -2598,7 +2618,8 @@ async def choose_subgroup(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         subgroup = 1 if '1' in choice else 2
 
     schedule = await get_schedule_for_days(group, subgroup, update)
-    await update.message.reply_text(schedule)
+    with timed("telegram_send", "group"):
+        await update.message.reply_text(schedule)
 
     return ConversationHandler.END
 
@@ -2623,6 +2644,8 @@ async def set_commands(application: Application):
         BotCommand(command="cancel", description="Отменить текущую операцию"),
         BotCommand(command="clear_cache", description="Очистить кэш (только для администраторов)"),
         BotCommand("classroom", "Расписание кабинета(бета) (например, /classroom А403 02.05.2023)"),
+        BotCommand("free_rooms", "Свободные кабинеты на пару (например, /free_rooms 3 02.05.2023)"),
+        BotCommand("subscribe", "Подписка на изменения (например, /subscribe ИСпП-22-1 1 или /subscribe препод Иванов И.И.)"),
         BotCommand(command="myid", description="Узнать свой ID пользователя")
     ]
     await application.bot.set_my_commands(commands)
@@ -2665,6 +2688,7 @@ def find_applicable_replacement_files(dbx, target_date):
         return []
 
 
+@timed("formatting")
 def format_schedule(schedule, group_name, date_str, selected_subgroup=None):
     """Форматирует расписание с учетом замен"""
     date_obj = datetime.strptime(date_str, '%d.%m.%Y')
@@ -2943,7 +2967,8 @@ async def choose_date_for_teacher(update: Update, context: ContextTypes.DEFAULT_
     await update.message.reply_text("Получаю расписание, может потребовать от 30 секунд до 4 минут...")
     teacher_name = context.user_data.get('teacher_name')
     schedule_text = await get_teacher_schedule(teacher_name, date_str, date_str)
-    await update.message.reply_text(schedule_text)
+    with timed("telegram_send", "teacher"):
+        await update.message.reply_text(schedule_text)
     return ConversationHandler.END
 
 
@@ -2998,7 +3023,8 @@ async def subgroup_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return CHOOSE_SUBGROUP
 
     schedule_text = await get_schedule_for_days(group, subgroup, update)
-    await update.message.reply_text(schedule_text)
+    with timed("telegram_send", "group"):
+        await update.message.reply_text(schedule_text)
 
     keyboard = ReplyKeyboardMarkup([
         [KeyboardButton("Первая подгруппа"), KeyboardButton("Вторая подгруппа")],
@@ -3324,19 +3350,15 @@ async def choose_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         return CHOOSE_ACTION
 
 
-async def get_schedule_for_days(group: str, subgroup: int = None, update: Update = None) -> str:
-    """Gets schedule for group with replacements from local files (async version)"""
+@coalesced("group", lambda group, subgroup=None: ((group or "").strip().upper(), subgroup))
+async def build_schedule_for_days(group: str, subgroup: int = None) -> str:
+    """Builds schedule text for group with replacements from local files (one build per concurrent query)"""
     try:
-        if update:
-            wait_message = await update.message.reply_text("Подождите...")
-
         # Check cache at the start
         logger.info(f"Проверка кэша для группы {group}, подгруппа {subgroup}")
         cached_schedule = await run_blocking(get_cached_student_schedule, group, subgroup)
         if cached_schedule:
             logger.info("Найдено кэшированное расписание")
-            if update and wait_message:
-                await wait_message.delete()
             return cached_schedule
 
         # Get schedule files list
@@ -3351,8 +3373,6 @@ async def get_schedule_for_days(group: str, subgroup: int = None, update: Update
                 break
 
         if not schedule_file:
-            if update and wait_message:
-                await wait_message.delete()
             return f"Расписание для группы {group} не найдено."
 
         schedule_file_path = os.path.join("downloaded_files", schedule_file)
@@ -3520,26 +3540,39 @@ async def get_schedule_for_days(group: str, subgroup: int = None, update: Update
         sorted_schedules = sorted(valid_schedules, key=lambda x: datetime.strptime(x[0], '%d.%m.%Y'))
         schedules = [schedule for _, schedule in sorted_schedules]
 
-        if update and wait_message:
-            await wait_message.delete()
-
         if not schedules:
             return f"Расписание для группы {group} не найдено."
 
         result = "\n\n".join(schedules)
 
-        # Cache the result
-        await run_blocking(cache_student_schedule, group, subgroup, result)
+        # Cache the result, tagged with the resolved group too ("испп-23" -> ИСпП-23-1)
+        await run_blocking(cache_student_schedule, group, subgroup, result, group_file=schedule_file)
 
         return result
 
     except Exception as e:
         logger.error(f"Ошибка при получении расписания: {str(e)}")
-        if update and wait_message:
-            await wait_message.delete()
         return f"Произошла ошибка при получении расписания: {str(e)}"
 
 
+async def get_schedule_for_days(group: str, subgroup: int = None, update: Update = None) -> str:
+    """Gets schedule for group with replacements from local files (async version)"""
+    wait_message = None
+    try:
+        if update:
+            wait_message = await update.message.reply_text("Подождите...")
+        with track_query("group"):
+            return await build_schedule_for_days(group, subgroup)
+    except asyncio.TimeoutError:
+        return f"Не удалось получить расписание для группы {group} из-за таймаута. Пожалуйста, попробуйте позже."
+    finally:
+        if wait_message:
+            try:
+                await wait_message.delete()
+            except Exception as e:
+                logger.error(f"Не удалось удалить сообщение ожидания: {e}")
+
+
 async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle all messages and maintain menu functionality"""
     if not update.message or not update.message.text:
@@ -3645,6 +3678,7 @@ async def get_my_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message += "\nЧтобы получить права администратора, обратитесь к разработчику бота."
     
     await update.message.reply_text(message)
+@coalesced("classroom_files", lambda classroom, date_str: ((classroom or "").strip().upper(), date_str.strip()))
 async def get_classroom_schedule(classroom: str, date_str: str) -> str:
     """Gets schedule for a specific classroom on a specific date"""
     try:
@@ -4187,7 +4221,8 @@ async def classroom_schedule_date_handler(update: Update, context: ContextTypes.
         schedule = await get_classroom_schedule(classroom, date_str)
         
         # Send the schedule
-        await query.message.reply_text(schedule)
+        with timed("telegram_send", "classroom"):
+            await query.message.reply_text(schedule)
         
         return ConversationHandler.END
         